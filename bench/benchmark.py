@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+
+import subprocess 																		# Run Pipeline Scripts
+import argparse 																		# Input Argument Parser
+import logging 																			# Quiet Stage Logs
+import sqlite3 																			# Read the Participant Ledger
+import shutil 																			# Remove Study Trees
+import time as t0 																		# Timer
+import json 																			# JSON Files
+import sys 																				# System Operations
+import os 																				# Operating System
+
+import pandas as pd 																	# Result Tables
+
+bench    = os.path.dirname(os.path.abspath(__file__)) 									# bench Directory
+repo     = os.path.dirname(bench) 														# Repository Directory
+stubs    = '{}/stubs'.format(bench) 													# Stub Executables
+sys.path.insert(0, '{}/src'.format(repo)) 												# Pipeline Modules
+
+import generate 																		# Synthetic Studies
+from scanner import RawScanner 															# Incremental Raw Directory Scanner
+from ledger import ParticipantLedger 													# Indexed Participant Log
+from bidsindex import BidsIndex 														# BIDS Metadata Index
+from results import ResultsStore, session_date 											# Study-Wide Results Store
+from qastats import OnlineStats, session_metrics 										# Streaming QA Statistics
+from preflight import check_pair 														# Pre-Flight QC
+from preprocess import reduce_pair 														# Coil Combination, Alignment and Averaging
+import main 																			# Pipeline Stages
+
+higher   = ['jobs_per_s', 'sessions_per_hour', 'e2e_batch_runs_sessions_per_hour'] 		# Metrics where Higher is Better (others are Seconds)
+
+def bench_discovery(basedir): 															# Raw Directory Scan (Cold and Warm)
+	rawdir  = '{}/raw'.format(basedir) 													# Raw Directory
+	if os.path.exists('{}/.scan_cache.json'.format(rawdir)): 							# Start without Cache
+		os.remove('{}/.scan_cache.json'.format(rawdir))
+
+	start   = t0.time()
+	RawScanner(rawdir).scan() 															# Every Subject Listed
+	cold    = t0.time() - start
+
+	t0.sleep(2.5) 																		# Outside the Scanner's Modification Time Slack
+	RawScanner(rawdir).scan() 															# Cache Trusted from now on
+	start   = t0.time()
+	subdict, combined = RawScanner(rawdir).scan() 										# Only Changed Subjects Listed
+	warm    = t0.time() - start
+	return {'discovery_cold_s': cold, 'discovery_warm_s': warm}, combined
+
+def bench_bids_index(basedir): 															# BIDS Metadata Index (Cold and Warm)
+	bidsdir = '{}/bids'.format(basedir) 												# BIDS Directory
+	if os.path.exists('{}/.bids_index.db'.format(bidsdir)): 							# Start without Index
+		os.remove('{}/.bids_index.db'.format(bidsdir))
+
+	index   = BidsIndex(bidsdir)
+	start   = t0.time()
+	index.update() 																		# Every Directory Listed, Every Sidecar Read
+	cold    = t0.time() - start
+
+	t0.sleep(2.5) 																		# Outside the Index's Modification Time Slack
+	index.update() 																		# Listings Trusted from now on
+	start   = t0.time()
+	index.update() 																		# Only Changed Directories Listed
+	warm    = t0.time() - start
+	index.close()
+	return {'bids_index_cold_s': cold, 'bids_index_warm_s': warm}
+
+def bench_ledger(basedir, combined): 													# Participant Ledger Updates
+	dbfile   = '{}/bench_ledger.db'.format(basedir) 									# Separate Ledger (main.py keeps its own)
+	partfile = '{}/bench_ledger.csv'.format(basedir) 									# Separate Participant Log File
+	for filepath in [dbfile, partfile]: 												# Start without Ledger
+		if os.path.exists(filepath):
+			os.remove(filepath)
+
+	combined = [tuple(comb.split('_', 1)) for comb in combined] 						# (Subject, Session)
+	ledger   = ParticipantLedger(dbfile, partfile)
+	start    = t0.time()
+	ledger.add(basedir, combined[:-1]) 													# Every Session New
+	cold     = t0.time() - start
+	ledger.close()
+
+	ledger   = ParticipantLedger(dbfile, partfile) 										# Reopen (Loads Index)
+	start    = t0.time()
+	ledger.add(basedir, combined) 														# One New Session
+	incr     = t0.time() - start
+	ledger.close()
+	return {'ledger_cold_s': cold, 'ledger_incremental_s': incr}
+
+def bench_jobs(basedir, combined): 														# Osprey Job File Generation
+	quiet          = logging.getLogger('bench') 										# Stage Logs Discarded
+	quiet.addHandler(logging.NullHandler())
+	quiet.propagate = False
+	main.sub_log   = quiet 																# Globals set by main.py before Stages Run
+	main.study_log = quiet
+
+	start    = t0.time()
+	failed   = 0 																		# Sessions without Job File
+	for comb in combined: 																# Iterate over Sessions
+		sub, ses = comb.split('_', 1)
+		failed  += main.osprey_job(basedir, sub, ses, {}) == False
+	seconds  = t0.time() - start
+	return {'jobs_s': seconds, 'jobs_per_s': len(combined) / seconds, 'jobs_failed': failed}
+
+def bench_qc(basedir, combined): 														# Pre-Flight QC of the Osprey Jobs
+	start    = t0.time()
+	runs     = 0 																		# Scan/Reference Pairs Checked
+	for comb in combined: 																# Iterate over Sessions (Job Files from bench_jobs)
+		sub, ses = comb.split('_', 1)
+		with open(main.osprey_job_file(basedir, sub, ses), 'r') as f:
+			job  = json.loads(f.read())
+		for scan, ref in zip(job['files'], job['files_ref']): 							# Iterate over Runs
+			check_pair(scan, ref)
+			runs += 1
+	seconds  = t0.time() - start
+	return {'qc_s': seconds, 'qc_per_session_s': seconds / max(1, len(combined)), 'qc_runs': runs}
+
+def bench_prep(basedir, combined): 														# Reduced NIfTI-MRS of the Osprey Jobs
+	start    = t0.time()
+	for comb in combined: 																# Iterate over Sessions (Job Files from bench_jobs)
+		sub, ses = comb.split('_', 1)
+		with open(main.osprey_job_file(basedir, sub, ses), 'r') as f:
+			job  = json.loads(f.read())
+		for scan, ref in zip(job['files'], job['files_ref']): 							# Iterate over Runs
+			reduce_pair(scan, ref, '{}/bench_reduced/{}'.format(basedir, comb)) 		# Separate Directory (main.py keeps its own)
+	seconds  = t0.time() - start
+	return {'prep_s': seconds, 'prep_per_session_s': seconds / max(1, len(combined))}
+
+def bench_results(basedir, combined): 													# Study Results Store (Write per Session, Projected Read)
+	storedir = '{}/bench_results'.format(basedir) 										# Separate Store (main.py keeps its own)
+	qafiles  = ['{}/bench_qa_stats.json'.format(basedir), '{}/bench_qa_alerts.jsonl'.format(basedir)] # Separate QA Statistics
+	if os.path.exists(storedir): 														# Start without Store
+		shutil.rmtree(storedir)
+	for filepath in qafiles: 															# Start without QA Statistics
+		if os.path.exists(filepath):
+			os.remove(filepath)
+
+	store    = ResultsStore(storedir)
+	online   = OnlineStats(*qafiles)
+	qa       = 0 																		# QA Update Time
+	start    = t0.time()
+	for n, comb in enumerate(combined): 												# One Session at a Time (as the osprey_results Stage)
+		sub, ses = comb.split('_', 1)
+		date     = session_date('{}/bids/{}/{}'.format(basedir, sub, ses), sub, ses) 	# From the Scans Table
+		table    = pd.DataFrame({'Subject': [comb], 'tNAA': [1.0 + n % 7 / 10], 'tCr': [1.0]})
+		store.write_session(sub, ses, date, {'QuantifyResults.A_tCr_Voxel_1': table})
+		qa_start = t0.time()
+		online.add_session(sub, ses, 'bench', session_metrics({'QuantifyResults.A_tCr_Voxel_1': table}))
+		qa      += t0.time() - qa_start
+	write    = t0.time() - start - qa
+
+	start    = t0.time()
+	rows     = ResultsStore(storedir).read('QuantifyResults.A_tCr_Voxel_1', ['sub', 'ses', 'tNAA']) # Reopen (Loads Index)
+	read     = t0.time() - start
+	return {'results_write_s': write, 'results_read_s': read, 'results_rows': len(rows), 'qa_update_s': qa}
+
+def bench_runpy(root, basedir): 														# run.py (BIDS App Wrapper) over the Study
+	env      = dict(os.environ, EXECUTABLE_PATH=shutil.which('true') or 'true', MCR_PATH='mcr') # Osprey not Run (Wrapper Overhead Only)
+	outdir   = '{}/bids/derivatives/runpy'.format(basedir) 								# run.py Outputs
+	script   = [sys.executable, '{}/src/run.py'.format(repo), '{}/bids'.format(basedir), outdir,
+				'participant', '{}/src/run_settings.json'.format(root)]
+	start    = t0.time()
+	P        = subprocess.run(script, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+	seconds  = t0.time() - start
+	if P.returncode != 0: 																# Wrapper Failed
+		print(P.stderr.decode(errors='replace'), file=sys.stderr)
+	return {'runpy_s': seconds, 'runpy_exit_code': P.returncode}
+
+def bench_end_to_end(root, sessions, params, args, prefix='e2e', extra=[]): 			# main.py with Stub Executables
+	'''
+	- 1. Description:
+		- Runs main.py over a fresh raw-only study with the stub dicomsort,
+		    bidscoiner and OspreyCMD on PATH, and counts the sessions the
+		    Participant Ledger records as successful, and the sessions whose
+		    osprey_run could not be batched (see main.osprey_batch).
+
+	- 2. Inputs:
+		- root     : (String) Root Directory of the benchmark studies
+		- sessions : (Int   ) Number of sessions
+		- params   : (Dict  ) Session parameters
+		- args     : (Object) Command line arguments (jobs, stub runtimes)
+		- prefix   : (String) Name of the run in the metrics (and of its study)
+		- extra    : (List  ) main.py arguments added to --main-args
+
+	- 3. Outputs:
+		- results  : (Dict  ) Wall time, successful and unbatched sessions and sessions/hour
+	'''
+
+	basedir  = generate.write_study(root, prefix, sessions, params, args.sessions_per_subject, bids=False)
+	env      = dict(os.environ, PATH=stubs + os.pathsep + os.environ.get('PATH', ''), 	# Stub Executables First
+					STUB_DICOMSORT_SECONDS =str(args.dicomsort_seconds),
+					STUB_BIDSCOINER_SECONDS=str(args.bidscoiner_seconds),
+					STUB_OSPREY_STARTUP    =str(args.osprey_startup),
+					STUB_OSPREY_FIT        =str(args.osprey_fit))
+	script   = [sys.executable, '{}/src/main.py'.format(repo), '-b', basedir, '-o', stubs,
+				'-j', str(args.jobs), '--quiet', '0', '--poll', '0.1'] + args.main_args + extra
+	start    = t0.time()
+	P        = subprocess.run(script, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+	seconds  = t0.time() - start
+	if P.returncode != 0: 																# Pipeline Failed
+		print(P.stderr.decode(errors='replace'), file=sys.stderr)
+
+	db       = sqlite3.connect('{}/raw/participant_log.db'.format(basedir)) 			# Participant Ledger
+	success  = db.execute("SELECT COUNT(*) FROM participants WHERE Status = 'success'").fetchone()[0]
+	db.close()
+	unbatched = 0 																		# Sessions Run on their Own
+	for dirpath, dirs, files in os.walk('{}/raw'.format(basedir)): 						# Subject Logs
+		for filename in files:
+			if filename.endswith('.log'):
+				with open(os.path.join(dirpath, filename), 'r') as f:
+					unbatched += 'osprey run: not batched' in f.read()
+	shutil.rmtree(basedir) 																# Next Size Starts Fresh
+	rate     = 'sessions_per_hour' if prefix == 'e2e' else '{}_sessions_per_hour'.format(prefix)
+	return {'{}_s'.format(prefix): seconds, '{}_success'.format(prefix): success,
+			'{}_unbatched'.format(prefix): unbatched, rate: success / seconds * 3600}
+
+def compare(results, baseline, tolerance): 												# Regressions against a Baseline
+	'''
+	- 1. Description:
+		- Compares every metric with the same size in a baseline results file.
+		    Seconds that grew, or rates that dropped, by more than the tolerance
+		    (fraction) are regressions.
+
+	- 2. Outputs:
+		- regressions: (List) Messages naming size, metric, baseline and current value
+	'''
+
+	regressions = []
+	for size, metrics in results['sizes'].items(): 										# Iterate over Sizes
+		for metric, value in metrics.items(): 											# Iterate over Metrics
+			base = baseline.get('sizes', {}).get(size, {}).get(metric) 					# Baseline Value
+			if base is None or base == 0 or metric == 'generate_s' or metric.endswith(('_failed', '_exit_code', '_success', '_unbatched')): # Not Comparable
+				continue
+			change = value / base - 1 if metric not in higher else base / value - 1 if value > 0 else float('inf')
+			if change > tolerance: 														# Slower than Baseline
+				regressions.append('{:>6} sessions {:<22} {:10.3f} -> {:10.3f} ({:+.0%})'.format(size, metric, base, value, change))
+	return regressions
+
+if __name__ == '__main__':
+
+	parser = argparse.ArgumentParser(description='Pipeline throughput benchmark on synthetic studies')
+	parser.add_argument('--sizes'               , help='Numbers of sessions'                       , type=int, nargs='+', default=[10, 100, 1000, 10000])
+	parser.add_argument('--root'                , help='Directory for the synthetic studies'       , type=str, default='bench_data')
+	parser.add_argument('--sessions-per-subject', help='Sessions of every subject'                 , type=int, default=1)
+	parser.add_argument('--runs'                , help='MRS runs per session'                      , type=int, default=1)
+	parser.add_argument('--points'              , help='Spectral points'                           , type=int, default=512)
+	parser.add_argument('--e2e-max'             , help='Largest size run end-to-end through main.py', type=int, default=100)
+	parser.add_argument('-j', '--jobs'          , help='main.py --jobs for the end-to-end run'     , type=int, default=4)
+	parser.add_argument('--batch-size'          , help='main.py --batch for the multi-run end-to-end run', type=int, default=3)
+	parser.add_argument('--main-args'           , help='Extra main.py arguments (i.e. "--batch 4")', type=str, default='')
+	parser.add_argument('--dicomsort-seconds'   , help='Stub dicomsort runtime'                    , type=float, default=0.1)
+	parser.add_argument('--bidscoiner-seconds'  , help='Stub bidscoiner runtime per session'       , type=float, default=0.2)
+	parser.add_argument('--osprey-startup'      , help='Stub OspreyCMD startup (Matlab Runtime)'   , type=float, default=1.0)
+	parser.add_argument('--osprey-fit'          , help='Stub OspreyCMD seconds per dataset'        , type=float, default=0.2)
+	parser.add_argument('--out'                 , help='Results JSON file'                         , type=str, default='bench_results.json')
+	parser.add_argument('--baseline'            , help='Results JSON file to compare with'         , type=str)
+	parser.add_argument('--tolerance'           , help='Allowed slowdown against the baseline'     , type=float, default=0.25)
+	parser.add_argument('--keep'                , help='Keep the synthetic studies'                , action='store_true')
+	args   = parser.parse_args()
+	args.main_args = args.main_args.split()
+
+	root    = os.path.abspath(args.root).replace('\\', '/') 							# Benchmark Root
+	params  = {'dicoms': 6, 'runs': args.runs, 'points': args.points, 'coils': 1, 'averages': 4, 'drift': 0.0}
+	results = {'settings': {key: value for key, value in vars(args).items() if key not in ['out', 'baseline']},
+			   'sizes'   : {}}
+
+	for size in args.sizes: 															# Iterate over Study Sizes
+		sizeroot = '{}/size-{}'.format(root, size) 										# Study of this Size
+		if os.path.exists(sizeroot): 													# Previous Benchmark
+			shutil.rmtree(sizeroot)
+
+		start    = t0.time()
+		basedir  = generate.write_study(sizeroot, 'study', size, params, args.sessions_per_subject)
+		metrics  = {'generate_s': t0.time() - start} 									# Generation Time (not Compared)
+
+		found, combined = bench_discovery(basedir)
+		metrics.update(found)
+		metrics.update(bench_ledger(basedir, combined))
+		metrics.update(bench_bids_index(basedir))
+		metrics.update(bench_jobs(basedir, combined))
+		metrics.update(bench_qc(basedir, combined))
+		metrics.update(bench_prep(basedir, combined))
+		metrics.update(bench_results(basedir, combined))
+		metrics.update(bench_runpy(sizeroot, basedir))
+		if size <= args.e2e_max: 														# Small Enough to Run End-to-End
+			metrics.update(bench_end_to_end(sizeroot, size, params, args))
+			metrics.update(bench_end_to_end(sizeroot, size, dict(params, runs=max(2, args.runs)), args, # Batched Multi-Run Sessions (One T1w per Session)
+											'e2e_batch_runs', ['--batch', str(args.batch_size)]))
+
+		results['sizes'][str(size)] = metrics
+		print('{:>6} sessions: '.format(size) + ', '.join('{} {:.3f}'.format(key, value) for key, value in metrics.items()), flush=True)
+		if args.keep == False: 															# Remove Study
+			shutil.rmtree(sizeroot)
+
+	with open(args.out, 'w') as f: 														# Write Results
+		f.write(json.dumps(results, indent = 4))
+
+	if args.baseline: 																	# Compare with Baseline
+		with open(args.baseline, 'r') as f:
+			regressions = compare(results, json.loads(f.read()), args.tolerance)
+		for line in regressions: 														# Report Regressions
+			print('REGRESSION {}'.format(line))
+		sys.exit(1 if len(regressions) > 0 else 0)
@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+
+import argparse 																		# Input Argument Parser
+import struct 																			# NIfTI Header Packing
+import shutil 																			# Copy Settings Files
+import json 																			# JSON Files
+import gzip 																			# Compressed NIfTI Files
+import zlib 																			# Session UIDs
+import os 																				# Operating System
+
+import numpy as np 																		# Synthetic Spectra
+
+repo     = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) 					# Repository Directory
+sequences = ['SE', 'GR', 'RM'] 															# ScanningSequence of Raw Dicoms (MRS, T1w, Localizer)
+metabs   = [(2.01, 1.0), (3.03, 0.8), (3.21, 0.6), (3.92, 0.5)] 						# Synthetic Peaks (ppm, Amplitude) - NAA, Cr, Cho, Cr
+water    = [(4.65, 20.0)] 																# Water Reference Peak
+
+def nifti_header(shape, datatype, bitpix, pixdim, intent_name=b'', extension=b''): 		# NIfTI-2 Header and Extension
+	'''
+	- 1. Description:
+		- Packs a NIfTI-2 header (540 bytes), followed by the extension flag and
+		    an optional header extension (NIfTI-MRS stores its JSON header
+		    extension with ecode 44). The data starts right after.
+
+	- 2. Inputs:
+		- shape    : (Tuple ) Data dimensions (up to 7)
+		- datatype : (Int   ) NIfTI datatype code (i.e. 32 = complex64)
+		- bitpix   : (Int   ) Bits per voxel
+		- pixdim   : (List  ) Voxel sizes (x, y, z, then the 4th dimension)
+		- intent_name: (Bytes) Intent name (i.e. mrs_v0_2)
+		- extension: (Bytes ) Header extension content (empty = none)
+
+	- 3. Outputs:
+		- header   : (Bytes ) Header, extension flag and extension
+	'''
+
+	ext    = b'' 																		# Header Extension
+	if len(extension) > 0: 																# Pad to a Multiple of 16 Bytes
+		esize = 8 + len(extension) + (-(8 + len(extension)) % 16) 						# Extension Size
+		ext   = struct.pack('<ii', esize, 44) + extension.ljust(esize - 8, b' ') 		# Size, Code (NIfTI-MRS) and Content
+
+	dim    = [len(shape)] + list(shape) + [1] * (7 - len(shape)) 						# Dimensions
+	pix    = [1.0] + list(pixdim) + [1.0] * (7 - len(pixdim)) 							# Voxel Sizes
+	header = struct.pack('<i8shh8q3d8dqdddddd2q80s24sii6d12d3i16sc15s',
+						 540, b'n+2\x00\r\n\x1a\n', datatype, bitpix, *dim, 			# Size, Magic, Type, Dimensions
+						 0.0, 0.0, 0.0, *pix, 544 + len(ext), 							# Intent Parameters, Voxel Sizes, Data Offset
+						 1.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0, 0, 							# Scaling, Display Range, Slice Timing
+						 b'synthetic', b'', 0, 1, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 		# Description, qform/sform
+						 10.0, 0.0, 0.0, 0.0, 0.0, 10.0, 0.0, 0.0, 0.0, 0.0, 10.0, 0.0, # sform Rows (10 mm Voxel)
+						 0, 10, 0, intent_name, b'\x00', b'') 							# Units (mm, s) and Intent Name
+	return header + struct.pack('<4b', 1 if len(ext) > 0 else 0, 0, 0, 0) + ext
+
+def write_nifti(filepath, data, pixdim, intent_name=b'', extension=b''): 				# Write a Gzipped NIfTI-2 File
+	data     = np.asarray(data) 														# Data Array
+	datatype = {np.dtype('complex64'): (32, 64), np.dtype('int16'): (4, 16)}[data.dtype] # NIfTI Datatype and Bits
+	header   = nifti_header(data.shape, datatype[0], datatype[1], pixdim, intent_name, extension)
+	with gzip.open(filepath, 'wb', compresslevel=1) as f: 								# Write Compressed File
+		f.write(header)
+		f.write(data.tobytes(order='F')) 												# NIfTI Stores Column Major
+
+def synthetic_fid(points, coils, averages, rng, dwell=2.5e-4, freq=123.2, 				# Synthetic Single Voxel FIDs
+				  linewidth=6.0, snr=30.0, drift=0.0, peaks=None):
+	'''
+	- 1. Description:
+		- Simulates the FIDs of a single voxel acquisition: a few Lorentzian
+		    peaks (NAA, Cr, Cho, or water for a reference) with random coil phases and amplitudes, a
+		    frequency drift over averages (Hz per average) and Gaussian noise.
+
+	- 2. Inputs:
+		- points   : (Int   ) Spectral points
+		- coils    : (Int   ) Receive coils
+		- averages : (Int   ) Transients
+		- rng      : (Object) NumPy random generator
+		- dwell    : (Float ) Dwell time (s)
+		- freq     : (Float ) Spectrometer frequency (MHz)
+		- linewidth: (Float ) Linewidth (Hz)
+		- snr      : (Float ) Peak amplitude over noise standard deviation
+		- drift    : (Float ) Frequency drift per average (Hz)
+		- peaks    : (List  ) (ppm, Amplitude) of the peaks (None = metabs)
+
+	- 3. Outputs:
+		- fid      : (Array ) complex64 array of shape (1, 1, 1, points, coils, averages)
+	'''
+
+	t      = np.arange(points) * dwell 													# Time Axis
+	shifts = np.arange(averages) * drift 												# Frequency Drift per Average
+	fid    = np.zeros((points, averages), dtype=complex) 								# Coil-Free Signal
+	for ppm, amp in (metabs if peaks is None else peaks): 								# Iterate over Peaks
+		hz   = (ppm - 4.65) * freq 														# Offset from Water (Hz)
+		fid += amp * np.exp((2j * np.pi * (hz + shifts[None, :]) - np.pi * linewidth) * t[:, None])
+
+	phase  = np.exp(1j * rng.uniform(0, 2 * np.pi, coils)) 								# Coil Phases
+	gain   = rng.uniform(0.5, 1.0, coils) 												# Coil Sensitivities
+	fid    = fid[:, None, :] * (gain * phase)[None, :, None] 							# Coil Signals
+	noise  = rng.normal(0, 1 / snr, fid.shape) + 1j * rng.normal(0, 1 / snr, fid.shape) # Gaussian Noise
+	return (fid + noise).astype(np.complex64).reshape(1, 1, 1, points, coils, averages)
+
+def write_mrs(filepath, points, coils, averages, rng, echo_time=0.03, freq=123.2, **kwargs): # Write a NIfTI-MRS File and Sidecar
+	dwell  = kwargs.pop('dwell', 2.5e-4) 												# Dwell Time
+	data   = synthetic_fid(points, coils, averages, rng, dwell=dwell, freq=freq, **kwargs)
+	header = {'SpectrometerFrequency': [freq], 'ResonantNucleus': ['1H'], 				# NIfTI-MRS Header Extension
+			  'EchoTime': echo_time, 'dim_5': 'DIM_COIL', 'dim_6': 'DIM_DYN'}
+	write_nifti(filepath, data, [10.0, 10.0, 10.0, dwell, 1.0, 1.0], b'mrs_v0_2', json.dumps(header).encode())
+
+def write_t1w(filepath, size=8): 														# Write a Small T1w Image
+	write_nifti(filepath, np.zeros((size, size, size), dtype=np.int16), [1.0, 1.0, 1.0])
+
+def write_json(filepath, content): 														# Write a JSON File
+	with open(filepath, 'w') as f:
+		f.write(json.dumps(content, indent = 4))
+
+def dicom_element(group, element, vr, value): 											# Explicit VR Little Endian Element
+	if isinstance(value, str): 															# Text Values are Padded to Even Length
+		value = value.encode() + (b'\x00' if vr == 'UI' else b' ') * (len(value) % 2)
+	if vr in ['OB', 'OW', 'SQ', 'UN', 'UT']: 											# 4-Byte Length
+		return struct.pack('<HH2s2xI', group, element, vr.encode(), len(value)) + value
+	return struct.pack('<HH2sH', group, element, vr.encode(), len(value)) + value
+
+def write_dicom(filepath, series, instance, instances, sequence, size=64): 				# Write a Small DICOM File
+	'''
+	- 1. Description:
+		- Writes a minimal DICOM Part 10 file (explicit VR little endian): the
+		    file meta information, a few series tags (ScanningSequence,
+		    SeriesNumber, InstanceNumber, ImagesInAcquisition, ...) and a
+		    size x size 16-bit image.
+
+	- 2. Inputs:
+		- filepath : (String) File path
+		- series   : (Int   ) Series number
+		- instance : (Int   ) Instance number (1 = first image)
+		- instances: (Int   ) Images in the series
+		- sequence : (String) ScanningSequence (i.e. SE)
+		- size     : (Int   ) Image rows and columns
+	'''
+
+	uid     = '1.2.826.0.1.3680043.10.1{}'.format(zlib.crc32(os.path.dirname(filepath).encode())) # Session UID Root
+	dataset = b''.join([dicom_element(0x0008, 0x0016, 'UI', '1.2.840.10008.5.1.4.1.1.4'),
+						dicom_element(0x0008, 0x0018, 'UI', '{}.{}.{}'.format(uid, series, instance)),
+						dicom_element(0x0008, 0x0060, 'CS', 'MR'),
+						dicom_element(0x0008, 0x103E, 'LO', 'series {} {}'.format(series, sequence)),
+						dicom_element(0x0018, 0x0020, 'CS', sequence),
+						dicom_element(0x0020, 0x000E, 'UI', '{}.{}'.format(uid, series)),
+						dicom_element(0x0020, 0x0011, 'IS', str(series)),
+						dicom_element(0x0020, 0x0013, 'IS', str(instance)),
+						dicom_element(0x0020, 0x1002, 'IS', str(instances)),
+						dicom_element(0x0028, 0x0010, 'US', struct.pack('<H', size)),
+						dicom_element(0x0028, 0x0011, 'US', struct.pack('<H', size)),
+						dicom_element(0x7FE0, 0x0010, 'OW', bytes(2 * size * size))])
+	meta    = b''.join([dicom_element(0x0002, 0x0001, 'OB', b'\x00\x01'),
+						dicom_element(0x0002, 0x0002, 'UI', '1.2.840.10008.5.1.4.1.1.4'),
+						dicom_element(0x0002, 0x0003, 'UI', '{}.{}.{}'.format(uid, series, instance)),
+						dicom_element(0x0002, 0x0010, 'UI', '1.2.840.10008.1.2.1')])
+	with open(filepath, 'wb') as f: 													# Preamble, Meta Information and Data Set
+		f.write(bytes(128) + b'DICM' + dicom_element(0x0002, 0x0000, 'UL', struct.pack('<I', len(meta))) + meta + dataset)
+
+def session_names(index, sessions_per_subject): 										# Subject and Session of the n-th Session
+	sub = 'sub-{:04d}'.format(index // sessions_per_subject + 1) 						# Subject Label
+	ses = 'ses-{:02d}'.format(index % sessions_per_subject + 1) 						# Session Label
+	return sub, ses
+
+def write_raw_session(rawdir, sub, ses, params): 										# Raw Session (Unsorted Dicoms)
+	'''
+	- 1. Description:
+		- Writes an uploaded raw session: small dicom files, spread over one
+		    series per ScanningSequence (see sequences), the synthetic.json
+		    parameters (read by the stub bidscoiner) and the .upload_complete
+		    sentinel.
+
+	- 2. Inputs:
+		- rawdir   : (String) Raw Directory
+		- sub      : (String) Subject label
+		- ses      : (String) Session label
+		- params   : (Dict  ) Session parameters (dicoms, runs, points, ...)
+	'''
+
+	subdir = '{}/{}/{}/DICOM'.format(rawdir, sub, ses) 									# Unsorted Dicom Directory
+	os.makedirs(subdir, exist_ok=True)
+	for ii in range(params['dicoms']): 													# Iterate over Dicom Files
+		series    = ii % len(sequences) 												# Series of the File
+		instances = len(range(series, params['dicoms'], len(sequences))) 				# Files of the Series
+		write_dicom('{}/IM_{:04d}'.format(subdir, ii), series + 1, ii // len(sequences) + 1, instances, sequences[series])
+	write_json('{}/{}/{}/synthetic.json'.format(rawdir, sub, ses), params) 				# Session Parameters
+	open('{}/{}/{}/.upload_complete'.format(rawdir, sub, ses), 'w').close() 			# Upload Sentinel
+
+def write_bids_session(bidsdir, sub, ses, params, seed=0): 								# BIDS Session (NIfTI-MRS and T1w)
+	'''
+	- 1. Description:
+		- Writes a BIDS session: one metabolite (svs) and water reference
+		    (svs_ref) NIfTI-MRS file per run with JSON sidecars, and a T1w image.
+		    With more than one run, the sidecars of a run name each other in
+		    their IntendedFor fields (relative to the subject directory). The
+		    scans table gives the session an acquisition date (from the seed).
+
+	- 2. Inputs:
+		- bidsdir  : (String) BIDS Directory
+		- sub      : (String) Subject label
+		- ses      : (String) Session label
+		- params   : (Dict  ) Session parameters (runs, points, coils, averages)
+		- seed     : (Int   ) Random seed of the session
+	'''
+
+	rng    = np.random.default_rng(seed) 												# Reproducible Noise
+	mrsdir = '{}/{}/{}/mrs'.format(bidsdir, sub, ses) 									# MRS Directory
+	anat   = '{}/{}/{}/anat'.format(bidsdir, sub, ses) 									# Anatomical Directory
+	os.makedirs(mrsdir, exist_ok=True)
+	os.makedirs(anat, exist_ok=True)
+
+	for run in range(1, params['runs'] + 1): 											# Iterate over Runs
+		stem  = '{}_{}_run-{}'.format(sub, ses, run) if params['runs'] > 1 else '{}_{}'.format(sub, ses) # File Name Stem
+		names = ['{}_svs.nii.gz'.format(stem), '{}_svs_ref.nii.gz'.format(stem)] 		# Metabolite and Reference
+		for name, averages, peaks in zip(names, [params['averages'], 1], [metabs, water]): # Iterate over Metabolite and Reference
+			write_mrs('{}/{}'.format(mrsdir, name), params['points'], params['coils'], averages, rng,
+					  drift=params.get('drift', 0.0), snr=params.get('snr', 30.0), peaks=peaks)
+			sidecar = {'EchoTime': 0.03, 'RepetitionTime': 2.0, 						# Sidecar
+					   'Manufacturer': params.get('vendor', 'Philips'),
+					   'MagneticFieldStrength': 3, 'SequenceName': 'PRESS'}
+			if params['runs'] > 1: 														# Pair Files of a Run
+				sidecar['IntendedFor'] = ['{}/mrs/{}'.format(ses, other) for other in names if other != name]
+			write_json('{}/{}'.format(mrsdir, name.replace('.nii.gz', '.json')), sidecar)
+
+	write_t1w('{}/{}_{}_T1w.nii.gz'.format(anat, sub, ses)) 							# T1w Image
+	write_json('{}/{}_{}_T1w.json'.format(anat, sub, ses), {'Modality': 'MR'})
+
+	acquired = np.datetime64('2020-01-01T09:00:00') + np.timedelta64(seed % 1500, 'D') 	# Session Date (Spread over about 4 Years)
+	with open('{}/{}/{}/{}_{}_scans.tsv'.format(bidsdir, sub, ses, sub, ses), 'w') as f: # BIDS Scans Table
+		f.write('filename\tacq_time\n')
+		for name in sorted(os.listdir(mrsdir)) + sorted(os.listdir(anat)): 				# Iterate over Images
+			if name.endswith('.nii.gz'):
+				f.write('{}/{}\t{}\n'.format('anat' if 'T1w' in name else 'mrs', name, acquired))
+
+def write_study(root, study, sessions, params, sessions_per_subject=1, bids=True, start=0): # Synthetic Study
+	'''
+	- 1. Description:
+		- Writes a synthetic study in the layout main.py expects:
+		    <root>/src (settings files), <root>/<study>/raw/sub-*/ses-* and,
+		    optionally, the converted <root>/<study>/bids/sub-*/ses-* tree.
+
+	- 2. Inputs:
+		- root     : (String) Root Directory (holds src and the study)
+		- study    : (String) Study name
+		- sessions : (Int   ) Number of sessions
+		- params   : (Dict  ) Session parameters (dicoms, runs, points, coils, averages)
+		- sessions_per_subject: (Int) Sessions of every subject
+		- bids     : (Bool  ) Also write the BIDS tree
+		- start    : (Int   ) Index of the first session (add sessions to a study)
+
+	- 3. Outputs:
+		- basedir  : (String) Study Directory
+	'''
+
+	basedir = '{}/{}'.format(root, study).replace('\\', '/') 							# Study Directory
+	srcdir  = '{}/src'.format(root) 													# Settings Directory
+	os.makedirs(srcdir, exist_ok=True)
+	for name in ['OSPREY_master_settings.json', 'EmailConfig.json']: 					# Settings used by osprey_job
+		shutil.copy('{}/src/{}'.format(repo, name), '{}/{}'.format(srcdir, name))
+
+	with open('{}/src/OSPREY_master_settings.json'.format(repo), 'r') as f: 			# run.py Settings (One Configuration)
+		master = json.loads(f.read())
+	write_json('{}/run_settings.json'.format(srcdir), {'unedited': master})
+
+	os.makedirs('{}/raw'.format(basedir), exist_ok=True)
+	os.makedirs('{}/bids/code/bidscoin'.format(basedir), exist_ok=True)
+	with open('{}/bids/code/bidscoin/bidsmap.yaml'.format(basedir), 'w') as f: 			# Bidsmap (Content Only Hashed)
+		f.write('Options:\n  bidscoin:\n    version: synthetic\n')
+
+	for index in range(start, start + sessions): 										# Iterate over Sessions
+		sub, ses = session_names(index, sessions_per_subject) 							# Session Labels
+		write_raw_session('{}/raw'.format(basedir), sub, ses, params)
+		if bids: 																		# Converted Data
+			write_bids_session('{}/bids'.format(basedir), sub, ses, params, seed=index)
+	return basedir
+
+if __name__ == '__main__':
+
+	parser = argparse.ArgumentParser(description='Write a synthetic raw/BIDS study for benchmarks')
+	parser.add_argument('root'                  , help='Root directory (holds src and the study)'  , type=str)
+	parser.add_argument('--study'               , help='Study name'                                , type=str, default='synthetic')
+	parser.add_argument('--sessions'            , help='Number of sessions'                        , type=int, default=10)
+	parser.add_argument('--sessions-per-subject', help='Sessions of every subject'                 , type=int, default=1)
+	parser.add_argument('--runs'                , help='MRS runs per session'                      , type=int, default=1)
+	parser.add_argument('--dicoms'              , help='Placeholder dicom files per session'       , type=int, default=6)
+	parser.add_argument('--points'              , help='Spectral points'                           , type=int, default=512)
+	parser.add_argument('--coils'               , help='Receive coils'                             , type=int, default=1)
+	parser.add_argument('--averages'            , help='Transients of the metabolite scans'        , type=int, default=4)
+	parser.add_argument('--drift'               , help='Frequency drift per average (Hz)'          , type=float, default=0.0)
+	parser.add_argument('--no-bids'             , help='Only write the raw tree'                   , action='store_true')
+	args   = parser.parse_args()
+
+	params = {'dicoms': args.dicoms, 'runs': args.runs, 'points': args.points,
+			  'coils' : args.coils, 'averages': args.averages, 'drift': args.drift}
+	basedir = write_study(os.path.abspath(args.root), args.study, args.sessions, params,
+						  args.sessions_per_subject, bids=args.no_bids == False)
+	print(basedir)
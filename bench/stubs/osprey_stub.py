@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+import time as t0 																		# Timer
+import zlib 																			# Dataset Seeds
+import argparse 																		# Input Argument Parser
+import json 																			# JSON Files
+import sys 																				# System Operations
+import os 																				# Operating System
+
+def run_job(jobfile, args): 															# Pretend to Run an Osprey Job
+	'''
+	- 1. Description:
+		- Stands in for OspreyCMD on machines without the Matlab Runtime. Reads
+		    an Osprey job file, sleeps args.fit seconds per dataset, and writes
+		    outputs in the layout of an Osprey output folder (one figure per
+		    dataset, a results and a quality metrics table with a row per
+		    dataset, and a log file).
+
+	- 2. Inputs:
+		- jobfile  : (String) Osprey Job File Path
+		- args     : (Object) Command line arguments (fit, fail, hang)
+
+	- 3. Outputs:
+		- exit_code: (Int   ) 0 = Success, 1 = Failed
+	'''
+
+	if args.hang and args.hang in jobfile: 												# Simulate a Stuck Job
+		while True:
+			t0.sleep(60)
+
+	try:
+		with open(jobfile, 'r') as f: 													# Read Job File
+			job = json.loads(f.read())
+		outdir = job['outputFolder'][0] 												# Output Folder
+		files  = job['files'] 															# Datasets
+	except (OSError, ValueError, KeyError, IndexError) as e: 							# Invalid Job File
+		print('osprey_stub: {}'.format(e), flush=True)
+		return 1
+
+	if args.fail and args.fail in jobfile: 												# Simulate a Failed Fit
+		return 1
+
+	os.makedirs('{}/SpecFigures'.format(outdir), exist_ok=True) 						# Figures Folder
+	os.makedirs('{}/QuantifyResults'.format(outdir), exist_ok=True) 					# Results Folder
+	rows = ['Subject\ttNAA\ttCr\ttCho'] 												# Results Table Header
+	qm   = ['Subject\tNAA_SNR\tNAA_FWHM\twater_FWHM'] 									# Quality Metrics Table Header
+	for filepath in files: 																# Iterate over Datasets
+		t0.sleep(args.fit) 																# Fit Time per Dataset
+		stem = os.path.basename(filepath).replace('.nii.gz', '').replace('.nii', '') 	# Dataset Name
+		with open('{}/SpecFigures/{}_fit.txt'.format(outdir, stem), 'w') as f: 			# Dataset Figure
+			f.write(stem)
+		seed = zlib.crc32(stem.encode()) 												# Dataset Seed (Same Values on Reruns)
+		vary = lambda scale: scale * ((seed >> (8 * len(qm))) % 1000 / 1000 - 0.5) 		# Spread around the Mean
+		rows.append('{}\t{:.3f}\t1.000\t{:.3f}'.format(stem, 1.4 + vary(0.2), 0.25 + vary(0.05))) # Dataset Row
+		qm.append('{}\t{:.1f}\t{:.2f}\t{:.2f}'.format(stem, 120 + vary(40), 5.5 + vary(1.0), 6.5 + vary(1.0))) # Quality Metrics Row
+
+	with open('{}/QuantifyResults/A_tCr_Voxel_1.tsv'.format(outdir), 'w') as f: 		# Results Table
+		f.write('\n'.join(rows) + '\n')
+	with open('{}/QM_processed_spectra.tsv'.format(outdir), 'w') as f: 					# Quality Metrics Table
+		f.write('\n'.join(qm) + '\n')
+	with open('{}/LogFile.txt'.format(outdir), 'a') as f: 								# Osprey Log
+		f.write('{} dataset(s) from {}\n'.format(len(files), jobfile))
+	return 0
+
+if __name__ == '__main__':
+
+	parser = argparse.ArgumentParser(description='Stub for OspreyCMD (one-shot or long-lived worker)')
+	parser.add_argument('jobfile'    , help='Osprey job file (one-shot mode)'                 , nargs='?')
+	parser.add_argument('--worker'   , help='Read job files from stdin, answer DONE <code>'   , action='store_true')
+	parser.add_argument('--startup'  , help='Seconds to start (Matlab Runtime initialization)', type=float, default=5)
+	parser.add_argument('--fit'      , help='Seconds per dataset'                             , type=float, default=1)
+	parser.add_argument('--fail'     , help='Fail job files whose path contains this string'  , type=str)
+	parser.add_argument('--hang'     , help='Never finish job files whose path contains this' , type=str)
+	args   = parser.parse_args()
+
+	t0.sleep(args.startup) 																# Matlab Runtime Initialization
+
+	if args.worker == False: 															# One-Shot Mode (like OspreyCMD)
+		sys.exit(run_job(args.jobfile, args))
+
+	for line in sys.stdin: 																# Long-Lived Worker - One Job per Line
+		jobfile = line.strip() 															# Job File Path
+		if jobfile == '': 																# Empty Line
+			continue
+		print('DONE {}'.format(run_job(jobfile, args)), flush=True) 					# Reply with Exit Code
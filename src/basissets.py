@@ -0,0 +1,289 @@
+import argparse 																		# Input Argument Parser
+import json 																			# JSON Files
+import re 																				# Namelist Parsing
+import os 																				# Operating System
+
+import numpy as np 																		# Basis Arrays
+
+extensions = {'.basis': 'basis', '.mat': 'mat', '.control': 'control'} 					# Basis Set Files (Lowercase Extension -> Kind)
+editings   = ['unedited', 'mega', 'hermes', 'hercules'] 								# Editing Schemes (Folder Names)
+sequences  = ['press', 'slaser', 'special', 'steam'] 									# Localisations (Folder Names)
+aliases    = {'semilaser': 'slaser', 'svs se': 'press', 'svs st': 'steam', 				# Vendor Sequence Names (i.e. Siemens svs_se, GE PROBE-P)
+			  'probep': 'press', 'probes': 'steam'}
+gyromagnetic = 42.577478518 															# 1H (MHz/T)
+namelist   = re.compile(r"(\w+)\s*=\s*('[^']*'|[^,\n]*)") 								# Namelist Entry (NAME = value)
+
+def parse_key(relpath): 																# Lookup Key of a Basis Set Folder
+	'''
+	- 1. Description:
+		- Reads the lookup key of a basis set folder from its path in the
+		    basis set tree (field/vendor/editing/localisation/TE, i.e.
+		    3T/philips/unedited/press/35 or 3T/siemens/unedited/special/8_5).
+		    A last folder with letters (i.e. mega/press/gaba68) is kept as the
+		    variant, with its digits as TE.
+
+	- 2. Inputs:
+		- relpath  : (String) Folder relative to the basis set tree
+
+	- 3. Outputs:
+		- key      : (Dict  ) b0 (Tesla), vendor, editing, localisation, te
+							    (ms), variant (None if not in the path)
+	'''
+
+	parts = relpath.replace('\\', '/').strip('/').split('/') 							# Folder Names
+	key   = {'b0': None, 'vendor': None, 'editing': None, 'localisation': None, 'te': None, 'variant': None}
+	if len(parts) > 0 and re.fullmatch(r'\d+(\.\d+)?T', parts[0], re.I): 				# Field Strength
+		key['b0'] = float(parts[0][:-1])
+	for name, part in zip(['vendor', 'editing', 'localisation'], parts[1:4]): 			# Vendor, Editing, Localisation
+		key[name] = part.lower()
+	if len(parts) > 4: 																	# TE or Variant
+		digits = re.fullmatch(r'([a-z]*)(\d+(?:_\d+)?)', parts[4].lower()) 				# i.e. 35, 8_5, gaba68
+		if digits is not None:
+			key['te'] = float(digits.group(2).replace('_', '.'))
+		if digits is None or digits.group(1) != '': 									# Named Variant
+			key['variant'] = parts[4].lower() if digits is None else digits.group(1)
+	return key
+
+def sidecar_key(sidecar): 																# Lookup Key of a NIfTI-MRS Session
+	'''
+	- 1. Description:
+		- Reads the lookup key of a session from the JSON sidecar (or NIfTI-MRS
+		    header extension) of its MRS data: MagneticFieldStrength (or
+		    SpectrometerFrequency), Manufacturer, EchoTime (seconds) and the
+		    sequence name (SequenceName, PulseSequenceType or ProtocolName;
+		    vendor names such as svs_se or PROBE-P are understood).
+		    Editing is read from the sequence name (MEGA, HERMES, HERCULES) or
+		    an EditPulse entry, otherwise unedited.
+
+	- 2. Inputs:
+		- sidecar  : (Dict  ) Sidecar content
+
+	- 3. Outputs:
+		- key      : (Dict  ) b0, vendor, editing, localisation and te (ms);
+							    None where the sidecar does not tell
+	'''
+
+	b0       = sidecar.get('MagneticFieldStrength') 									# Field Strength (Tesla)
+	if b0 is None and sidecar.get('SpectrometerFrequency') is not None: 				# From Larmor Frequency (MHz)
+		freq = sidecar['SpectrometerFrequency']
+		b0   = (freq[0] if isinstance(freq, list) else freq) / gyromagnetic
+	vendor   = str(sidecar.get('Manufacturer') or '').lower().split() 					# i.e. Philips Medical Systems -> philips
+	sequence = ' '.join(str(sidecar.get(name) or '') for name in ['SequenceName', 'PulseSequenceType', 'ProtocolName']).lower()
+	sequence = sequence.replace('-', '').replace('_', ' ') 								# i.e. semi-LASER -> semilaser
+
+	editing  = next((name for name in editings[1:] if name in sequence), None) 			# Edited Sequence
+	if editing is None:
+		editing = 'mega' if 'EditPulse' in sidecar else 'unedited'
+	localisation = next((aliases[name] for name in aliases if name in sequence), None) 	# Vendor Sequence Name
+	if localisation is None:
+		localisation = next((name for name in sequences if name in sequence), None) 	# Localisation
+	te       = sidecar.get('EchoTime') 													# Echo Time (Seconds)
+	return {'b0'          : None if b0 is None else round(float(b0) * 2) / 2, 			# Nearest 0.5 T
+			'vendor'      : vendor[0] if len(vendor) > 0 else None,
+			'editing'     : editing,
+			'localisation': localisation,
+			'te'          : None if te is None else float(te) * 1000}
+
+def parse_basis(path): 																	# Parse an LCModel .BASIS File
+	'''
+	- 1. Description:
+		- Parses an LCModel .BASIS text file: the $SEQPAR and $BASIS1 header
+		    (field, echo time, dwell time, points) and every $BASIS block with
+		    the metabolite name and its FID (NDATAB complex points).
+
+	- 2. Inputs:
+		- path     : (String) .BASIS file path
+
+	- 3. Outputs:
+		- header   : (Dict  ) hzpppm, te, dwell, points, fwhmba, seq, id
+		- names    : (List  ) Metabolite names (METABO)
+		- fids     : (Array ) Complex FIDs (metabolites x points)
+	'''
+
+	with open(path, 'r', errors='replace') as f:
+		text = f.read()
+
+	blocks = re.split(r'^\s*\$(\w+)', text, flags=re.M) 								# Text, Name, Body, Name, Body...
+	params = {} 																		# Header Namelists
+	names  = [] 																		# Metabolite Names
+	fids   = [] 																		# Metabolite FIDs
+	points = None 																		# Complex Points per FID
+	for name, body in zip(blocks[1::2], blocks[2::2]): 									# Iterate over Namelists
+		name   = name.upper()
+		if name == 'END': 																# Data after a Namelist
+			if len(names) > len(fids): 													# FID of Last Metabolite
+				values = np.array(body.replace('D', 'E').replace('d', 'e').split(), dtype=float) # Real, Imaginary, ...
+				if values.size < 2 * points: 											# Truncated FID
+					raise ValueError('{}: {} has {} of {} values'.format(path, names[-1], values.size, 2 * points))
+				fids.append(values[:2 * points:2] + 1j * values[1:2 * points:2])
+			continue
+		entries = {key.upper(): value.strip().strip("'").strip() for key, value in namelist.findall(body)} # Namelist Entries
+		if name == 'BASIS': 															# Metabolite
+			names.append(entries.get('METABO') or entries.get('ID'))
+		else: 																			# Header (SEQPAR, BASIS1, NMUSED)
+			params.update(entries)
+			if 'NDATAB' in entries:
+				points = int(entries['NDATAB'])
+
+	if points is None or len(fids) == 0: 												# Not a Basis File
+		raise ValueError('{}: no $BASIS1 header or metabolites'.format(path))
+	number = lambda key: float(params[key]) if key in params else None 					# Numeric Header Entry
+	header = {'hzpppm': number('HZPPPM'), 'te': number('ECHOT'), 'dwell': number('BADELT'),
+			  'points': points, 'fwhmba': number('FWHMBA'), 'seq': params.get('SEQ'), 'id': params.get('IDBASI')}
+	return header, names[:len(fids)], np.array(fids, dtype=np.complex64)
+
+class BasisRegistry(): 																	# Indexed Basis Set Tree
+	'''
+	- 1. Description:
+		- Indexes a basis set tree (osprey/basissets: field/vendor/editing/
+		    localisation/TE folders with .BASIS, .mat and .control files), so
+		    the basis set of a session can be selected from its sidecar (see
+		    select). The index is kept in index.json of the cache directory
+		    and only rebuilt when a folder of the tree changed.
+		- LCModel .BASIS files are parsed once into a NumPy cache (one .npy
+		    of complex FIDs and one .json header per file), and later loads
+		    memory-map the .npy instead of parsing the text again (see load).
+		    A cached file is parsed again when its size or modification time
+		    changed. Osprey .mat basis sets are indexed but not loaded.
+
+	- 2. Inputs:
+		- root     : (String) Basis set tree (i.e. osprey/basissets)
+		- cache    : (String) Cache directory (default root/.cache)
+	'''
+
+	def __init__(self, root, cache=None):
+
+		self.root    = os.path.abspath(root) 											# Basis Set Tree
+		self.cache   = cache or os.path.join(self.root, '.cache') 						# Index and Parsed Files
+		self.entries = [] 																# Basis Set Folders
+		self.update()
+
+	def folders(self): 																	# Folders of the Tree and their Modification Times
+		found = {}
+		for path, dirs, files in os.walk(self.root): 									# Walk Tree
+			dirs[:] = sorted(d for d in dirs if d.startswith('.') == False) 			# Skip Hidden (i.e. Cache)
+			found[os.path.relpath(path, self.root)] = os.stat(path).st_mtime_ns
+		return found
+
+	def update(self): 																	# Bring Index up to Date
+		indexfile = os.path.join(self.cache, 'index.json') 								# Stored Index
+		folders   = self.folders()
+		try:
+			with open(indexfile, 'r') as f:
+				index = json.loads(f.read())
+			if index['folders'] == folders: 											# Tree Unchanged
+				self.entries = index['entries']
+				return
+		except (OSError, ValueError, KeyError): 										# No Index
+			pass
+
+		self.entries = [] 																# Basis Set Folders
+		for relpath in sorted(folders): 												# Iterate over Folders
+			files = {} 																	# Kind -> File
+			for filename in sorted(os.listdir(os.path.join(self.root, relpath))): 		# Iterate over Files
+				kind = extensions.get(os.path.splitext(filename)[1].lower())
+				if kind is not None and kind not in files: 								# First File of its Kind
+					files[kind] = os.path.normpath(os.path.join(relpath, filename))
+			if len(files) > 0: 															# Folder Holds a Basis Set
+				self.entries.append(dict(parse_key(relpath), folder=os.path.normpath(relpath), **files))
+
+		os.makedirs(self.cache, exist_ok=True)
+		tmpfile = '{}.{}.tmp'.format(indexfile, os.getpid()) 							# Write to Temporary File First (Workers Share the Cache)
+		with open(tmpfile, 'w') as f:
+			f.write(json.dumps({'folders': folders, 'entries': self.entries}))
+		os.replace(tmpfile, indexfile) 													# Replace Index in one Step
+
+	def select(self, sidecar, kind=None, te_tolerance=5.0): 							# Basis Set for a Session
+		'''
+		- 1. Description:
+			- Selects the basis set of a session from the sidecar of its MRS
+			    data. Field strength, editing and localisation must match. A
+			    basis set of the same vendor is preferred, then the closest
+			    echo time (within te_tolerance ms).
+
+		- 2. Inputs:
+			- sidecar  : (Dict  ) Sidecar content (see sidecar_key)
+			- kind     : (String) Only folders with this file (basis, mat, control)
+			- te_tolerance: (Float) Largest echo time difference (ms)
+
+		- 3. Outputs:
+			- entry    : (Dict  ) Index entry (key, folder and files relative to
+								    root), or None if no basis set fits
+		'''
+
+		want  = sidecar_key(sidecar) 													# Session Key
+		found = [] 																		# Candidates (Score, Entry)
+		for entry in self.entries: 														# Iterate over Basis Sets
+			if kind is not None and kind not in entry: 									# File Kind Missing
+				continue
+			if any(want[name] is None or entry[name] != want[name] for name in ['b0', 'editing', 'localisation']): # Must Match
+				continue
+			te_diff = abs(entry['te'] - want['te']) if entry['te'] is not None and want['te'] is not None else 0.0
+			if te_diff > te_tolerance: 													# Echo Time too Far
+				continue
+			found.append(((entry['vendor'] != want['vendor'], te_diff, entry['folder']), entry))
+		return min(found, key=lambda item: item[0])[1] if len(found) > 0 else None
+
+	def path(self, entry, kind): 														# Absolute Path of a File of an Entry
+		return os.path.join(self.root, entry[kind]) if entry is not None and kind in entry else None
+
+	def load(self, path): 																# Load an LCModel .BASIS File (Cached)
+		'''
+		- 1. Description:
+			- Returns the header, metabolite names and FIDs of a .BASIS file.
+			    The first load parses the text and writes the cache; later
+			    loads read the header and memory-map the FIDs (read-only).
+
+		- 2. Inputs:
+			- path     : (String) .BASIS file (absolute, or relative to root)
+
+		- 3. Outputs:
+			- header   : (Dict  ) hzpppm, te, dwell, points, fwhmba, seq, id
+			- names    : (List  ) Metabolite names
+			- fids     : (Array ) Complex FIDs (metabolites x points, memory-mapped)
+		'''
+
+		path     = os.path.join(self.root, path) 										# Absolute Path (Unchanged if Absolute)
+		stat     = os.stat(path)
+		stem     = os.path.join(self.cache, os.path.relpath(path, self.root).replace(os.sep, '__')) # Cache Files
+		source   = [stat.st_size, stat.st_mtime_ns] 									# Cached File Version
+		try:
+			with open('{}.json'.format(stem), 'r') as f: 								# Cached Header
+				cached = json.loads(f.read())
+			if cached['source'] == source: 												# Cache Current
+				return cached['header'], cached['names'], np.load('{}.npy'.format(stem), mmap_mode='r')
+		except (OSError, ValueError, KeyError): 										# Not Cached
+			pass
+
+		header, names, fids = parse_basis(path) 										# Parse Text
+		os.makedirs(self.cache, exist_ok=True)
+		tmpstem  = '{}.{}.tmp'.format(stem, os.getpid()) 								# Write to Temporary Files First (Workers Share the Cache)
+		np.save('{}.npy'.format(tmpstem), fids)
+		os.replace('{}.npy'.format(tmpstem), '{}.npy'.format(stem)) 					# FIDs before Header (Header Marks Cache Current)
+		with open('{}.json'.format(tmpstem), 'w') as f:
+			f.write(json.dumps({'source': source, 'header': header, 'names': names}))
+		os.replace('{}.json'.format(tmpstem), '{}.json'.format(stem))
+		return header, names, np.load('{}.npy'.format(stem), mmap_mode='r')
+
+if __name__ == '__main__':
+
+	parser = argparse.ArgumentParser(description='Index a basis set tree, select a basis set for a sidecar, and cache parsed .BASIS files')
+	parser.add_argument('root'           , help='Basis set tree (i.e. osprey/basissets)'   , type=str)
+	parser.add_argument('--cache'        , help='Cache directory (default root/.cache)'     , type=str)
+	parser.add_argument('--select'       , help='Select the basis set for a JSON sidecar'  , type=str)
+	parser.add_argument('--warm'         , help='Parse every .BASIS file into the cache'    , action='store_true')
+	args   = parser.parse_args()
+
+	registry = BasisRegistry(args.root, args.cache)
+	if args.select is not None: 														# Select for a Sidecar
+		with open(args.select, 'r') as f:
+			entry = registry.select(json.loads(f.read()))
+		print(json.dumps(entry, indent=4))
+	else: 																				# List Index
+		for entry in registry.entries:
+			print('{b0:>4}T {vendor:<8} {editing:<9} {localisation:<8} TE {te!s:<5} {folder}'.format(**entry))
+	if args.warm: 																		# Fill Cache
+		for entry in registry.entries:
+			if 'basis' in entry:
+				header, names, fids = registry.load(entry['basis'])
+				print('{}: {} metabolite(s) x {} point(s)'.format(entry['basis'], *fids.shape))
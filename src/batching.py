@@ -0,0 +1,160 @@
+from datetime import datetime 															# Date and Time
+import hashlib 																			# Template Hashing
+import shutil 																			# Move Files
+import json 																			# JSON Files
+import uuid 																			# Unique Batch Names
+import os 																				# Operating System
+
+filekeys = ['files', 'files_ref', 'files_w', 'files_nii', 'files_seg'] 					# Per-Dataset Job Keys (One Entry per Dataset)
+rawkeys  = ['files_raw', 'files_ref_raw'] 												# Original Data of Preprocessed Jobs (see main.osprey_prep)
+sesskeys = filekeys + rawkeys + ['outputFolder'] 										# Per-Session Job Keys
+
+def load_job(jobfile): 																	# Read an Osprey Job File
+	with open(jobfile, 'r') as f: 														# Read Job File
+		return json.loads(f.read())
+
+def job_key(jobfile): 																	# Settings Template of a Job File
+	'''
+	- 1. Description:
+		- Hash of the settings of an Osprey job file without its data files and
+		    output folder. Job files with the same key were created from the
+		    same settings template and can be run as a single Osprey job.
+
+	- 2. Inputs:
+		- jobfile  : (String) Osprey Job File Path
+
+	- 3. Outputs:
+		- key      : (String) SHA-256 of the job settings
+	'''
+
+	job = load_job(jobfile) 															# Osprey Job
+	job = {key: value for key, value in job.items() if key not in sesskeys} 			# Settings Only
+	return hashlib.sha256(json.dumps(job, sort_keys=True).encode()).hexdigest()
+
+def dataset_stem(filepath): 															# Dataset Name from a Data File
+	name = os.path.basename(filepath.rstrip('/')) 										# File Name
+	for ext in ['.nii.gz', '.nii', '.json']: 											# Known Extensions
+		if name.endswith(ext): 															# Strip Extension
+			return name[:-len(ext)]
+	return os.path.splitext(name)[0]
+
+def merge_jobs(jobfiles, batchdir): 													# Combine Job Files into One
+	'''
+	- 1. Description:
+		- Combines the Osprey job files of several sessions into a single job
+		    file with multi-entry files/files_ref/files_w/files_nii/files_seg
+		    lists and writes it into the batch directory, which is used as the
+		    output folder of the combined job.
+
+		  Note: Osprey expects every data list to have one entry per dataset.
+		    A session with a single entry for several datasets (i.e. one T1w
+		    in files_nii for all runs) has that entry repeated for each of
+		    its datasets. Job files are only combined if they share the same
+		    settings and every session provides the same data lists, with one
+		    entry or one entry per dataset (otherwise a ValueError is raised).
+
+	- 2. Inputs:
+		- jobfiles : (List  ) Osprey Job File Paths (one per session)
+		- batchdir : (String) Batch Directory (Output Folder of the combined job)
+
+	- 3. Outputs:
+		- jobfile  : (String) Combined Osprey Job File Path
+		- owners   : (List  ) Index of the session (job file) of every dataset
+		- stems    : (List  ) Dataset names (data file names without extension)
+	'''
+
+	jobs   = [load_job(jobfile) for jobfile in jobfiles] 								# Osprey Jobs
+	keys   = set(job_key(jobfile) for jobfile in jobfiles) 								# Settings Templates
+	if len(keys) != 1: 																	# Different Settings
+		raise ValueError('job files use different settings')
+
+	merged = {key: value for key, value in jobs[0].items() if key not in sesskeys} 		# Shared Settings
+	owners = [] 																		# Session of every Dataset
+	stems  = [] 																		# Dataset Names
+	for ii, job in enumerate(jobs): 													# Iterate over Sessions
+		ndata = len(job.get('files', [])) 												# Number of Datasets
+		for key in filekeys: 															# Iterate over Data Lists
+			if (key in job) != (key in jobs[0]): 										# Data List Missing in some Sessions
+				raise ValueError('{} is not given for every session'.format(key))
+			if key not in job: 															# Data List not Used
+				continue
+			entries = job[key] if len(job[key]) != 1 else job[key] * ndata 				# One Entry Shared by all Datasets (i.e. T1w)
+			if len(entries) != ndata: 													# Not One Entry per Dataset
+				raise ValueError('{} does not match files in {}'.format(key, jobfiles[ii]))
+			merged.setdefault(key, []).extend(entries) 									# Add Session Datasets
+
+		owners.extend([ii] * ndata) 													# Datasets belong to this Session
+		stems.extend([dataset_stem(filepath) for filepath in job.get('files', [])]) 	# Dataset Names
+
+	os.makedirs(batchdir) 																# Create Batch Directory (Never Reuse a Batch)
+	merged['outputFolder'] = [batchdir] 												# Batch Output Folder
+	jobfile = '{}/batch_osprey_job.json'.format(batchdir) 								# Combined Job File
+	with open(jobfile, 'w') as f: 														# Write Combined Job
+		f.write(json.dumps(merged, indent = 4))
+	return jobfile, owners, stems
+
+def batch_dir(basedir): 																# New Batch Directory
+	batchid = 'batch-{}-{}'.format(datetime.now().strftime('%Y%m%d%H%M%S'), uuid.uuid4().hex[:12]) # Unique Batch Name (Same Second, Same Worker)
+	return '{}/bids/derivatives/batches/{}'.format(basedir, batchid)
+
+def split_derivatives(batchdir, owners, stems, outdirs): 								# Return Batch Outputs to Sessions
+	'''
+	- 1. Description:
+		- Splits the outputs of a combined Osprey job back into the per-session
+		    derivatives directories (bids/derivatives/sub-*/ses-*):
+		      - files (or folders) named after a dataset are moved to the
+		          session of that dataset, keeping their relative path.
+		      - tables (.tsv/.csv) with one row per dataset are split by row,
+		          so every session receives the header and its own rows.
+		      - everything else (logs, combined .mat files) stays in the batch
+		          directory. Every session receives a batch.json naming the
+		          batch directory, its datasets, and the shared files.
+
+	- 2. Inputs:
+		- batchdir : (String) Batch Directory (Output Folder of the combined job)
+		- owners   : (List  ) Index of the session (output directory) of every dataset
+		- stems    : (List  ) Dataset names
+		- outdirs  : (List  ) Output Directory of every session
+
+	- 3. Outputs:
+		- shared   : (List  ) Files left in the batch directory
+	'''
+
+	order  = sorted(range(len(stems)), key=lambda ii: len(stems[ii]), reverse=True) 	# Longest Names First (run-1 vs run-10)
+	shared = [] 																		# Files Kept in Batch Directory
+
+	for root, dirs, files in os.walk(batchdir): 										# Walk Batch Outputs
+		for filename in files: 															# Iterate over Files
+			filepath = os.path.join(root, filename) 									# Full Path
+			relpath  = os.path.relpath(filepath, batchdir).replace('\\', '/') 			# Relative Path
+			if relpath == 'batch_osprey_job.json': 										# Combined Job File
+				continue
+
+			match    = next((ii for ii in order if stems[ii] in relpath), None) 		# Dataset Named in Path
+			if match is not None: 														# Dataset Output
+				outfile = '{}/{}'.format(outdirs[owners[match]], relpath) 				# Session Output
+				os.makedirs(os.path.dirname(outfile), exist_ok=True) 					# Create Output Directory
+				shutil.move(filepath, outfile) 											# Move to Session
+				continue
+
+			if filename.endswith(('.tsv', '.csv')): 									# Table
+				with open(filepath, 'r') as f: 											# Read Table
+					lines = f.read().splitlines() 										# Header and Rows
+				if len(lines) == len(stems) + 1: 										# One Row per Dataset
+					for jj, outdir in enumerate(outdirs): 								# Iterate over Sessions
+						rows    = [lines[ii + 1] for ii in range(len(stems)) if owners[ii] == jj] # Rows of Session
+						outfile = '{}/{}'.format(outdir, relpath) 						# Session Output
+						os.makedirs(os.path.dirname(outfile), exist_ok=True) 			# Create Output Directory
+						with open(outfile, 'w') as f: 									# Write Session Table
+							f.write('\n'.join([lines[0]] + rows) + '\n')
+					continue
+
+			shared.append(relpath) 														# Batch-Wide Output
+
+	for jj, outdir in enumerate(outdirs): 												# Iterate over Sessions
+		os.makedirs(outdir, exist_ok=True) 												# Create Output Directory
+		with open('{}/batch.json'.format(outdir), 'w') as f: 							# Note Batch of Session
+			f.write(json.dumps({'batch'   : batchdir, 									# Batch Directory
+								'datasets': [stems[ii] for ii in range(len(stems)) if owners[ii] == jj],
+								'shared'  : shared}, indent = 4)) 						# Files Kept in Batch Directory
+	return shared
@@ -0,0 +1,306 @@
+import fnmatch 																			# File Name Patterns
+import sqlite3 																			# Index Database
+import time as t0 																		# Timer
+import json 																			# JSON Files
+import os 																				# Operating System
+
+def parse_name(filename): 																# BIDS Entities of a File Name
+	'''
+	- 1. Description:
+		- Splits a BIDS file name (i.e. sub-01_ses-01_run-1_svs.nii.gz) into its
+		    entities (sub, ses, run, ...), suffix (svs) and extension (.nii.gz).
+
+	- 2. Inputs:
+		- filename : (String) File name without directory
+
+	- 3. Outputs:
+		- entities : (Dict  ) Entity keys and values
+		- suffix   : (String) Suffix (None if the name has none)
+		- extension: (String) Extension including the leading dot
+	'''
+
+	extension = '.nii.gz' if filename.endswith('.nii.gz') else os.path.splitext(filename)[1] # Double Extension of Gzipped NIfTI
+	stem      = filename[:len(filename) - len(extension)] 								# Name without Extension
+	entities  = {} 																		# Entities
+	suffix    = None 																	# Suffix
+	for part in stem.split('_'): 														# Iterate over Name Parts
+		if '-' in part: 																# Key-Value Entity
+			key, value     = part.split('-', 1)
+			entities[key]  = value
+		else: 																			# Suffix (Last Part without Dash)
+			suffix = part
+	return entities, suffix, extension
+
+class BidsIndex(): 																		# Persistent BIDS Metadata Index
+	'''
+	- 1. Description:
+		- Indexes the sub-*/[ses-*/]<datatype>/ files of a BIDS directory in a
+		    SQLite database (.bids_index.db in the BIDS directory). Every file is
+		    recorded with its subject, session, datatype, entities, suffix and
+		    extension, and JSON sidecars with their parsed content, so inputs
+		    can be found and sidecar fields read without globbing the tree.
+
+		  The index is updated incrementally: the modification time of every
+		    subject, session and datatype directory is kept, and a directory is
+		    only listed again when its modification time changed (a file added
+		    or removed changes the modification time of its directory). Files of
+		    a listed directory are only parsed again if their size or
+		    modification time changed.
+
+		  Note: Sessionless subjects (sub-01/anat) are recorded with an empty
+		    session (''). Hidden files are not indexed. Editing a sidecar in
+		    place does not change the modification time of its directory, so
+		    sidecar() checks the size and modification time of the .json file
+		    itself and reads it again if either changed.
+
+	- 2. Inputs:
+		- bidsdir  : (String) BIDS Directory holding the sub-* directories.
+		- dbfile   : (String) Index Database Path (default to bids/.bids_index.db)
+		- slack    : (Float ) Seconds of modification time precision.
+	'''
+
+	def __init__(self, bidsdir, dbfile=None, slack=2):
+
+		self.bidsdir  = bidsdir.replace('\\', '/').rstrip('/') 							# BIDS Directory
+		self.dbfile   = dbfile if dbfile else '{}/.bids_index.db'.format(self.bidsdir) 	# Index Database Path
+		self.slack    = slack 															# Modification Time Precision
+		self.stats    = {} 																# Last Update Statistics
+		self.db       = sqlite3.connect(self.dbfile, timeout=60) 						# Open Index
+		self.db.execute('PRAGMA synchronous = OFF') 									# No fsync (Index can be Rebuilt from the Tree)
+		self.db.execute('''CREATE TABLE IF NOT EXISTS dirs (
+							Path      TEXT PRIMARY KEY,
+							Subject   TEXT,
+							Mtime     REAL,
+							Listed    REAL,
+							Dirs      TEXT,
+							Files     TEXT)''') 										# Directory Table
+		self.db.execute('''CREATE TABLE IF NOT EXISTS files (
+							Path      TEXT PRIMARY KEY,
+							Directory TEXT,
+							Subject   TEXT,
+							Session   TEXT,
+							Datatype  TEXT,
+							Suffix    TEXT,
+							Extension TEXT,
+							Entities  TEXT,
+							Sidecar   TEXT,
+							Mtime     REAL,
+							Size      INTEGER)''') 										# File Table
+		self.db.execute('CREATE INDEX IF NOT EXISTS files_session ON files (Subject, Session)') # Session Lookups
+		self.db.commit()
+
+	def close(self): 																	# Close Index
+		self.db.close()
+
+	def update(self, subjects=None, force=False): 										# Bring Index up to Date
+		'''
+		- 1. Description:
+			- Walks the subject directories and lists every directory whose
+			    modification time changed since it was last listed. Statistics
+			    of the update (seconds, directories listed, files parsed) are
+			    kept in self.stats.
+
+		- 2. Inputs:
+			- subjects : (List  ) Only update these subjects (None = whole tree)
+			- force    : (Bool  ) List every directory again
+		'''
+
+		start    = t0.time() 															# Update Start
+		self.stats = {'listed': 0, 'parsed': 0} 										# Update Statistics
+
+		if subjects is None: 															# Whole Tree - List BIDS Directory
+			dirs, files = self.listdir('') 												# Subject Directories
+			self.db.execute('INSERT OR REPLACE INTO dirs VALUES (?,?,?,?,?,?)', 		# BIDS Directory Listing
+							('', '', os.stat(self.bidsdir).st_mtime, t0.time(), json.dumps(dirs), json.dumps(files)))
+			subjects = [name for name in dirs if name.startswith('sub-')]
+			rows     = self.db.execute('SELECT Path, Subject, Mtime, Listed, Dirs, Files FROM dirs').fetchall()
+		else: 																			# Selected Subjects
+			rows     = self.db.execute('SELECT Path, Subject, Mtime, Listed, Dirs, Files FROM dirs WHERE Subject IN ({})'.format(
+										','.join('?' * len(subjects))), list(subjects)).fetchall()
+
+		cached   = {row[0]: row for row in rows} 										# Directories Listed Before
+		alive    = set() 																# Directories Found Now
+		for subject in subjects: 														# Iterate over Subjects
+			self.walk(subject, subject, None, cached, alive, force)
+
+		removed  = [path for path, row in cached.items() if row[1] != '' and path not in alive] # Directories Removed
+		self.db.executemany('DELETE FROM dirs WHERE Path = ?', [(path,) for path in removed])
+		self.db.executemany('DELETE FROM files WHERE Directory = ?', [(path,) for path in removed])
+		self.db.commit()
+		self.stats['seconds'] = t0.time() - start 										# Update Time
+
+	def listdir(self, relpath): 														# List a Directory and Record it
+		dirs, files = [], [] 															# Sub-Directories and Files
+		with os.scandir('{}/{}'.format(self.bidsdir, relpath).rstrip('/')) as entries: 	# List Directory
+			for entry in entries: 														# Iterate over Entries
+				if entry.name.startswith('.'): 											# Hidden (i.e. the Index Itself)
+					continue
+				(dirs if entry.is_dir() else files).append(entry.name)
+		return sorted(dirs), sorted(files)
+
+	def walk(self, relpath, subject, session, cached, alive, force): 					# Update one Directory (Recursive)
+		'''
+		- 1. Description:
+			- Updates one subject (session None), session, or datatype directory
+			    and the directories below it. Datatype directories are the ones
+			    whose files are indexed.
+
+		- 2. Inputs:
+			- relpath  : (String) Directory relative to the BIDS directory
+			- subject  : (String) Subject of the directory
+			- session  : (String) Session ('' for sessionless datatype directories)
+			- cached   : (Dict  ) Directory rows from the index
+			- alive    : (Set   ) Directories found during this update
+			- force    : (Bool  ) List the directory again
+		'''
+
+		try:
+			mtime = os.stat('{}/{}'.format(self.bidsdir, relpath)).st_mtime 			# Directory Modification Time
+		except (FileNotFoundError, NotADirectoryError): 								# Directory Removed
+			return
+		alive.add(relpath)
+
+		depth = relpath.count('/') 														# 0 Subject, 1 Session or Datatype, 2 Datatype
+		datatype = depth == 2 or (depth == 1 and session == '') 						# Holds Data Files
+		prior = cached.get(relpath) 													# Previous Listing
+		if force == False and prior is not None and prior[2] == mtime and mtime < prior[3] - self.slack: # Unchanged
+			dirs, files = json.loads(prior[4]), json.loads(prior[5])
+		else: 																			# New or Changed - List Again
+			dirs, files = self.listdir(relpath)
+			self.stats['listed'] += 1
+			self.db.execute('INSERT OR REPLACE INTO dirs VALUES (?,?,?,?,?,?)',
+							(relpath, subject, mtime, t0.time(), json.dumps(dirs), json.dumps(files)))
+			if datatype: 																# Index Data Files
+				self.index_files(relpath, subject, session, files, force)
+
+		if datatype: 																	# No Deeper Levels
+			return
+		for name in dirs: 																# Iterate over Sub-Directories
+			if session is None and name.startswith('ses-'): 							# Session Directory
+				self.walk('{}/{}'.format(relpath, name), subject, name, cached, alive, force)
+			elif session is None: 														# Sessionless Datatype Directory
+				self.walk('{}/{}'.format(relpath, name), subject, '', cached, alive, force)
+			else: 																		# Datatype Directory of a Session
+				self.walk('{}/{}'.format(relpath, name), subject, session, cached, alive, force)
+
+	def index_files(self, relpath, subject, session, files, force): 					# Record the Files of a Datatype Directory
+		known    = {row[0]: row[1:] for row in self.db.execute( 						# Files Recorded Before
+					'SELECT Path, Mtime, Size FROM files WHERE Directory = ?', (relpath,))}
+		current  = set() 																# Files Found Now
+		datatype = relpath.split('/')[-1] 												# Datatype (anat, mrs, ...)
+		for filename in files: 															# Iterate over Files
+			filepath = '{}/{}'.format(relpath, filename) 								# Relative File Path
+			current.add(filepath)
+			try:
+				stat = os.stat('{}/{}'.format(self.bidsdir, filepath)) 					# File Information
+			except FileNotFoundError: 													# Removed while Indexing
+				continue
+			if force == False and known.get(filepath) == (stat.st_mtime, stat.st_size): # Unchanged
+				continue
+
+			entities, suffix, extension = parse_name(filename) 							# BIDS Entities
+			sidecar  = None 															# Parsed Sidecar
+			if extension == '.json': 													# Sidecar
+				try:
+					with open('{}/{}'.format(self.bidsdir, filepath), 'r') as f: 		# Read Sidecar
+						sidecar = f.read()
+					json.loads(sidecar) 												# Only Keep Valid JSON
+				except (OSError, ValueError): 											# Unreadable or Incomplete
+					sidecar = None
+			self.db.execute('INSERT OR REPLACE INTO files VALUES (?,?,?,?,?,?,?,?,?,?,?)',
+							(filepath, relpath, subject, session, datatype, suffix, extension,
+							 json.dumps(entities), sidecar, stat.st_mtime, stat.st_size))
+			self.stats['parsed'] += 1
+
+		self.db.executemany('DELETE FROM files WHERE Path = ?', [(path,) for path in known if path not in current]) # Removed Files
+
+	def subjects(self): 																# Indexed Subjects
+		row = self.db.execute("SELECT Dirs FROM dirs WHERE Path = ''").fetchone() 		# BIDS Directory Listing
+		if row is None: 																# Only Single Subjects Indexed
+			return [row[0] for row in self.db.execute("SELECT Path FROM dirs WHERE Path NOT LIKE '%/%' AND Path != ''")]
+		return [name for name in json.loads(row[0]) if name.startswith('sub-')]
+
+	def sessions(self, subject): 														# Sessions of a Subject
+		row = self.db.execute('SELECT Dirs FROM dirs WHERE Path = ?', (subject,)).fetchone() # Subject Directory Listing
+		if row is None: 																# Unknown Subject
+			return []
+		return [name for name in json.loads(row[0]) if name.startswith('ses')]
+
+	def files(self, subject, session=None, datatype=None, pattern=None, suffix=None, extension=None, **entities): # Find Files
+		'''
+		- 1. Description:
+			- Finds indexed files of a subject (i.e. instead of globbing
+			    bids/sub-01/ses-01/anat/*T1w.ni*).
+
+		- 2. Inputs:
+			- subject  : (String) Subject (i.e. sub-01)
+			- session  : (String) Session (i.e. ses-01; '' = sessionless; None = any)
+			- datatype : (String) Datatype directory (i.e. anat, mrs)
+			- pattern  : (String) File name pattern (i.e. *T1w.ni*)
+			- suffix   : (String) BIDS suffix (i.e. T1w)
+			- extension: (String) Extension (i.e. .nii.gz)
+			- entities : (Dict  ) Entity values (i.e. run='1')
+
+		- 3. Outputs:
+			- paths    : (List  ) Sorted absolute file paths
+		'''
+
+		query  = 'SELECT Path, Entities FROM files WHERE Subject = ?' 					# Files of Subject
+		values = [subject]
+		for column, value in [('Session', session), ('Datatype', datatype), ('Suffix', suffix), ('Extension', extension)]:
+			if value is not None: 														# Filter Given
+				query += ' AND {} = ?'.format(column)
+				values.append(value)
+
+		paths  = [] 																	# Matching Files
+		for path, found in self.db.execute(query, values): 								# Iterate over Candidates
+			if pattern is not None and fnmatch.fnmatchcase(path.split('/')[-1], pattern) == False: # Name does not Match
+				continue
+			found = json.loads(found) 													# Entities of File
+			if any(found.get(key) != str(value) for key, value in entities.items()): 	# Entity does not Match
+				continue
+			paths.append('{}/{}'.format(self.bidsdir, path))
+		return sorted(paths)
+
+	def sidecar(self, path): 															# Parsed JSON Sidecar of a File
+		'''
+		- 1. Description:
+			- Returns the parsed JSON sidecar of a data file (or of a .json file),
+			    i.e. sub-01_ses-01_svs.nii.gz -> sub-01_ses-01_svs.json. The
+			    sidecar is read again (and its row updated) if its size or
+			    modification time differ from the index (i.e. edited in place).
+
+		- 2. Inputs:
+			- path     : (String) Absolute (or BIDS-relative) file path
+
+		- 3. Outputs:
+			- sidecar  : (Dict  ) Sidecar content (None if not indexed)
+		'''
+
+		path = path.replace('\\', '/') 													# Forward Slashes
+		if path.startswith(self.bidsdir + '/'): 										# Relative to BIDS Directory
+			path = path[len(self.bidsdir) + 1:]
+		path = path.split('.nii')[0] if '.nii' in path else os.path.splitext(path)[0] 	# Path without Extension
+		path = path + '.json' 															# Sidecar Path
+		row  = self.db.execute('SELECT Sidecar, Mtime, Size FROM files WHERE Path = ?', (path,)).fetchone()
+		if row is None: 																# Not Indexed
+			return None
+
+		try:
+			stat = os.stat('{}/{}'.format(self.bidsdir, path)) 							# Sidecar Now
+		except OSError: 																# Removed since Indexed
+			return None
+		sidecar = row[0]
+		if (stat.st_mtime, stat.st_size) != (row[1], row[2]): 							# Edited in Place - Read Again
+			try:
+				with open('{}/{}'.format(self.bidsdir, path), 'r') as f: 				# Read Sidecar
+					sidecar = f.read()
+				json.loads(sidecar) 													# Only Keep Valid JSON
+			except (OSError, ValueError): 												# Unreadable or Incomplete
+				sidecar = None
+			self.db.execute('UPDATE files SET Sidecar = ?, Mtime = ?, Size = ? WHERE Path = ?',
+							(sidecar, stat.st_mtime, stat.st_size, path))
+			self.db.commit()
+		if sidecar is None: 															# Not Valid JSON
+			return None
+		return json.loads(sidecar)
@@ -0,0 +1,169 @@
+from multiprocessing.connection import Listener, Client 								# Local Socket Connections
+from multiprocessing import connection 													# Authentication Handshake
+from multiprocessing import AuthenticationError 										# Wrong Authentication Key
+from collections import OrderedDict 													# Coalesced Events
+import threading 																		# Listener Thread
+import secrets 																			# Authentication Key
+import json 																			# JSON Files
+import os 																				# Operating System
+
+def address_file(basedir): 																# Daemon Address File
+	return '{}/.pipeline_daemon.json'.format(basedir)
+
+def session_from_path(basedir, path): 													# Subject/Session of a Changed Path
+	'''
+	- 1. Description:
+		- Determine the subject (and session) a changed path belongs to. Paths
+		    can be absolute or relative to the study directory (as reported by
+		    watchman), i.e. raw/sub-01/ses-01/DICOM/IM_0001.
+
+	- 2. Inputs:
+		- basedir  : (String) Base Directory where raw and bids can be found.
+		- path     : (String) Changed path
+
+	- 3. Outputs:
+		- key      : (Tuple ) (Subject, Session) where Session is None if the
+							    path does not name a session (None if no subject)
+	'''
+
+	path  = path.strip().replace('\\', '/') 											# Forward Slashes
+	if path.startswith(basedir + '/'): 													# Absolute Path within Study
+		path = path[len(basedir) + 1:] 													# Relative to Study Directory
+
+	parts = [part for part in path.split('/') if part != ''] 							# Path Components
+	if len(parts) > 0 and parts[0] == 'raw': 											# Relative to Study Directory
+		parts = parts[1:] 																# Relative to Raw Directory
+
+	if len(parts) == 0 or parts[0].startswith('sub') == False: 							# Not within a Subject
+		return None
+	if len(parts) > 1 and parts[1].startswith('ses'): 									# Session Directory
+		return (parts[0], parts[1])
+	return (parts[0], None) 															# Subject Only
+
+class EventQueue(): 																	# Coalescing Work Queue
+	'''
+	- 1. Description:
+		- In-memory work queue of changed subjects/sessions. Repeated events for
+		    the same subject/session are coalesced into a single entry until the
+		    queue is drained.
+	'''
+
+	def __init__(self):
+		self.lock    = threading.Lock() 												# Events Arrive from the Listener Thread
+		self.events  = OrderedDict() 													# (Subject, Session) -> Number of Events
+
+	def put(self, basedir, paths): 														# Queue Changed Paths
+		with self.lock: 																# Thread-Safe
+			for path in paths: 															# Iterate over Changed Paths
+				key = session_from_path(basedir, path) 									# Subject and Session
+				if key is not None: 													# Path within a Subject
+					self.events[key] = self.events.get(key, 0) + 1 						# Coalesce Events
+
+	def drain(self): 																	# Take all Queued Events
+		with self.lock: 																# Thread-Safe
+			events, self.events = self.events, OrderedDict() 							# Swap Queues
+		return events
+
+	def __len__(self):
+		return len(self.events)
+
+class PipelineServer(): 																# Receives Changed Paths from Watchman Triggers
+	'''
+	- 1. Description:
+		- Listens on a local socket for changed paths sent by watchman triggers
+		    (main.py --enqueue) and adds them to an EventQueue. The address and
+		    authentication key of the listener are written to an address file in
+		    the study directory (readable by the owner only), so triggers of the
+		    same study can find the running daemon.
+
+		  Note: Every connection is authenticated and read on its own thread,
+		    so a trigger that connects and stalls never holds up the others.
+
+	- 2. Inputs:
+		- basedir  : (String) Base Directory where raw and bids can be found.
+		- events   : (Queue ) EventQueue that receives the changed paths.
+		- timeout  : (Float ) Seconds to wait for the paths of a connection
+	'''
+
+	def __init__(self, basedir, events, timeout=5):
+
+		self.basedir  = basedir 														# Base Directory
+		self.events   = events 															# Event Queue
+		self.timeout  = timeout 														# Seconds to Wait for a Message
+		self.authkey  = secrets.token_bytes(32) 										# Authentication Key
+		self.listener = Listener(('localhost', 0)) 										# Free Local Port (Authenticated per Connection, see handle)
+		self.addrfile = address_file(basedir) 											# Address File
+
+		host, port    = self.listener.address 											# Listener Address
+		descriptor    = os.open(self.addrfile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600) # Owner Only
+		with os.fdopen(descriptor, 'w') as f: 											# Write Address File
+			f.write(json.dumps({'host'   : host, 										# Listener Host
+								'port'   : port, 										# Listener Port
+								'authkey': self.authkey.hex(), 							# Authentication Key
+								'pid'    : os.getpid()})) 								# Daemon Process
+
+		self.thread   = threading.Thread(target=self.serve, daemon=True) 				# Listener Thread
+		self.thread.start() 															# Start Listening
+
+	def serve(self): 																	# Accept Connections
+		while True: 																	# Until Listener is Closed
+			try: 																		# Accept Next Trigger
+				conn = self.listener.accept() 											# Wait for Connection
+			except OSError: 															# Listener Closed
+				return
+			except Exception as e: 														# Broken Connection - Ignore
+				continue
+			threading.Thread(target=self.handle, args=(conn,), daemon=True).start() 	# One Thread per Trigger
+
+	def handle(self, conn): 															# Receive the Paths of one Trigger
+		try:
+			connection.deliver_challenge(conn, self.authkey) 							# Authenticate Trigger (as Listener.accept)
+			connection.answer_challenge(conn, self.authkey)
+			if conn.poll(self.timeout) == False: 										# Stalled Trigger - Drop
+				return
+			message = conn.recv() 														# Message from Trigger
+			self.events.put(self.basedir, message.get('paths', [])) 					# Queue Paths
+			conn.send('queued') 														# Acknowledge
+		except Exception as e: 															# Failed Authentication or Broken Connection - Ignore
+			pass
+		finally:
+			conn.close()
+
+	def close(self): 																	# Stop Listening
+		try: 																			# Remove Address File (if still ours)
+			with open(self.addrfile, 'r') as f: 										# Read Address File
+				owner = json.loads(f.read()).get('pid') 								# Daemon Process
+			if owner == os.getpid(): 													# Written by this Daemon
+				os.remove(self.addrfile)
+		except (OSError, ValueError):
+			pass
+		self.listener.close() 															# Close Socket
+
+def send_paths(basedir, paths, timeout=5): 												# Send Changed Paths to a Running Daemon
+	'''
+	- 1. Description:
+		- Send changed paths to the daemon of a study.
+
+	- 2. Inputs:
+		- basedir  : (String) Base Directory where raw and bids can be found.
+		- paths    : (List  ) Changed paths
+		- timeout  : (Float ) Seconds to wait for the acknowledgement
+
+	- 3. Outputs:
+		- queued   : (Bool  ) True if a running daemon received the paths.
+	'''
+
+	try: 																				# Daemon might not be Running
+		with open(address_file(basedir), 'r') as f: 									# Read Address File
+			address = json.loads(f.read()) 												# Daemon Address
+
+		conn = Client((address['host'], address['port']), authkey=bytes.fromhex(address['authkey'])) # Connect
+		try:
+			conn.send({'paths': list(paths)}) 											# Send Changed Paths
+			if conn.poll(timeout) == False: 											# No Acknowledgement
+				return False
+			return conn.recv() == 'queued'
+		finally:
+			conn.close()
+	except (OSError, ValueError, KeyError, EOFError, AuthenticationError): 				# No Daemon Listening
+		return False
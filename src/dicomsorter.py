@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+
+from concurrent.futures import ThreadPoolExecutor 										# Header Reads at the Same Time
+import argparse 																		# Input Argument Parser
+import string 																			# Folder Scheme Fields
+import struct 																			# Dicom Element Unpacking
+import time as t0 																		# Timer
+import re 																				# Folder Name Cleanup
+import os 																				# Operating System
+
+try: 																					# Optional - Full Dicom Dictionary and Transfer Syntaxes
+	import pydicom
+	from pydicom.errors import InvalidDicomError
+	from pydicom.multival import MultiValue
+except ImportError: 																	# Built-in Header Reader Only
+	pydicom = None
+
+keywords  = {'Modality'           : ((0x0008, 0x0060), 'CS'), 							# Tags Known to the Built-in Header Reader
+			 'StudyDescription'   : ((0x0008, 0x1030), 'LO'), 							# (Any Keyword Works with pydicom)
+			 'SeriesDescription'  : ((0x0008, 0x103E), 'LO'),
+			 'PatientName'        : ((0x0010, 0x0010), 'PN'),
+			 'PatientID'          : ((0x0010, 0x0020), 'LO'),
+			 'ScanningSequence'   : ((0x0018, 0x0020), 'CS'),
+			 'SequenceVariant'    : ((0x0018, 0x0021), 'CS'),
+			 'SequenceName'       : ((0x0018, 0x0024), 'SH'),
+			 'RepetitionTime'     : ((0x0018, 0x0080), 'DS'),
+			 'EchoTime'           : ((0x0018, 0x0081), 'DS'),
+			 'ProtocolName'       : ((0x0018, 0x1030), 'LO'),
+			 'StudyInstanceUID'   : ((0x0020, 0x000D), 'UI'),
+			 'SeriesInstanceUID'  : ((0x0020, 0x000E), 'UI'),
+			 'SeriesNumber'       : ((0x0020, 0x0011), 'IS'),
+			 'AcquisitionNumber'  : ((0x0020, 0x0012), 'IS'),
+			 'InstanceNumber'     : ((0x0020, 0x0013), 'IS'),
+			 'ImagesInAcquisition': ((0x0020, 0x1002), 'IS')}
+pixeldata = (0x7FE0, 0x0010) 															# Pixel Data (Headers End Here)
+longvrs   = [b'OB', b'OD', b'OF', b'OL', b'OV', b'OW', b'SQ', b'SV', b'UC', b'UN', b'UR', b'UT', b'UV'] # Explicit VRs with 4-Byte Lengths
+undefined = 0xFFFFFFFF 																	# Undefined Length (Delimited Sequences and Items)
+
+def folder_keywords(scheme): 															# Keywords of a Folder Scheme
+	return [field for text, field, spec, conv in string.Formatter().parse(scheme) if field]
+
+def read_element(f, explicit): 															# Tag, VR and Length of the Next Element
+	head = f.read(8) 																	# Tag and (Short) Length
+	if len(head) < 8: 																	# End of File
+		return None, None, None
+	tag = struct.unpack('<HH', head[:4]) 												# Group and Element
+	if tag[0] == 0xFFFE or explicit == False: 											# Items, Delimiters and Implicit VR
+		return tag, None, struct.unpack('<I', head[4:])[0]
+	vr  = head[4:6] 																	# Explicit VR
+	if vr in longvrs: 																	# 4-Byte Length after 2 Reserved Bytes
+		return tag, vr, struct.unpack('<I', f.read(4))[0]
+	return tag, vr, struct.unpack('<H', head[6:])[0]
+
+def skip_delimited(f, explicit, delimiter): 											# Skip a Value of Undefined Length
+	while True: 																		# Until the Delimiter
+		tag, vr, length = read_element(f, explicit)
+		if tag is None: 																# Truncated File
+			raise ValueError('unterminated sequence')
+		if tag == delimiter: 															# End of Sequence or Item
+			return
+		if length == undefined: 														# Nested Item or Sequence
+			skip_delimited(f, explicit, (0xFFFE, 0xE00D) if tag == (0xFFFE, 0xE000) else (0xFFFE, 0xE0DD))
+		else:
+			f.seek(length, 1)
+
+def decode(value, vr): 																	# Python Value of an Element
+	if vr in ['US', b'US']: 															# Unsigned Short
+		return struct.unpack('<H', value[:2])[0]
+	if vr in ['UL', b'UL']: 															# Unsigned Long
+		return struct.unpack('<I', value[:4])[0]
+	text = value.decode('latin-1').strip('\x00 ') 										# Text Value
+	try:
+		if vr in ['IS', b'IS']: 														# Integer String
+			return int(text.split('\\')[0])
+		if vr in ['DS', b'DS']: 														# Decimal String
+			return float(text.split('\\')[0])
+	except ValueError: 																	# Malformed Number - Keep Text
+		pass
+	return text
+
+def parse_header(path, names): 															# Built-in Dicom Header Reader
+	'''
+	- 1. Description:
+		- Reads selected tags from a DICOM Part 10 file (explicit or implicit
+		    VR little endian) without pydicom. Values that are not needed are
+		    skipped with seek, and reading stops at the last wanted tag (the
+		    elements are sorted by tag), so the pixel data is never read.
+
+	- 2. Inputs:
+		- path     : (String) File path
+		- names    : (List  ) Keywords of the tags to read (see keywords)
+
+	- 3. Outputs:
+		- values   : (Dict  ) Keyword -> Value (None for missing tags); None if
+							    the file is not a DICOM file
+	'''
+
+	wanted = {keywords[name][0]: (name, keywords[name][1]) for name in names} 			# Tag -> Keyword and VR
+	last   = max(wanted.keys()) 														# Stop after this Tag
+	values = dict.fromkeys(names) 														# Missing Tags are None
+
+	with open(path, 'rb') as f:
+		f.seek(128) 																	# Skip Preamble
+		if f.read(4) != b'DICM': 														# Not a DICOM File
+			return None
+
+		syntax = '1.2.840.10008.1.2.1' 													# Transfer Syntax (Explicit VR Little Endian)
+		while True: 																	# File Meta Information (Always Explicit VR)
+			start = f.tell()
+			tag, vr, length = read_element(f, True)
+			if tag is None: 															# File Ends within Meta Information
+				raise ValueError('truncated file')
+			if tag[0] != 0x0002: 														# End of Meta Information
+				f.seek(start)
+				break
+			value = f.read(length)
+			if tag == (0x0002, 0x0010): 												# Transfer Syntax UID
+				syntax = decode(value, vr)
+
+		if syntax in ['1.2.840.10008.1.2.2', '1.2.840.10008.1.2.1.99']: 				# Big Endian or Deflated Data Set
+			raise ValueError('transfer syntax {} needs pydicom'.format(syntax))
+		explicit = syntax != '1.2.840.10008.1.2' 										# Implicit VR Little Endian (Compressed Pixel Data is Explicit)
+
+		elements = 0 																	# Data Set Elements Read
+		while True: 																	# Data Set
+			tag, vr, length = read_element(f, explicit)
+			if tag is None and elements == 0: 											# File Ends before the Data Set
+				raise ValueError('truncated file')
+			if tag is None or tag > last or tag == pixeldata: 							# Past the Wanted Tags
+				break
+			elements += 1
+			if tag in wanted: 															# Wanted Tag
+				value = f.read(length)
+				if len(value) < length: 												# File Ends within the Value
+					raise ValueError('truncated file')
+				values[wanted[tag][0]] = decode(value, vr or wanted[tag][1])
+			elif length == undefined: 													# Sequence of Undefined Length
+				skip_delimited(f, explicit, (0xFFFE, 0xE0DD))
+			else: 																		# Skip Value
+				f.seek(length, 1)
+
+	return values
+
+def read_header(path, names): 															# Selected Tags of a Dicom File
+	'''
+	- 1. Description:
+		- Reads selected tags of a DICOM file, stopping before the pixel data.
+		    Uses pydicom when it is installed (any keyword and transfer syntax),
+		    and the built-in reader (see parse_header) otherwise.
+
+	- 2. Inputs:
+		- path     : (String) File path
+		- names    : (List  ) Tag keywords (i.e. ScanningSequence)
+
+	- 3. Outputs:
+		- values   : (Dict  ) Keyword -> Value (None for missing tags); None if
+							    the file is not a DICOM file
+	'''
+
+	if pydicom is None: 																# Built-in Header Reader
+		return parse_header(path, names)
+
+	try:
+		ds = pydicom.dcmread(path, stop_before_pixels=True, specific_tags=names) 		# Header Only
+	except InvalidDicomError: 															# Not a DICOM File
+		return None
+	values = {} 																		# Keyword -> Value
+	for name in names: 																	# Iterate over Keywords
+		value = ds.get(name)
+		if isinstance(value, MultiValue): 												# Multiple Values (i.e. SE\IR)
+			value = '\\'.join(str(v) for v in value)
+		values[name] = value
+	return values
+
+def folder_name(scheme, values): 														# Folder of a Dicom File
+	clean = {} 																			# Values Safe for Folder Names
+	for name, value in values.items(): 													# Iterate over Values
+		if value is None: 																# Missing Tag
+			value = ''
+		if isinstance(value, str): 														# Replace Unsafe Characters
+			value = re.sub(r'[^\w.+-]', '_', value.strip())
+		clean[name] = value
+	return scheme.format(**clean)
+
+def list_files(sortdir): 																# Files of a Session (without Hidden Files)
+	paths = [] 																			# Candidate Files
+	for root, dirs, files in os.walk(sortdir): 											# Walk Session Directory
+		dirs[:] = [d for d in dirs if d.startswith('.') == False] 						# Skip Hidden Directories
+		paths  += [os.path.join(root, filename) for filename in files if filename.startswith('.') == False]
+	return paths
+
+def sort_dicoms(sortdir, scheme='{ScanningSequence}', link=False, threads=8, paths=None, extra=()): # Sort a Session's Dicoms
+	'''
+	- 1. Description:
+		- Sorts the DICOM files below sortdir into folders named after their
+		    header tags (i.e. sortdir/{ScanningSequence}/IM_0001), like
+		    dicomsort -f {ScanningSequence} sortdir, but within this process.
+		    Only the header tags in the folder scheme are read, and the reads
+		    run on a thread pool (they mostly wait on the file system). Files
+		    keep their names (_1, _2, ... on clashes). Files that are not DICOM
+		    files, and hidden files, are left where they are. Files already in
+		    their folder are skipped, so sorting again is cheap.
+
+	- 2. Inputs:
+		- sortdir  : (String) Directory to sort (i.e. raw/sub-01/ses-01)
+		- scheme   : (String) Folder scheme with tag keywords (i.e. {SeriesNumber:03d}-{SeriesDescription})
+		- link     : (Bool  ) Hardlink files into their folders instead of moving them
+		- threads  : (Int   ) Header reads at the same time
+		- paths    : (List  ) Only sort these files (default all files below sortdir)
+		- extra    : (List  ) More tag keywords to read (see placed)
+
+	- 3. Outputs:
+		- stats    : (Dict  ) files, dicoms, sorted, unreadable, seconds,
+							    files_per_s (files looked at per second),
+							    placed: (Path, Folder, Tag Values) of every dicom
+							    after sorting, and errors: unreadable files
+	'''
+
+	start  = t0.time() 																	# Sort Start
+	sortdir = os.path.normpath(sortdir) 												# Compare Folders without Trailing Slashes
+	names  = folder_keywords(scheme) 													# Tags to Read
+	names += [name for name in extra if name not in names] 								# Tags Read for the Caller
+	if pydicom is None: 																# Built-in Reader Knows a Few Tags
+		for name in names:
+			if name not in keywords:
+				raise ValueError('{} needs pydicom (built-in tags: {})'.format(name, ', '.join(sorted(keywords))))
+
+	if paths is None: 																	# Whole Session
+		paths = list_files(sortdir)
+
+	def folder(path): 																	# Folder and Tags of a File (or Read Error)
+		try:
+			values = read_header(path, names)
+			return None if values is None else (folder_name(scheme, values), values) 	# None - Not a DICOM File
+		except (OSError, ValueError, struct.error) as e: 								# Truncated or Unsupported File
+			return e
+
+	with ThreadPoolExecutor(max_workers=max(1, threads)) as pool: 						# Read Headers
+		folders = list(pool.map(folder, paths))
+
+		moves   = [] 																	# (Source, Destination) of Files to Sort
+		taken   = set() 																# Destinations Chosen in this Sort
+		stats   = {'files': len(paths), 'dicoms': 0, 'sorted': 0, 'unreadable': 0, 'placed': [], 'errors': []}
+		for path, header in zip(paths, folders): 										# Iterate over Files
+			if isinstance(header, Exception): 											# Unreadable File
+				stats['unreadable'] += 1
+				stats['errors'].append(path)
+				continue
+			if header is None: 															# Not a DICOM File
+				continue
+			name, values = header 														# Folder and Tag Values
+			stats['dicoms'] += 1
+			outdir = os.path.join(sortdir, name) 										# Sorted Folder
+			if os.path.dirname(path) == os.path.normpath(outdir): 						# Already Sorted
+				stats['placed'].append((path, name, values))
+				continue
+			stem, ext = os.path.splitext(os.path.basename(path)) 						# Keep File Name
+			dest   = os.path.join(outdir, stem + ext)
+			ii     = 0
+			while dest in taken or os.path.lexists(dest): 								# Name Clash
+				if link and os.path.exists(dest) and os.path.samefile(path, dest): 		# Linked Earlier
+					stats['placed'].append((dest, name, values))
+					dest = None
+					break
+				ii  += 1
+				dest = os.path.join(outdir, '{}_{}{}'.format(stem, ii, ext))
+			if dest is not None: 														# File to Sort
+				taken.add(dest)
+				moves.append((path, dest))
+				stats['placed'].append((dest, name, values))
+
+		for outdir in set(os.path.dirname(dest) for path, dest in moves): 				# Create Folders
+			os.makedirs(outdir, exist_ok=True)
+		list(pool.map(lambda move: (os.link if link else os.rename)(*move), moves)) 	# Move or Link Files
+		stats['sorted'] = len(moves)
+
+	stats['seconds']     = t0.time() - start 											# Sort Time
+	stats['files_per_s'] = stats['files'] / max(stats['seconds'], 1e-9) 				# Throughput
+	return stats
+
+if __name__ == '__main__': 																# Sort a Directory from the Command Line
+
+	parser = argparse.ArgumentParser(description='Sort DICOM files into folders named after their header tags')
+	parser.add_argument('sortdir'        , help='Directory to sort'                            , type=str)
+	parser.add_argument('-f', '--folder' , help='Folder scheme (default {ScanningSequence})'  , type=str, default='{ScanningSequence}')
+	parser.add_argument('-t', '--threads', help='Header reads at the same time (default 8)'    , type=int, default=8)
+	parser.add_argument('--link'         , help='Hardlink files instead of moving them'        , action='store_true')
+	args   = parser.parse_args()
+
+	stats  = sort_dicoms(args.sortdir, args.folder, args.link, args.threads)
+	print('Sorted {sorted} of {dicoms} dicom(s) ({files} file(s), {unreadable} unreadable) in {seconds:.2f} s ({files_per_s:.0f} files/s)'.format(**stats))
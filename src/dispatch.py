@@ -0,0 +1,224 @@
+from concurrent.futures import ThreadPoolExecutor 										# Jobs Running at the Same Time
+import subprocess 																		# Run Osprey
+import hashlib 																			# Settings Hashing
+import json 																			# JSON Files
+import sys 																				# System Operations
+import os 																				# Operating System
+
+cost_model = {'startup': 30, 'dataset': 60, 'megabyte': 1} 								# Rough Osprey Seconds (Runtime Start, per Dataset, per MB of Data)
+datakeys   = ['files', 'files_ref', 'files_w', 'files_mm', 'files_nii', 'files_seg'] 	# Data File Keys of an Osprey Job
+
+def settings_digest(settings): 															# Hash of a wrapper_settings.json File
+	with open(settings, 'rb') as f:
+		return hashlib.sha256(f.read()).hexdigest()
+
+def done_file(settings): 																# Completion Marker Next to the Settings
+	return os.path.join(os.path.dirname(settings), 'osprey_wrapper.done')
+
+def is_done(job): 																		# Job Finished with these Settings
+	try:
+		with open(done_file(job['settings']), 'r') as f: 								# Read Completion Marker
+			return f.read().strip() == settings_digest(job['settings'])
+	except OSError: 																	# Never Finished
+		return False
+
+def estimate_cost(settings): 															# Estimated Cost of an Osprey Job
+	'''
+	- 1. Description:
+		- Estimates the cost of an Osprey job from its settings file: the number
+		    of datasets (entries of files) and the size of all data files. The
+		    seconds follow cost_model (Matlab Runtime start, per dataset, and
+		    per MB read), which is meant for ordering and sizing jobs, not as a
+		    prediction of the exact runtime.
+
+	- 2. Inputs:
+		- settings : (String) wrapper_settings.json path
+
+	- 3. Outputs:
+		- cost     : (Dict  ) datasets, bytes and estimated seconds
+	'''
+
+	with open(settings, 'r') as f: 														# Read Settings
+		job = json.loads(f.read())
+
+	nbytes   = 0 																		# Size of Data Files
+	for key in datakeys: 																# Iterate over Data Lists
+		for filepath in job.get(key, []): 												# Iterate over Data Files
+			if os.path.isfile(filepath):
+				nbytes += os.path.getsize(filepath)
+
+	datasets = len(job.get('files', [])) 												# Number of Datasets
+	seconds  = cost_model['startup'] + cost_model['dataset'] * datasets + cost_model['megabyte'] * nbytes / 1e6
+	return {'datasets': datasets, 'bytes': nbytes, 'seconds': round(seconds, 1)}
+
+def write_manifest(manifest, jobs): 													# Write a Job Manifest (JSON Lines)
+	tmpfile = '{}.tmp'.format(manifest) 												# Write to Temporary File First
+	with open(tmpfile, 'w') as f: 														# One Job per Line
+		for job in jobs:
+			f.write(json.dumps(job) + '\n')
+	os.replace(tmpfile, manifest) 														# Replace Manifest in one Step
+
+def read_manifest(manifest): 															# Read a Job Manifest
+	with open(manifest, 'r') as f:
+		return [json.loads(line) for line in f if line.strip() != '']
+
+def job_command(job): 																	# Osprey Command of a Job
+	executable = os.getenv('EXECUTABLE_PATH') or job.get('executable') 					# Executable on this Machine (i.e. Compute Node)
+	mcr        = os.getenv('MCR_PATH') or job.get('mcr') 								# Matlab Runtime on this Machine
+	if executable is None or mcr is None: 												# Not Configured
+		raise ValueError('EXECUTABLE_PATH and MCR_PATH must be set to run osprey')
+	return executable + ' ' + mcr + ' ' + job['settings']
+
+def execute_job(job): 																	# Run one Osprey Job
+	'''
+	- 1. Description:
+		- Runs Osprey on the settings file of a job. The output of Osprey is
+		    kept in osprey_wrapper.log next to the settings file and returned
+		    with the exit code, so the outputs of jobs running at the same time
+		    do not mix. A successful job leaves osprey_wrapper.done (the hash of
+		    its settings), so planning again skips it until its settings change.
+
+	- 2. Inputs:
+		- job      : (Dict  ) Manifest job (settings, executable, mcr)
+
+	- 3. Outputs:
+		- exit_code: (Int   ) Exit code of Osprey (-1 if it could not be started)
+		- output   : (String) Output of Osprey
+	'''
+
+	try:
+		command = job_command(job) 														# Osprey Command
+		result  = subprocess.run(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+		output  = 'Running: ' + command + '\n' + result.stdout.decode(errors='replace')
+		with open(os.path.join(os.path.dirname(job['settings']), 'osprey_wrapper.log'), 'w') as f: # Job Log
+			f.write(output)
+		if result.returncode == 0: 														# Mark Job Done
+			with open(done_file(job['settings']), 'w') as f:
+				f.write(settings_digest(job['settings']))
+		return result.returncode, output
+	except Exception as e: 																# Job could not be Run
+		return -1, 'Error: ' + str(e) + '\n'
+
+def run_jobs(jobs, n_jobs=1, unplanned=()): 											# Run Jobs on this Machine
+	'''
+	- 1. Description:
+		- Runs jobs, n_jobs at a time. Every job runs Osprey as its own process,
+		    so one thread per running job is enough to keep n_jobs Osprey
+		    processes busy. Outputs are printed in job order as the jobs finish,
+		    followed by a summary of the failed jobs (and of the work items
+		    that could not be prepared).
+
+	- 2. Inputs:
+		- jobs     : (List  ) Manifest jobs
+		- n_jobs   : (Int   ) Jobs to run at the same time
+		- unplanned: (List  ) (Label, Error) of work items without a job
+
+	- 3. Outputs:
+		- failed   : (List  ) (Job, Exit Code) of the failed jobs
+	'''
+
+	failed = [] 																		# Failed Jobs
+	with ThreadPoolExecutor(max_workers=max(1, n_jobs)) as pool: 						# Bounded Pool
+		for job, (exit_code, output) in zip(jobs, pool.map(execute_job, jobs)): 		# Results in Job Order
+			print('\n[' + job['label'] + '] exit code ' + str(exit_code))
+			print(output, end='', flush=True)
+			if exit_code != 0: 															# Job Failed
+				failed.append((job, exit_code))
+
+	print('\nProcessed ' + str(len(jobs) + len(unplanned)) + ' job(s), ' + str(len(failed) + len(unplanned)) + ' failed')
+	for label, error in unplanned: 														# Summarize Items not Prepared
+		print('Failed: ' + label + ' (not prepared: ' + error + ')')
+	for job, exit_code in failed: 														# Summarize Failed Jobs
+		print('Failed: ' + job['label'] + ' (exit code ' + str(exit_code) + ')')
+	return failed
+
+def array_script(manifest, jobs, system='slurm', limit=None): 							# Array Job Script for a Manifest
+	'''
+	- 1. Description:
+		- Writes an array job script next to the manifest. Array task N runs job
+		    N of the manifest (run.py --dispatch <manifest> --task N). The time
+		    limit is twice the largest estimated cost (at least 10 minutes).
+
+	- 2. Inputs:
+		- manifest : (String) Manifest path
+		- jobs     : (List  ) Manifest jobs
+		- system   : (String) Batch system (slurm or pbs)
+		- limit    : (Int   ) Array tasks running at the same time (None = no limit)
+
+	- 3. Outputs:
+		- script   : (String) Array job script path
+	'''
+
+	if len(jobs) == 0: 																	# Array of no Tasks (Rejected by the Batch System)
+		raise ValueError('no jobs in {}'.format(manifest))
+
+	manifest = os.path.abspath(manifest) 												# Compute Nodes might Start Elsewhere
+	logdir = os.path.join(os.path.dirname(manifest), 'logs') 							# Array Task Logs
+	os.makedirs(logdir, exist_ok=True)
+
+	seconds  = max([2 * job['cost']['seconds'] for job in jobs] + [600]) 				# Time Limit
+	minutes  = int(-(-seconds // 60)) 													# Whole Minutes
+	walltime = '{:02d}:{:02d}:00'.format(minutes // 60, minutes % 60)
+	run_py   = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'run.py') 		# run.py next to this Module
+	command  = '"{}" "{}" --dispatch "{}" --task'.format(sys.executable, run_py, manifest)
+
+	if system == 'slurm': 																# Slurm
+		lines = ['#SBATCH --job-name=osprey',
+				 '#SBATCH --array=1-{}{}'.format(len(jobs), '' if limit is None else '%{}'.format(limit)),
+				 '#SBATCH --time={}'.format(walltime),
+				 '#SBATCH --output={}/osprey_%A_%a.out'.format(logdir),
+				 '',
+				 '{} "$SLURM_ARRAY_TASK_ID"'.format(command)]
+	elif system == 'pbs': 																# PBS Pro
+		lines = ['#PBS -N osprey',
+				 '#PBS -J 1-{}'.format(len(jobs)),
+				 '#PBS -W max_run_subjobs={}'.format(limit) if limit is not None else '',
+				 '#PBS -l walltime={}'.format(walltime),
+				 '#PBS -o {}'.format(logdir),
+				 '#PBS -j oe',
+				 '',
+				 '{} "$PBS_ARRAY_INDEX"'.format(command)]
+	else:
+		raise ValueError('unknown batch system: {}'.format(system))
+
+	script   = '{}.{}.sh'.format(os.path.splitext(manifest)[0], system) 				# Script next to Manifest
+	with open(script, 'w') as f:
+		f.write('\n'.join(['#!/bin/bash'] + [line for line in lines[:-2] if line != ''] + lines[-2:]) + '\n')
+	return script
+
+def dispatch(manifest, n_jobs=1, task=None, array=None, limit=None): 					# run.py --dispatch
+	'''
+	- 1. Description:
+		- Runs the jobs of a manifest written by run.py --plan on this machine
+		    (all of them, or only job number task), or writes an array job
+		    script that runs one job per array task.
+
+	- 2. Inputs:
+		- manifest : (String) Manifest path
+		- n_jobs   : (Int   ) Jobs to run at the same time
+		- task     : (Int   ) Only run this job (1 = first line of the manifest)
+		- array    : (String) Write an array job script for this batch system
+		- limit    : (Int   ) Array tasks running at the same time
+
+	- 3. Outputs:
+		- status   : (Int   ) Exit status (0 = every job succeeded)
+	'''
+
+	jobs = read_manifest(manifest) 														# Pending Jobs
+	if len(jobs) == 0: 																	# Everything Done Already
+		print('Nothing to dispatch: ' + manifest + ' has no pending jobs')
+		return 0
+
+	if array is not None: 																# Hand Jobs to the Batch System
+		script = array_script(manifest, jobs, array, limit)
+		print('Wrote ' + script + ' (' + str(len(jobs)) + ' array task(s))')
+		return 0
+
+	if task is not None: 																# Single Array Task
+		if task < 1 or task > len(jobs): 												# No such Job
+			print('Error: task ' + str(task) + ' is not in ' + manifest + ' (' + str(len(jobs)) + ' jobs)')
+			return 1
+		jobs = [jobs[task - 1]]
+
+	failed = run_jobs(jobs, n_jobs)
+	return 1 if len(failed) > 0 else 0
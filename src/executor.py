@@ -0,0 +1,263 @@
+from multiprocessing.connection import Listener, Client 								# Local Socket Connections
+import subprocess 																		# Run External Commands
+import threading 																		# Listener and Reader Threads
+import secrets 																			# Authentication Key
+import shlex 																			# Split Worker Command
+import queue 																			# Idle Workers and Replies
+import time as t0 																		# Timer
+import os 																				# Operating System
+
+import metrics 																			# Child Resource Usage
+
+class SubprocessExecutor(): 															# One-Shot OspreyCMD
+	'''
+	- 1. Description:
+		- Runs every Osprey job file with a new OspreyCMD process (the Matlab
+		    Runtime is started for every job).
+
+	- 2. Inputs:
+		- command  : (String) Osprey command (job file path is appended)
+		- cwd      : (String) Working directory (i.e. the Osprey directory)
+		- env      : (Dict  ) Environment (i.e. with the Matlab Runtime on PATH)
+		- timeout  : (Float ) Seconds before a job is stopped (None = no limit)
+	'''
+
+	def __init__(self, command='OspreyCMD', cwd=None, env=None, timeout=None):
+
+		self.command = command 															# Osprey Command
+		self.cwd     = cwd 																# Working Directory
+		self.env     = env 																# Environment
+		self.timeout = timeout 															# Job Timeout
+		self.usage   = {} 																# Resource Usage of the Last Job
+
+	def run(self, jobfile): 															# Run a Job File
+		'''
+		- 1. Description:
+			- Run a single Osprey job file and wait for it to finish. The CPU 
+			    time and peak RSS of the job are kept in self.usage.
+
+		- 2. Inputs:
+			- jobfile  : (String) Osprey Job File Path
+
+		- 3. Outputs:
+			- exit_code: (Int   ) Exit code of OspreyCMD (TimeoutError if it timed out)
+		'''
+
+		script = '{} "{}"'.format(self.command, jobfile) 								# Osprey run script
+		P      = subprocess.Popen(script, cwd=self.cwd, shell=True, env=self.env) 		# Run Script
+		try:
+			exit_code, self.usage = metrics.wait(P, timeout=self.timeout) 				# Wait for Script Completion
+			return exit_code
+		except subprocess.TimeoutExpired: 												# Job took too long
+			P.kill() 																	# Stop Job
+			P.wait()
+			raise TimeoutError('OspreyCMD timed out after {} s'.format(self.timeout))
+
+class OspreyWorker(): 																	# Long-Lived Osprey Process
+	'''
+	- 1. Description:
+		- A long-lived Osprey worker process that has initialized the Matlab
+		    Runtime once and then runs job files sent to it. The protocol is
+		    line based:
+		      - job file paths are written to the worker's stdin (one per line)
+		      - the worker answers every job with a line "DONE <exit code>" on
+		          stdout. All other output lines are ignored.
+		    The worker exits when its stdin is closed.
+
+	- 2. Inputs:
+		- command  : (String) Worker command (i.e. a compiled Osprey worker loop)
+		- cwd      : (String) Working directory
+		- env      : (Dict  ) Environment
+	'''
+
+	def __init__(self, command, cwd=None, env=None):
+
+		self.command = command 															# Worker Command
+		self.cwd     = cwd 																# Working Directory
+		self.env     = env 																# Environment
+		self.process = None 															# Worker Process
+		self.replies = None 															# Exit Codes Read from Worker
+		self.start() 																	# Start Worker
+
+	def start(self): 																	# Start Worker Process
+		self.process = subprocess.Popen(shlex.split(self.command, posix=os.name != 'nt'), cwd=self.cwd, env=self.env,
+										stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+										universal_newlines=True, bufsize=1) 			# Line Buffered Pipes
+		self.replies = queue.Queue() 													# Exit Codes
+		threading.Thread(target=self.read, args=(self.process, self.replies), daemon=True).start() # Reader Thread
+
+	@staticmethod
+	def read(process, replies): 														# Read Worker Output
+		for line in process.stdout: 													# Iterate over Output Lines
+			if line.startswith('DONE'): 												# Job Finished
+				try:
+					replies.put(int(line.split()[1])) 									# Exit Code
+				except (IndexError, ValueError): 										# Malformed Reply
+					replies.put(1)
+		replies.put(None) 																# Worker Exited
+
+	def run(self, jobfile, timeout=None): 												# Run a Job File
+		'''
+		- 1. Description:
+			- Send a job file to the worker and wait for its exit code. Workers
+			    that exited are started again. A worker that does not answer
+			    within timeout seconds is stopped and started again.
+
+		- 2. Inputs:
+			- jobfile  : (String) Osprey Job File Path
+			- timeout  : (Float ) Seconds before the job is stopped (None = no limit)
+
+		- 3. Outputs:
+			- exit_code: (Int   ) Exit code of the job (TimeoutError if it timed out)
+		'''
+
+		if self.process.poll() is not None: 											# Worker Exited - Restart
+			self.start()
+
+		try: 																			# Send Job
+			self.process.stdin.write(jobfile + '\n')
+			self.process.stdin.flush()
+		except OSError: 																# Worker Died - Restart and Retry
+			self.start()
+			self.process.stdin.write(jobfile + '\n')
+			self.process.stdin.flush()
+
+		try:
+			exit_code = self.replies.get(timeout=timeout) 								# Wait for Reply
+		except queue.Empty: 															# Job took too long
+			self.close(kill=True) 														# Stop Worker
+			self.start() 																# Fresh Worker for the Next Job
+			raise TimeoutError('Osprey worker timed out after {} s'.format(timeout))
+
+		if exit_code is None: 															# Worker Exited during the Job
+			self.start() 																# Fresh Worker for the Next Job
+			raise RuntimeError('Osprey worker exited while running {}'.format(jobfile))
+		return exit_code
+
+	def close(self, kill=False): 														# Stop Worker
+		if self.process is None or self.process.poll() is not None: 					# Not Running
+			return
+		if kill: 																		# Stop Immediately
+			self.process.kill()
+		else: 																			# Let Worker Finish
+			self.process.stdin.close()
+		try:
+			self.process.wait(timeout=10)
+		except subprocess.TimeoutExpired: 												# Worker did not Exit
+			self.process.kill()
+			self.process.wait()
+
+class WorkerPool(): 																	# Warm Osprey Worker Pool
+	'''
+	- 1. Description:
+		- Keeps K long-lived Osprey worker processes (see OspreyWorker) in the
+		    main process, so the Matlab Runtime is initialized once per worker
+		    instead of once per job. The stage worker processes send job files
+		    to the pool over a local socket (see PoolExecutor); each job is run
+		    by the next idle worker. The number of jobs, time spent running
+		    them, and worker restarts are kept in self.stats.
+
+	- 2. Inputs:
+		- command  : (String) Worker command
+		- workers  : (Int   ) Number of worker processes (K)
+		- cwd      : (String) Working directory
+		- env      : (Dict  ) Environment
+		- timeout  : (Float ) Seconds before a job is stopped (None = no limit)
+	'''
+
+	def __init__(self, command, workers=1, cwd=None, env=None, timeout=None):
+
+		self.timeout  = timeout 														# Job Timeout
+		self.idle     = queue.Queue() 													# Idle Workers
+		self.workers  = [OspreyWorker(command, cwd, env) for ii in range(max(1, workers))] # Start Workers
+		for worker in self.workers: 													# All Workers Idle
+			self.idle.put(worker)
+
+		self.lock     = threading.Lock() 												# Statistics Updated by Connection Threads
+		self.stats    = {'jobs': 0, 'seconds': 0.0, 'timeouts': 0} 						# Pool Statistics
+		self.authkey  = secrets.token_bytes(32) 										# Authentication Key
+		self.listener = Listener(('localhost', 0), authkey=self.authkey) 				# Free Local Port
+		self.thread   = threading.Thread(target=self.serve, daemon=True) 				# Listener Thread
+		self.thread.start() 															# Start Listening
+
+	def executor(self): 																# Executor for Stage Workers
+		return PoolExecutor(self.listener.address, self.authkey)
+
+	def serve(self): 																	# Accept Connections
+		while True: 																	# Until Listener is Closed
+			try: 																		# Accept Next Stage Worker
+				conn = self.listener.accept() 											# Wait for Connection
+			except OSError: 															# Listener Closed
+				return
+			except Exception as e: 														# Failed Authentication - Ignore
+				continue
+			threading.Thread(target=self.handle, args=(conn,), daemon=True).start() 	# One Thread per Job
+
+	def handle(self, conn): 															# Run one Job for a Stage Worker
+		try:
+			jobfile = conn.recv() 														# Job File Path
+			worker  = self.idle.get() 													# Wait for an Idle Worker
+			start   = t0.time() 														# Job Start
+			try:
+				reply = {'exit_code': worker.run(jobfile, self.timeout)} 				# Run Job
+			except Exception as e: 														# Timeout or Worker Exited
+				reply = {'error': str(e)}
+				with self.lock:
+					self.stats['timeouts'] += isinstance(e, TimeoutError)
+			finally:
+				self.idle.put(worker) 													# Worker Idle Again
+			with self.lock: 															# Update Statistics
+				self.stats['jobs']    += 1
+				self.stats['seconds'] += t0.time() - start
+			conn.send(reply) 															# Reply to Stage Worker
+		except Exception as e: 															# Broken Connection - Ignore
+			pass
+		finally:
+			conn.close()
+
+	def close(self): 																	# Stop Listening and Workers
+		self.listener.close() 															# Close Socket
+		for worker in self.workers: 													# Iterate over Workers
+			worker.close() 																# Stop Worker
+
+class PoolExecutor(): 																	# Send Jobs to a WorkerPool
+	'''
+	- 1. Description:
+		- Runs Osprey job files on the WorkerPool of the main process. Only the
+		    address and authentication key are kept, so the executor can be sent
+		    to the stage worker processes (i.e. within misc).
+
+	- 2. Inputs:
+		- address  : (Tuple ) Host and port of the WorkerPool
+		- authkey  : (Bytes ) Authentication key of the WorkerPool
+	'''
+
+	def __init__(self, address, authkey):
+
+		self.address = address 															# Pool Address
+		self.authkey = authkey 															# Authentication Key
+
+	def run(self, jobfile): 															# Run a Job File
+		'''
+		- 1. Description:
+			- Run a single Osprey job file on the next idle pool worker.
+
+		- 2. Inputs:
+			- jobfile  : (String) Osprey Job File Path
+
+		- 3. Outputs:
+			- exit_code: (Int   ) Exit code of the job (TimeoutError if it timed out)
+		'''
+
+		conn = Client(self.address, authkey=self.authkey) 								# Connect to Pool
+		try:
+			conn.send(jobfile) 															# Send Job File
+			reply = conn.recv() 														# Wait for Reply
+		finally:
+			conn.close()
+
+		if 'error' in reply: 															# Job Failed in the Pool
+			if 'timed out' in reply['error']:
+				raise TimeoutError(reply['error'])
+			raise RuntimeError(reply['error'])
+		return reply['exit_code']
@@ -0,0 +1,239 @@
+from datetime import datetime 															# Date and Time
+import sqlite3 																			# Ledger Database
+import csv 																				# Participant Log CSV
+import os 																				# Operating System
+
+class ParticipantLedger(): 																# Indexed Participant Log
+	'''
+	- 1. Description:
+		- Maintains the record of Subjects and Sessions that have been found
+		    (and analyzed) in a SQLite database next to the Participant Log File
+		    (participant_log.csv). Every subject/session is recorded once with a
+		    status and the last stage that was run. The (Subject, Session) keys
+		    are held in memory as a set, so checking for new sessions and adding
+		    them costs O(new sessions) instead of re-reading and re-writing the
+		    whole Participant Log File on every trigger.
+
+		  Note: The Participant Log File is kept for backward compatibility.
+		    New sessions are appended to it in the same format (Date, Directory,
+		    Subject, Session). If the Participant Log File exists but the ledger
+		    does not (i.e. first run after updating), the ledger is populated
+		    from the Participant Log File.
+
+	- 2. Inputs:
+		- dbfile   : (String) Ledger Database Path (participant_log.db)
+		- partfile : (String) Participant File Path (participant_log.csv)
+	'''
+
+	datefmt  = '%m/%d/%Y %I:%M:%S %p' 													# Date/Time Specific Formatting
+	columns  = ['Date', 'Directory', 'Subject', 'Session'] 								# Participant Log File Columns
+
+	def __init__(self, dbfile, partfile=None):
+
+		self.dbfile   = dbfile 															# Ledger Database Path
+		self.partfile = partfile 														# Participant Log File Path
+		self.db       = sqlite3.connect(dbfile, timeout=60) 							# Open Ledger
+		self.db.execute('''CREATE TABLE IF NOT EXISTS participants (
+							Subject   TEXT NOT NULL,
+							Session   TEXT NOT NULL,
+							Directory TEXT,
+							Date      TEXT,
+							Status    TEXT,
+							Stage     TEXT,
+							Updated   TEXT,
+							PRIMARY KEY (Subject, Session))''') 						# Participant Table
+		self.db.execute('''CREATE TABLE IF NOT EXISTS checkpoints (
+							Subject   TEXT NOT NULL,
+							Session   TEXT NOT NULL,
+							Stage     TEXT NOT NULL,
+							Status    TEXT,
+							Start     TEXT,
+							End       TEXT,
+							ExitCode  INTEGER,
+							PRIMARY KEY (Subject, Session, Stage))''') 					# Stage Checkpoint Table
+		self.db.commit()
+
+		self.index    = set(self.db.execute('SELECT Subject, Session FROM participants')) # In-Memory Hash Index
+
+		if len(self.index) == 0 and partfile is not None and os.path.exists(partfile): 	# Migrate Participant Log File
+			self.import_csv(partfile)
+
+	def __contains__(self, key): 														# (Subject, Session) in Ledger
+		return tuple(key) in self.index
+
+	def __len__(self): 																	# Number of Sessions
+		return len(self.index)
+
+	def close(self): 																	# Close Ledger
+		self.db.close()
+
+	def import_csv(self, partfile): 													# Populate Ledger from Participant Log File
+		'''
+		- 1. Description:
+			- Records all subjects/sessions of an existing Participant Log File
+			    in the ledger with the status 'logged'.
+
+		- 2. Inputs:
+			- partfile : (String) Participant File Path (Record of Subjects and Sessions).
+		'''
+
+		rows = [] 																		# Rows to Insert
+		with open(partfile, 'r', newline='') as f: 										# Read Participant Log File
+			for row in csv.DictReader(f): 												# Iterate over Rows
+				key = (row['Subject'], row['Session']) 									# Subject and Session
+				if key in self.index: 													# Duplicate Row
+					continue
+				self.index.add(key) 													# Add to Index
+				rows.append((row['Subject'], row['Session'], row['Directory'], row['Date'], 'logged', None, row['Date']))
+
+		self.db.executemany('INSERT OR IGNORE INTO participants VALUES (?,?,?,?,?,?,?)', rows) # Insert Rows
+		self.db.commit()
+
+	def add(self, basedir, combined): 													# Record New Subjects/Sessions
+		'''
+		- 1. Description:
+			- Records every subject/session that is not yet in the ledger and
+			    appends them to the Participant Log File.
+
+		- 2. Inputs:
+			- basedir  : (String) Base Directory where raw and bids can be found.
+			- combined : (List  ) List of (Subject, Session) tuples found in raw.
+
+		- 3. Outputs:
+			- new_subs : (Dict  ) New Subjects (keys) and list of new Sessions (values)
+		'''
+
+		now      = datetime.now().strftime(self.datefmt) 								# Current Date/Time
+		new_subs = {} 																	# New Subjects and Sessions
+		rows     = [] 																	# Rows to Insert
+
+		for subject, session in combined: 												# Iterate over Subjects and Sessions
+			if (subject, session) in self.index: 										# Previously Recorded
+				continue
+
+			self.index.add((subject, session)) 											# Add to Index
+			rows.append((subject, session, basedir, now, 'new', None, now)) 			# Ledger Row
+			new_subs.setdefault(subject, []).append(session) 							# New Subject/Session
+
+		if len(rows) > 0: 																# Found New Sessions
+			self.db.executemany('INSERT OR IGNORE INTO participants VALUES (?,?,?,?,?,?,?)', rows)
+			self.db.commit()
+
+			if self.partfile is not None: 												# Maintain Participant Log File
+				if os.path.exists(self.partfile): 										# Append New Sessions
+					self.append_csv(self.partfile, rows, len(self.index) - len(rows))
+				else: 																	# Participant Log File Missing
+					self.export_csv(self.partfile)
+
+		return new_subs
+
+	def set_status(self, subject, session, status, stage=None): 						# Update Session Status
+		'''
+		- 1. Description:
+			- Update the status (i.e. new, queued, success, failed) and last
+			    stage of a subject/session.
+
+		- 2. Inputs:
+			- subject  : (String) Subject
+			- session  : (String) Session
+			- status   : (String) Status
+			- stage    : (String) Last stage that was run
+		'''
+
+		now = datetime.now().strftime(self.datefmt) 									# Current Date/Time
+		self.db.execute('UPDATE participants SET Status = ?, Stage = ?, Updated = ? WHERE Subject = ? AND Session = ?',
+						(status, stage, now, subject, session))
+		self.db.commit()
+
+	def sessions(self, exclude=()): 													# All Recorded Sessions (Except Statuses in exclude)
+		return [(subject, session) for subject, session, status in
+				self.db.execute('SELECT Subject, Session, Status FROM participants ORDER BY rowid')
+				if status not in exclude]
+
+	def status(self, subject, session): 												# Session Status
+		row = self.db.execute('SELECT Status, Stage FROM participants WHERE Subject = ? AND Session = ?',
+							  (subject, session)).fetchone()
+		return row if row is not None else (None, None)
+
+	def checkpoint(self, subject, session, stage, status, start=None, end=None, exit_code=None): # Record Stage Checkpoint
+		'''
+		- 1. Description:
+			- Record the status (running, success, failed) of a single stage of
+			    a subject/session with its start/end time and the exit code of
+			    the external tool (if any). A stage has one checkpoint, which is
+			    replaced every time the stage runs.
+
+		- 2. Inputs:
+			- subject  : (String) Subject
+			- session  : (String) Session
+			- stage    : (String) Stage name
+			- status   : (String) Status
+			- start    : (String) Start Date/Time
+			- end      : (String) End Date/Time
+			- exit_code: (Int   ) Exit code of the external tool
+		'''
+
+		self.db.execute('INSERT OR REPLACE INTO checkpoints VALUES (?,?,?,?,?,?,?)',
+						(subject, session, stage, status, start, end, exit_code))
+		self.db.commit()
+
+	def checkpoints(self, subject, session): 											# Stage Checkpoints of a Session
+		rows = self.db.execute('SELECT Stage, Status, Start, End, ExitCode FROM checkpoints WHERE Subject = ? AND Session = ?',
+							   (subject, session))
+		return {row[0]: tuple(row[1:]) for row in rows}
+
+	def resume_stage(self, subject, session, stages): 									# First Unfinished Stage
+		'''
+		- 1. Description:
+			- Determine where an interrupted or failed subject/session has to
+			    continue: the first stage (in order) without a successful
+			    checkpoint. Stages left 'running' (i.e. the machine rebooted
+			    during the stage) count as unfinished.
+
+		- 2. Inputs:
+			- subject  : (String) Subject
+			- session  : (String) Session
+			- stages   : (List  ) Ordered stage names
+
+		- 3. Outputs:
+			- stage    : (String) First unfinished stage (None if all succeeded)
+		'''
+
+		checkpoints = self.checkpoints(subject, session) 								# Stage Checkpoints
+		for stage in stages: 															# Iterate over Stages in Order
+			if checkpoints.get(stage, (None,))[0] != 'success': 						# Not Finished
+				return stage
+		return None
+
+	def append_csv(self, partfile, rows, nrows): 										# Append Rows to Participant Log File
+		'''
+		- 1. Description:
+			- Appends ledger rows to the Participant Log File without re-writing it.
+
+		- 2. Inputs:
+			- partfile : (String) Participant File Path (Record of Subjects and Sessions).
+			- rows     : (List  ) Ledger rows to append
+			- nrows    : (Int   ) Number of rows already in the Participant Log File
+		'''
+
+		with open(partfile, 'a', newline='') as f: 										# Append to Participant Log File
+			writer = csv.writer(f) 														# CSV Writer
+			for ii, row in enumerate(rows): 											# Iterate over New Rows
+				writer.writerow([nrows + ii, row[3], row[2], row[0], row[1]]) 			# Index, Date, Directory, Subject, Session
+
+	def export_csv(self, partfile): 													# Write Participant Log File
+		'''
+		- 1. Description:
+			- Writes the whole ledger as a Participant Log File (.csv) in the
+			    original format (Date, Directory, Subject, Session).
+
+		- 2. Inputs:
+			- partfile : (String) Participant File Path (Record of Subjects and Sessions).
+		'''
+
+		rows = self.db.execute('SELECT Date, Directory, Subject, Session FROM participants ORDER BY rowid')
+		with open(partfile, 'w', newline='') as f: 										# Create Participant Log File
+			writer = csv.writer(f) 														# CSV Writer
+			writer.writerow([''] + self.columns) 										# Header (Index Column is Unnamed)
+			for ii, row in enumerate(rows): 											# Iterate over Ledger
+				writer.writerow([ii] + list(row)) 										# Index, Date, Directory, Subject, Session
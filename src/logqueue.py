@@ -0,0 +1,161 @@
+from logging.handlers import QueueHandler, QueueListener 								# Queued Log Records
+from collections import OrderedDict 													# Open Files in Order of Use
+from datetime import datetime 															# Date and Time
+import multiprocessing 																	# Queue Shared with Worker Processes
+import logging 																			# Log Records
+import json 																			# JSON Lines
+import os 																				# Operating System
+
+queue   = None 																			# Log Queue of this Process (None = Write Files Directly)
+formats = ['text', 'json'] 																# Log File Formats
+
+def formatter(fmt='text'): 																# Log Line Format
+	if fmt == 'json': 																	# One JSON Object per Line
+		return JsonFormatter()
+	return logging.Formatter('(%(asctime)s) %(message)s', 								# Logging format (Time and Message)
+							 datefmt = '%m/%d/%Y %I:%M:%S %p') 							# Date/Time Specific Formatting
+
+def attach(log_queue): 																	# Use a Log Queue in this Process
+	'''
+	- 1. Description:
+		- Sends the logs of this process to log_queue (None = write log files
+		    directly). Used as initializer of the worker processes, so their
+		    subject logs are written by the listener of the main process.
+
+	- 2. Inputs:
+		- log_queue: (Queue ) Queue of a LogQueue (None = no queue)
+	'''
+
+	global queue
+	queue = log_queue
+
+class JsonFormatter(logging.Formatter): 												# JSON Lines Log Format
+	'''
+	- 1. Description:
+		- Formats a log record as one JSON object: time, level, log name, the
+		    fields of its handler (i.e. sub, ses and stage, see SessionHandler)
+		    and the message.
+	'''
+
+	def format(self, record):
+		line = {'time' : datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+				'level': record.levelname, 'log': record.name}
+		line.update(getattr(record, 'fields', {})) 										# Session Fields
+		line['message'] = record.getMessage()
+		return json.dumps(line)
+
+class SessionHandler(QueueHandler): 													# Queue Handler of one Log File
+	'''
+	- 1. Description:
+		- Puts the records of a log on the log queue instead of writing them,
+		    tagged with the log file they belong to and the fields of the log
+		    (i.e. {'sub': 'sub-01', 'ses': 'ses-01', 'stage': 'osprey_run'}).
+		    The message is formatted before it is queued, so the record no
+		    longer holds its arguments.
+
+	- 2. Inputs:
+		- log_queue: (Queue ) Queue of a LogQueue
+		- logfile  : (String) Log file path
+		- fields   : (Dict  ) Fields added to every record (JSON format)
+	'''
+
+	def __init__(self, log_queue, logfile, fields=None):
+
+		QueueHandler.__init__(self, log_queue)
+		self.logfile = logfile 															# Log File Path
+		self.fields  = dict(fields or {}) 												# Session Fields
+
+	def prepare(self, record): 															# Record as Queued
+		record = QueueHandler.prepare(self, record) 									# Message Formatted, no Arguments
+		record.logfile = self.logfile 													# Route to Log File
+		record.fields  = self.fields 													# Session Fields
+		return record
+
+	def close_file(self): 																# Ask the Listener to Close the Log File
+		self.enqueue(logging.makeLogRecord({'logfile': self.logfile, 'close_file': True}))
+
+class RoutingHandler(logging.Handler): 													# Writes Queued Records to their Log Files
+	'''
+	- 1. Description:
+		- Runs in the listener thread of a LogQueue and writes every record to
+		    its log file. Files are opened on their first record and kept open
+		    until their log is closed (SessionHandler.close_file), so a session
+		    opens its subject log once. At most max_open files are open at the
+		    same time; the file used least recently is closed first.
+
+	- 2. Inputs:
+		- fmt      : (String) Log file format (text or json)
+		- max_open : (Int   ) Log files open at the same time
+	'''
+
+	def __init__(self, fmt='text', max_open=64):
+
+		logging.Handler.__init__(self)
+		self.fmt      = fmt 															# Log File Format
+		self.max_open = max(1, max_open) 												# Open File Limit
+		self.files    = OrderedDict() 													# Log File -> FileHandler (Least Recent First)
+
+	def file_handler(self, logfile): 													# Open Handler of a Log File
+		handler = self.files.pop(logfile, None) 										# Already Open
+		if handler is None: 															# Open Log File
+			path    = logfile if self.fmt == 'text' else '{}.jsonl'.format(os.path.splitext(logfile)[0]) # JSON Lines next to the Text Log
+			handler = logging.FileHandler(path)
+			handler.setFormatter(formatter(self.fmt))
+		self.files[logfile] = handler 													# Most Recently Used
+		while len(self.files) > self.max_open: 											# Too many Open Files
+			self.files.popitem(last=False)[1].close() 									# Close Least Recently Used
+		return handler
+
+	def emit(self, record): 															# Write a Record
+		logfile = getattr(record, 'logfile', None) 										# Log File of Record
+		if logfile is None: 															# Not a Session Record
+			return
+		if getattr(record, 'close_file', False): 										# Log Closed
+			handler = self.files.pop(logfile, None)
+			if handler is not None:
+				handler.close()
+			return
+		self.file_handler(logfile).handle(record)
+
+	def close(self): 																	# Close every Log File
+		for handler in self.files.values():
+			handler.close()
+		self.files.clear()
+		logging.Handler.close(self)
+
+class LogQueue(): 																		# One Writer Thread for all Logs
+	'''
+	- 1. Description:
+		- Collects the log records of this process and of the worker processes
+		    (see attach) on one queue, and writes them to their log files from a
+		    single listener thread. Logging a line only puts a record on the
+		    queue, so slow (i.e. network) storage never holds up a stage.
+
+		  Note: Records still queued are written when the queue is stopped.
+
+	- 2. Inputs:
+		- fmt      : (String) Log file format (text or json)
+		- max_open : (Int   ) Log files open at the same time
+	'''
+
+	def __init__(self, fmt='text', max_open=64):
+
+		self.queue    = multiprocessing.Queue(-1) 										# Records of every Process
+		self.router   = RoutingHandler(fmt, max_open) 									# Writes Records to their Files
+		self.listener = QueueListener(self.queue, self.router) 							# Writer Thread
+
+	def __enter__(self):
+		return self.start()
+
+	def __exit__(self, *exc):
+		self.stop()
+
+	def start(self): 																	# Start Writer Thread
+		attach(self.queue) 																# Logs of this Process use the Queue
+		self.listener.start()
+		return self
+
+	def stop(self): 																	# Write Queued Records and Close Files
+		attach(None) 																	# Write Files Directly from now on
+		self.listener.stop()
+		self.router.close()
@@ -4,37 +4,61 @@ __email__   = 'agudmun2@jhmi.edu'
 __date__    = '2022/10/01'
 
 from datetime import date, datetime 													# Date and Time
-import pandas as pd 																	# DataFrames
-import numpy as np 																		# Numerical Operations
+from collections import OrderedDict 													# Ordered Dictionaries
 import time as t0 																		# Timer
+import signal 																			# Termination Signals
 import subprocess 																		# Run External Commands
+import shlex 																			# Split Scripts into Arguments
 import argparse 																		# Input Argument Parser
 import logging 																			# File Logging
 import glob 																			# File Matching
+import fnmatch 																			# Priority Patterns
 import copy 																			# Safely Copy Objects
 import json 																			# JSON Files
 import sys 																				# System Operations
 import os 																				# Operating System
 
-def setup_log(log_name, log_file, level=logging.INFO): 									# Create new global log file
+from scheduler import StageScheduler, lanes 											# Concurrent Subject/Session Stages
+from upload import UploadWatcher, StreamingWatcher 										# Upload Completion Detection
+from ledger import ParticipantLedger 													# Indexed Participant Log
+from scanner import RawScanner 															# Incremental Raw Directory Scanner
+from bidsindex import BidsIndex 														# BIDS Metadata Index
+from daemon import EventQueue, PipelineServer, send_paths 								# Daemon Mode
+import stagecache 																		# Stage Input Fingerprints
+import batching 																		# Batched Osprey Jobs
+from executor import SubprocessExecutor, WorkerPool 									# Osprey Executors
+import metrics 																			# Stage Timing and Resource Metrics
+import dicomsorter 																		# Built-in Dicom Sorter
+import results 																			# Study-Wide Results Store
+import qastats 																			# Streaming QA Statistics
+import logqueue 																		# Queued Log Writing
+from basissets import BasisRegistry 													# Basis Set Selection
+import preflight 																		# Pre-Flight QC of MRS Data
+import preprocess 																		# Coil Combination, Alignment and Averaging
+
+def setup_log(log_name, log_file, level=logging.INFO, fields=None): 					# Create new global log file
 	'''
 	- 1. Description:
-		- Creates logfiles that will be appropriately handled globally
+		- Creates logfiles that will be appropriately handled globally. When 
+		    a log queue is running (see logqueue.LogQueue), records are put on
+		    the queue and written by its listener thread instead.
 	
 	- 2. Inputs:
 		- log_name : (String) Name of the log 
 		- log_file : (String) Filename of the log
 		- level    : (Func  ) Level to log (default to debug and info)
+		- fields   : (Dict  ) Fields of every record (i.e. sub, ses and stage 
+							    in JSON logs)
 
 	- 3. Outputs:
 		- logger   : (Logger) Global log object
 	'''
 
-	formatter = logging.Formatter('(%(asctime)s) %(message)s'       , 					# Logging format (Time and Message)
-								  datefmt = '%m/%d/%Y %I:%M:%S %p') 					# Date/Time Specific Formatting
-	
-	handler = logging.FileHandler(log_file)         									# Log Handler
-	handler.setFormatter(formatter)														# Log Formatting
+	if logqueue.queue is not None: 														# Queued - Written by Listener Thread
+		handler = logqueue.SessionHandler(logqueue.queue, log_file, fields) 			# Log Handler
+	else: 																				# Write File Directly
+		handler = logging.FileHandler(log_file)         								# Log Handler
+		handler.setFormatter(logqueue.formatter())										# Log Formatting
 
 	logger  = logging.getLogger(log_name) 												# Instantiate Logger
 	logger.setLevel(level) 																# Set Log Level
@@ -42,7 +66,27 @@ def setup_log(log_name, log_file, level=logging.INFO): 									# Create new glo
 
 	return logger 																		# Return Logger Object
 
-def create_subjdict(basedir): 															# Subject Dictionary
+def close_log(logger, release=True): 													# Detach and Close Log Handlers
+	'''
+	- 1. Description:
+		- Removes and closes every handler of a log so that file descriptors
+		    do not accumulate when many subject logs are opened by one process.
+		    Queued logs are only detached, and their file is closed by the 
+		    listener once its records are written (unless release is False, 
+		    i.e. between the stages of a session).
+
+	- 2. Inputs:
+		- logger   : (Logger) Log object to close
+		- release  : (Bool  ) Close the log file of a queued log
+	'''
+
+	for handler in list(logger.handlers): 												# Iterate over Handlers
+		logger.removeHandler(handler) 													# Disconnect Handler
+		if isinstance(handler, logqueue.SessionHandler) and release == True: 			# Queued Log Finished
+			handler.close_file() 														# Listener Closes File
+		handler.close() 																# Close File
+
+def create_subjdict(basedir, scanner=None): 											# Subject Dictionary
 	''' 
 	1. Description:
 		- Populate dictionary with subjects (keys) and list of sessions (values) 
@@ -53,142 +97,99 @@ def create_subjdict(basedir): 															# Subject Dictionary
 		   Note: We could simply do a single glob.glob(*sub*ses*) statement, but 
 		     I'm not going to assume there will always be a session used. This 
 		     way we can Default to a ses-01 if no sessions are found.
+
+		   Note: The raw directory is scanned incrementally (see RawScanner). 
+		     Only subject directories that changed since the last scan are 
+		     listed again.
 	
 	2. Inputs:
 		- basedir  : (String) Base Directory where raw and bids can be found.
+		- scanner  : (Object) Raw Directory Scanner to reuse (Optional).
 
 	3. Outputs:
 		- subdict  : (Dict  ) Subjects and Sessions found upon running main.py. 
 		- combined : (List  ) List of strings ["sub_ses"] to determine new subjects 
 	'''
 
-	subdirs    = list(sorted(set(glob.glob('{}/raw/sub*'.format(basedir)) )))			# Subject Directories
-	subdict    = {} 																	# Subject Dictionary with Sessions
-	combined   = [] 																	# Combined Subject and Session
-
-	for ii in range(len(subdirs)):
-		subdirs[ii] = subdirs[ii].replace('\\', '/') 									# Forward Slashes
-		subject     = subdirs[ii].split('/')[-1]
-		sessions    = list(sorted(set(glob.glob('{}/ses*'.format(subdirs[ii]) ))))		# Subject Directories
+	if scanner is None: 																# No Scanner Given
+		scanner    = RawScanner('{}/raw'.format(basedir)) 								# Raw Directory Scanner (Loads Cache)
+	subdict, combined = scanner.scan() 													# Subjects and Sessions
 
-		subdict[subject] = [] 															# Create List of Sessions
-		if len(sessions) == 0: 															# No Session Specified
-			subdict[subject].append('ses-01')											# Default to ses-01
-			combined.append('{}_ses-01'.format(subject, ))
-
-		for jj in range(len(sessions)): 												# Iterate Over Sessions
-			sessions[jj]     = sessions[jj].replace('\\', '/') 							# Forward Slashes
-			session          = sessions[jj].split('/')[-1]								# Current Session
-
-			subdict[subject].append(session) 											# Populate Sessions 												
-			combined.append('{}_{}'.format(subject, session)) 							# Combined Subject and Session 
+	study_log.info('Scan      : %d subject(s), %d director(ies) visited in %.3f s', 	# Study Log - Scan Statistics
+				   scanner.stats['subjects'], scanner.stats['visited'], scanner.stats['seconds'])
 
 	return subdict, combined 															# 
 
-def create_partfile(basedir, partfile): 												# Create Participant Log File
+def update_partfile(basedir, ledger, scanner=None): 									# Update the Participant Log
 	'''
 	1. Description
-	    - Create a Participant Log File (.csv) which will maintains a list of 
-	    	Subjects and Sessions that have been previously analyzed. The 
-	    	Participant log file is created when new subjects or sessions are 
-	    	found during main.py execution. This file can be found at the study 
-	    	level where the bids and raw directories.
+	    - Update the Participant Ledger which maintains a list of Subjects and 
+	    	Sessions that have been previously analyzed. The ledger (and the 
+	    	Participant Log File (.csv) it maintains) is updated when new subjects 
+	    	or sessions are found during main.py execution. Both can be found in 
+	    	the raw directory of the study.
 	
 	2. Inputs:
 		- basedir  : (String) Base Directory where raw and bids can be found.
-		- partfile : (String) Participant File Path (Record of Subjects and Sessions).
+		- ledger   : (Ledger) Participant Ledger (Record of Subjects and Sessions).
+		- scanner  : (Object) Raw Directory Scanner to reuse (Optional).
 
 	3. Outputs:
-		- subdict  : Subjects and Sessions found upon running main.py. 
+		- new_subs : (Dict  ) New Subjects (keys) and list of new Sessions (values)
 	'''
 
-	study_log.info('Check     : Check Subjects/Update Study Log') 						# Study Log
-	subdict,_ = create_subjdict(basedir) 												# Get Subject Dictionary 							
-
-	df_date   = [] 																		# DataFrame Date/Time Information
-	df_base   = [] 																		# DataFrame Base Directory Information
-	df_subs   = [] 																		# DataFrame Subject Information
-	df_sess   = [] 																		# DataFrame Session Information	
-
-	subkeys   = list(subdict.keys()) 													# Subjects in Subject Dictionary
-	for ii in range(len(subkeys)): 			 											# Iterate Over Subjects										
-		for jj in range(len( subdict[subkeys[ii]] )): 									# Iterate over Sessions
-			
-			df_date.append(datetime.now().strftime('%m/%d/%Y %I:%M:%S %p')) 			# Add Date/Time
-			df_base.append( basedir) 													# Add Base Directory
-			df_subs.append( subkeys[ii]) 												# Add Subject
-			df_sess.append( subdict[subkeys[ii]][jj]) 									# Add Session
-
-	df        = pd.DataFrame({'Date'     : df_date, 									# DataFrame Date/Time
-							  'Directory': df_base, 									# DataFrame Base Directory
-							  'Subject'  : df_subs, 									# DataFrame Subjects
-							  'Session'  : df_sess})									# DataFrame Sessions
+	study_log.info('Update    : Updated Subject File') 									# Study Log 
+	_,combined = create_subjdict(basedir, scanner) 										# Get Combined Subject and Session Strings from Subject Dicionary		
 
-	df.to_csv(partfile) 																# DataFrame Create CSV
-	study_log.info('Check     : Created Subject File') 									# Subject File
+	combined   = [tuple(comb.split('_', 1)) for comb in combined] 						# Split into (Subject, Session)
+	new_subs   = ledger.add(basedir, combined) 											# Record New Subjects and Sessions
 
-	return subdict 	 					 												# Return Newly Added
+	study_log.info('Update    : Updated Subject File: Completed (%d new)', 				# Study Log 
+				   sum(len(sess) for sess in new_subs.values()))
+	return new_subs 	 					 											# Return Newly Added
 
-def update_partfile(basedir, partfile): 												# Update the Participant Log File
+def update_events(basedir, ledger, scanner, events): 									# Update the Participant Log from Events
 	'''
 	1. Description
-	    - Update the Participant Log File (.csv) which maintains a list of 
-	    	Subjects and Sessions that have been previously analyzed. The 
-	    	Participant log file is updated when new subjects or sessions are 
-	    	found during main.py execution. This file can be found at the study 
-	    	level where the bids and raw directories.
+	    - Update the Participant Ledger with the subjects/sessions named by 
+	    	watchman events (daemon mode). Only the subject directories named by
+	    	the events are listed, instead of scanning the whole raw directory.
 	
 	2. Inputs:
 		- basedir  : (String) Base Directory where raw and bids can be found.
-		- partfile : (String) Participant File Path (Record of Subjects and Sessions).
+		- ledger   : (Ledger) Participant Ledger (Record of Subjects and Sessions).
+		- scanner  : (Object) Raw Directory Scanner.
+		- events   : (Dict  ) Coalesced (Subject, Session) events (Session can be None)
 
 	3. Outputs:
-		- combined : List of strings ["sub_ses"] to determine new subjects 
+		- new_subs : (Dict  ) New Subjects (keys) and list of new Sessions (values)
 	'''
 
-	study_log.info('Update    : Updated Subject File') 									# Study Log 
-	_,combined = create_subjdict(basedir) 												# Get Combined Subject and Session Strings from Subject Dicionary		
-
-	df         = pd.read_csv(partfile) 													# Read in Current CSV Subject file
-	df['Comb'] = df.Subject + '_' + df.Session 											# Combined Name
-	df_dates   = list(df.Date.values     ) 												# Dates
-	df_base    = list(df.Directory.values) 												# Directory
-	df_subs    = list(df.Subject.values  ) 												# Subjects
-	df_sess    = list(df.Session.values  ) 												# Sessions
-	comb       = list(df.Comb.values     ) 												# Get Combined Subject and Sessions as list
-
-	new_subs   = {} 																	# Find New Subjects
+	combined   = [] 																	# Subjects and Sessions Named by Events
+	for subject, session in events: 													# Iterate over Events
+		if session is not None and (subject, session) in ledger: 						# Known Session - Nothing to Do
+			continue
+		for ses in scanner.scan_subject(subject): 										# List Subject Directory Once
+			combined.append((subject, ses)) 											# Subject and Session
 
-	for ii in range(len(combined)): 													# Iterate Over All Subjects
-		if combined[ii] not in comb: 													# Current Subject is not in the Subject File
-
-			subject = combined[ii].split('_')[0] 										# Get New Subject
-			session = combined[ii].split('_')[1] 										# Get New Session
-
-			df_dates.append(datetime.now().strftime('%m/%d/%Y %I:%M:%S %p')) 			# Add Date/Time
-			df_base.append( basedir) 													# Base Directory
-			df_subs.append( subject) 													# Add Subject
-			df_sess.append( session) 													# Add Session
-
-			if subject not in list(new_subs.keys()): 									# Subject Not Yet included in new_subs
-				new_subs[subject] = [ session ] 										# Add Subject and Session
-			else: 																		# Subject Already in new_subs
-				new_subs[subject].append( session ) 									# Append Session
-
-	df        = pd.DataFrame({'Date'     : df_dates, 									# DataFrame Date/Time
-							  'Directory': df_base, 									# DataFrame Base Directory
-							  'Subject'  : df_subs, 									# DataFrame Subjects
-							  'Session'  : df_sess})									# DataFrame Sessions
-
-	df.to_csv(partfile) 																# DataFrame Create CSV
-
-	study_log.info('Update    : Updated Subject File: Completed') 						# Study Log 
+	new_subs   = ledger.add(basedir, list(OrderedDict.fromkeys(combined))) 				# Record New Subjects and Sessions
+	study_log.info('Events    : %d event(s), %d new session(s)', len(events), 			# Study Log 
+				   sum(len(sess) for sess in new_subs.values()))
 	return new_subs 	 					 											# Return Newly Added
 
+def script_args(script): 																# Popen Arguments of a Script
+	if os.name == 'nt': 																# Windows Splits the Script Itself
+		return script
+	return shlex.split(script) 															# Other Systems Need a List of Arguments
+
 def dicomsort(basedir, sub, ses, misc, success=True, debug=False):  					# Sort Subject Dicoms				
 	'''
 	- 1. Description:
-	    - The function sorts dicoms using the 3rd party software, dicomsort.py. 
+	    - The function sorts dicoms into folders named after a header tag 
+	        (misc['sort_scheme'], default {ScanningSequence}). By default the 
+	        built-in sorter is used (see dicomsorter), which reads only the 
+	        needed header tags on a thread pool. With misc['sorter'] set to 
+	        dicomsort, the 3rd party software, dicomsort.py, is called instead. 
 	        The dicomsort software can be found at the following link:
 	          https://github.com/pieper/dicomsort
 
@@ -221,17 +222,31 @@ def dicomsort(basedir, sub, ses, misc, success=True, debug=False):  					# Sort
 	if os.path.exists(subdir) == False:													# Determine if Session Information was Given
 		subdir = '{}/raw/{}'.format(basedir, sub) 										# No Session Information Provided
 
-	script  = 'dicomsort -f {{ScanningSequence}} "{}"'.format(subdir) 					# Script to Call
-	sub_log.info('%s %s dicomsort : %s', sub, ses, script) 								# Subject Log - Script to Call
+	scheme  = misc.get('sort_scheme', '{ScanningSequence}') 							# Folder Scheme
+	builtin = misc.get('sorter', 'builtin') == 'builtin' 								# Built-in Sorter or dicomsort
+	script  = 'dicomsort -f "{}" "{}"'.format(scheme, subdir) 							# Script to Call
+	if builtin == True: 																# Built-in Sorter
+		sub_log.info('%s %s dicomsort : built-in sorter -f %s (%d threads)', sub, ses, scheme, misc.get('sort_threads', 8)) # Subject Log - Sorter
+	else:
+		sub_log.info('%s %s dicomsort : %s', sub, ses, script) 							# Subject Log - Script to Call
 	
 	if debug == True: 																	# If Debug - Print to Screen
 		sub_log.info('%s %s dicomsort : debugging (Command Not run)', sub, ses) 		# Subject Log - dubugging
 		return success
 
 	try: 																				# Error Handling (Note subject fails and keep executing)
-		P       = subprocess.Popen(script, shell=False) 								# Run Script
-		P.wait() 																		# Wait for Script Completion
+		if builtin == True: 															# Sort within this Process
+			cpu     = t0.process_time() 												# CPU Time Start
+			stats   = dicomsorter.sort_dicoms(subdir, scheme, misc.get('sort_link', False), misc.get('sort_threads', 8))
+			misc['exit_code'], misc['usage'] = 0, {'cpu': t0.process_time() - cpu} 		# Exit Code and Usage (as for dicomsort)
+			sub_log.info('%s %s dicomsort : sorted %d of %d dicom(s), %d unreadable, %.2f s (%.0f files/s)', sub, ses,
+						 stats['sorted'], stats['dicoms'], stats['unreadable'], stats['seconds'], stats['files_per_s']) # Subject Log - Throughput
+		else: 																			# Run dicomsort
+			P       = subprocess.Popen(script_args(script), shell=False) 				# Run Script
+			misc['exit_code'], misc['usage'] = metrics.wait(P) 							# Wait for Script Completion (Keep Exit Code and Usage)
+		success = misc['exit_code'] == 0 												# Non-Zero Exit Code - Failed
 	except Exception as e: 																# Error Handling
+		sub_log.info('%s %s Error: %s', sub, ses, e) 									# Subject Log - Error
 		success = False 																# Set Success
 
 	sub_log.info('%s %s dicomsort : success = %s', sub, ses, success) 					# Subject Log - Success
@@ -286,14 +301,81 @@ def bidscoin(basedir, sub, ses, misc, success=True, debug=False): 						# Bids-i
 		return success 																	# Debugging - Exit.
 
 	try:
-		P       = subprocess.Popen(script, shell=False)									# Run Script
-		P.wait() 																		# Wait for Script Completion
+		P       = subprocess.Popen(script_args(script), shell=False) 					# Run Script
+		misc['exit_code'], misc['usage'] = metrics.wait(P) 								# Wait for Script Completion (Keep Exit Code and Usage)
+		success = misc['exit_code'] == 0 												# Non-Zero Exit Code - Failed
 	except Exception as e: 																# Error Handling
 		success = False 																# Set Success
 
 	sub_log.info('%s %s bidscoin  : success = %s', sub, ses, success) 					# Subject Log - Base Directory
 	return success
 
+def bidscoin_batch(sessions, misc, success=True, debug=False): 							# Bids-ify Several Subjects at Once
+	'''
+	- 1. Description:
+	    - The function converts the raw data of several subjects with a single 
+	        bidscoiner call (-p sub-01 sub-02 ...), so the bidsmap, the plugins 
+	        and the raw directory are loaded once per batch instead of once per 
+	        subject. Afterwards, each session is successful if its BIDS 
+	        directory was written.
+
+	        Note: If bidscoiner fails, every session is converted again on its 
+	          own (see bidscoin), so a failure is attributed to the session that 
+	          caused it.
+
+	- 2. Inputs:
+		- sessions : (List  ) Base Directory, Subject, and Session of every session
+		- misc     : (Dict  ) Miscellaneous Objects that specific functions may need.
+		- success  : (Bool  ) Status of function call
+		- debug    : (Bool  ) Debugging mode - commands are not execeuted.
+
+	- 3. Outputs:
+		- success  : (List  ) Status of every session where True = Success and 
+							    False = Fail.
+	'''
+
+	global sub_log 																		# bidscoin uses the Subject Log
+
+	logs    = [logging.getLogger('{}_{}'.format(sub, ses)) for basedir, sub, ses in sessions] # Subject Logs (Opened by run_batch)
+	basedir = sessions[0][0] 															# Base Directory (Same Study)
+	subs    = sorted(set(sub for basedir, sub, ses in sessions)) 						# Subjects (Once Each)
+
+	bmap    = '{}/bids/code/bidscoin/bidsmap.yaml'.format(basedir)
+	script  = 'bidscoiner -f "{}/raw" "{}/bids" -b "{}" -p {}'.format(basedir, basedir, bmap, ' '.join(subs)) # Script to Call
+
+	for (basedir, sub, ses), log in zip(sessions, logs): 								# Iterate over Sessions
+		log.info('%s %s bidscoin  :', sub, ses) 										# Subject Log - bidscoin function
+		log.info('%s %s bidscoin  : Starting (batch of %d subject(s))', sub, ses, len(subs)) # Subject Log - bidscoin Starting
+		log.info('%s %s bidscoin  : bidscoiner -f $raw $bids -b $bmap -p %s', sub, ses, ' '.join(subs)) # Subject Log - bidscoin command
+
+	if debug == True: 																	# If Debug - Print to Screen
+		return [success] * len(sessions) 												# Debugging - Exit.
+
+	try:
+		P       = subprocess.Popen(script_args(script), shell=False) 					# Run Script
+		misc['exit_code'], misc['usage'] = metrics.wait(P) 								# Wait for Script Completion (Keep Exit Code and Usage)
+		success = misc['exit_code'] == 0 												# Non-Zero Exit Code - Failed
+	except Exception as e: 																# Error Handling
+		for (basedir, sub, ses), log in zip(sessions, logs): 							# Iterate over Sessions
+			log.info('%s %s Error: %s', sub, ses, e) 									# Subject Log - Error
+		success = False 																# Set Success
+
+	results = [] 																		# Success of every Session
+	for (basedir, sub, ses), log in zip(sessions, logs): 								# Iterate over Sessions
+		if success == False: 															# Batch Failed - Convert Session on its own
+			log.info('%s %s bidscoin  : batch failed, converting on its own', sub, ses) # Subject Log - Not Batched
+			sub_log = log 																# Subject Log of Session
+			results.append(bidscoin(basedir, sub, ses, misc, debug=debug)) 				# Run bidscoiner
+			continue
+		ses_dir = stagecache.bids_dir(basedir, sub, ses) 								# BIDS Session Directory
+		written = os.path.isdir(ses_dir) and len(os.listdir(ses_dir)) > 0 				# Session Converted
+		log.info('%s %s bidscoin  : success = %s', sub, ses, written) 					# Subject Log - Success
+		results.append(written)
+	return results
+
+def bidscoin_batch_key(session, misc): 													# Batch Key of a bidscoin Session
+	return session[0] 																	# Same Study (Same Bidsmap)
+
 def osprey_job(basedir, sub, ses, misc, success=True, debug=False): 					# Create Osprey Job
 	'''
 	- 1. Description:
@@ -339,13 +421,18 @@ def osprey_job(basedir, sub, ses, misc, success=True, debug=False): 					# Creat
 	if os.path.exists(out_dir) == False: 												# Session Directory not yet created
 		os.mkdir(out_dir)  																# Create Session Directory in Derivatives/Subject
 
+	index     = BidsIndex(bids_dir) 													# BIDS Metadata Index
+	index.update([sub]) 																# Index Subject Converted by bidscoin
+
 	ses_dir   = '{}/bids/{}/{}'.format(basedir, sub, ses)            	 				# Session Directory
-	if os.path.exists(ses_dir) == False:                                                # Check Session Exists (Otherwise use Subject Directory)
+	ses_      = ses 																	# Session in the Index
+	if ses not in index.sessions(sub):                                                	# Check Session Exists (Otherwise use Subject Directory)
 		ses_dir = sub_dir                                                               # No Session - Use Subject Directory
+		ses_    = '' 																	# Sessionless Subject
 
-	mrs_dir   = '{}/mrs'.format(ses_dir) 												# MRS Data Directory
-	if os.path.exists(mrs_dir) == False: 												# Was MRS generated or a different name?
-		mrs_dir = '{}/extra_data'.format(ses_dir)
+	mrs_type  = 'mrs' 																	# MRS Data Directory
+	if os.path.exists('{}/mrs'.format(ses_dir)) == False: 								# Was MRS generated or a different name?
+		mrs_type = 'extra_data'
 
 	emailpath = '{}/EmailConfig.json'.format(src_dir)
 	with open(emailpath, 'r') as f:	 													# Create new JSON file
@@ -353,9 +440,10 @@ def osprey_job(basedir, sub, ses, misc, success=True, debug=False): 					# Creat
 		email = email['SourceEmail']
 
 	anat_dict = {}                                                                      # Anatomical (T1w) Scans Dictionary
-	anat      = glob.glob('{}/anat/*T1w.ni*'.format(ses_dir))                       	# Find Anatomical Scans
+	anat      = index.files(sub, ses_, 'anat', pattern='*T1w.ni*') 						# Find Anatomical Scans
 
 	if len(anat) == 0:                                                                  # No Anatomical Scans Found
+		index.close() 																	# Close Index
 		sub_log.info('%s %s osprey job: No T1w image found', sub, ses) 					# Subject Log - Note Missing Anatomical 
 		sub_log.info('%s %s osprey job: Sucess = False', sub, ses) 						# Subject Log - Set Success to False
 		return False 																	# Return Success as False
@@ -375,11 +463,11 @@ def osprey_job(basedir, sub, ses, misc, success=True, debug=False): 					# Creat
 		seq_dict['files_ref'] = []              										# Create new Key as files_ref
 
 		scans = master_settings['prerequisites']['files'] 								# Scan Pattern to Match
-		scans = glob.glob('{}/{}'.format(mrs_dir, scans)) 								# Grab Scan File Names
+		scans = index.files(sub, ses_, mrs_type, pattern=scans) 						# Grab Scan File Names
 		scans = list(sorted(set(scans))) 												# Sort Scan Files
 
 		refs  = master_settings['prerequisites']['files_ref'] 							# Ref Pattern to Match
-		refs  = glob.glob('{}/{}'.format(mrs_dir, refs)) 								# Grab Ref File Names
+		refs  = index.files(sub, ses_, mrs_type, pattern=refs) 							# Grab Ref File Names
 		refs  = list(sorted(set(refs))) 												# Sort Ref Files
 
 		jsons = []	 																	# Corresponding json file
@@ -397,6 +485,13 @@ def osprey_job(basedir, sub, ses, misc, success=True, debug=False): 					# Creat
 			seq_dict['files'    ].append(scans[ii])                       				# Match Runs Scan
 			seq_dict['files_ref'].append(refs[ ii])                       				# Match Runs Reference
 
+		if misc.get('basis_dir') and 'basisSet' not in seq_dict and len(scans) > 0: 	# Select Basis Set from Sidecar
+			registry = BasisRegistry(misc['basis_dir']) 								# Indexed Basis Set Tree
+			entry    = registry.select(index.sidecar(scans[0]) or {}) 					# Field, Vendor, Editing, Localisation, TE
+			if entry is not None: 														# Basis Set Found
+				seq_dict['basisSet'] = registry.path(entry, 'mat' if 'mat' in entry else 'basis') # Osprey .mat (or LCModel .BASIS)
+			sub_log.info('%s %s osprey job: basis set %s', sub, ses, seq_dict.get('basisSet', 'not found (Osprey default)')) # Subject Log - Basis Set
+
 		seq_dict[        'files_nii'] = anat 											# Add in Anatomical
 		seq_dict[     'outputFolder'] = [out_dir] 										# Add Output Directory
 		seq_dict[     'mailtoConfig'] = emailpath 										# Automatic emailing
@@ -415,10 +510,176 @@ def osprey_job(basedir, sub, ses, misc, success=True, debug=False): 					# Creat
 		sub_log.info('%s %s Error: %s', sub, ses, e) 									# Subject Log - Success
 		success = False		 															# Return False
 
+	index.close() 																		# Close Index
 	sub_log.info('%s %s osprey job: success = %s', sub, ses, success) 					# Subject Log - Success
 
 	return success 																		# True = Success; False = Failed
 
+def osprey_env(): 																		# Environment for OspreyCMD
+	my_env    = os.environ.copy()
+	if os.name != 'nt': 																# Matlab Runtime Paths below are Windows Paths
+		return my_env
+	my_env['PATH'] ='C:\\Program Files\\MATLAB\\MATLAB_Runtime\\v912;'     +my_env['PATH']  # Add Matlab Runtime to Path
+	my_env['PATH'] ='C:\\Program Files\\MATLAB\\MATLAB_Runtime\\v912\\bin;' +my_env['PATH'] # Add Matlab Runtime's bin to Path
+	my_env['PATH'] ='C:\\Program Files\\MATLAB\\MATLAB_Runtime\\v912\\runtime\\win64;' +my_env['PATH'] # Add Matlab Runtime's bin to Path
+	return my_env
+
+def osprey_executor(misc): 																# How Osprey Jobs are Run
+	'''
+	- 1. Description:
+		- Returns the executor that runs Osprey job files: the executor given 
+		    in misc['executor'] (i.e. a PoolExecutor of the warm WorkerPool), 
+		    otherwise a new OspreyCMD process per job (SubprocessExecutor).
+		    Executors provide run(jobfile), which returns the exit code.
+
+	- 2. Inputs:
+		- misc     : (Dict  ) Miscellaneous Objects that specific functions may need.
+
+	- 3. Outputs:
+		- executor : (Object) Osprey Executor
+	'''
+
+	if misc.get('executor') is not None: 												# Executor Given (i.e. Warm Worker Pool)
+		return misc['executor']
+	return SubprocessExecutor(cwd=misc['osp_path'], env=osprey_env(), timeout=misc.get('osp_timeout'))
+
+def osprey_qc(basedir, sub, ses, misc, success=True, debug=False): 						# Pre-Flight QC before Osprey
+	'''
+	- 1. Description:
+	    - The function checks every scan/reference pair of the Osprey job 
+	        before Osprey runs (see preflight.check_pair): usable transients, 
+	        NAA SNR, water linewidth, frequency drift and the water peak of 
+	        the scan relative to its reference (water-only or swapped pairs). 
+	        The NIfTI-MRS data is memory-mapped (or decompressed once) and 
+	        every transient is processed at once, so a session takes well 
+	        under a second. The metrics of every run are logged.
+	    - A run outside the thresholds (misc['qc'], see --qc) fails the 
+	        session before osprey_run when misc['qc_action'] is skip, or is 
+	        logged as flagged and processed anyway when it is flag.
+
+	- 2. Inputs:
+		- basedir  : (String) Base Directory where raw and bids can be found.
+		- sub      : (String) Current Subject as string
+		- ses      : (String) Current Subject's Session as string
+		- misc     : (Dict  ) Miscellaneous Objects that specific functions may need.
+		- success  : (Bool  ) Status of function call
+		- debug    : (Bool  ) Debugging mode - commands are not execeuted.
+
+	- 3. Outputs:
+		- success  : (Bool  ) Status of function call where True = Success and 
+							    False = Fail.
+	'''
+
+	jobfile = osprey_job_file(basedir, sub, ses) 										# Osprey Job File
+	action  = misc.get('qc_action', 'skip') 											# Skip or Flag Failed Runs
+	sub_log.info('%s %s osprey qc :', sub, ses) 										# Subject Log - qc function
+	sub_log.info('%s %s osprey qc : %s (action = %s)', sub, ses, jobfile, action) 		# Subject Log - Job File
+
+	if debug == True: 																	# If Debug - Print to Screen
+		return success 																	# Debugging - Exit.
+
+	with open(jobfile, 'r') as f: 														# Read Job File
+		job   = json.loads(f.read()) 													# Osprey Job
+	scans   = job.get('files_raw', job.get('files', [])) 								# Metabolite Data (Original if Preprocessed)
+	refs    = job.get('files_ref_raw', job.get('files_ref', [])) 						# Water References (Same Order)
+
+	failed  = 0 																		# Runs outside Thresholds
+	for ii in range(len(scans)): 														# Iterate over Runs
+		ref = refs[ii] if ii < len(refs) else None 										# Reference of Run (if any)
+		try:
+			qc, failures = preflight.check_pair(scans[ii], ref, misc.get('qc')) 		# Pre-Flight Metrics
+		except (OSError, ValueError) as e: 												# Unreadable Data (i.e. Truncated Upload)
+			qc, failures = {}, ['unreadable data ({})'.format(e)]
+		sub_log.info('%s %s osprey qc : run-%02d snr %s, fwhm %s Hz, naa fwhm %s Hz, drift %s Hz, transients %s/%s, water %s', # Subject Log - Metrics
+					 sub, ses, ii+1, qc.get('snr'), qc.get('fwhm_hz'), qc.get('naa_fwhm_hz'), qc.get('drift_hz'),
+					 qc.get('usable'), qc.get('transients'), qc.get('water'))
+		if len(failures) > 0: 															# Outside Thresholds
+			failed += 1
+			sub_log.warning('%s %s osprey qc : run-%02d QC %s: %s', sub, ses, ii+1, 	# Subject Log - Failed Checks
+							'FAILED' if action == 'skip' else 'FLAGGED', '; '.join(failures))
+
+	success = failed == 0 or action == 'flag' 											# Skip Osprey for Failed Runs
+	sub_log.info('%s %s osprey qc : %d of %d run(s) failed, success = %s', sub, ses, failed, len(scans), success) # Subject Log - Success
+	return success
+
+def osprey_prep(basedir, sub, ses, misc, success=True, debug=False): 					# Preprocess MRS Data for Osprey
+	'''
+	- 1. Description:
+	    - With misc['preprocess'] (see --preprocess), the function reduces 
+	        every scan and reference of the Osprey job to a single FID before 
+	        Osprey runs (see preprocess.reduce_pair): coils are combined with 
+	        the weights of the water reference, and all transients are aligned 
+	        in frequency and phase (spectral registration) and averaged at once 
+	        with NumPy. The reduced NIfTI-MRS files are written to reduced/ in 
+	        the session derivatives, and files/files_ref of the job file point 
+	        at them. The original paths are kept as files_raw/files_ref_raw.
+	    - Without misc['preprocess'], a job file that was preprocessed before 
+	        points at the original data again.
+
+	        Note: Edited data (i.e. MEGA) keeps its original files, since its 
+	          subspectra must not be averaged together.
+
+	- 2. Inputs:
+		- basedir  : (String) Base Directory where raw and bids can be found.
+		- sub      : (String) Current Subject as string
+		- ses      : (String) Current Subject's Session as string
+		- misc     : (Dict  ) Miscellaneous Objects that specific functions may need.
+		- success  : (Bool  ) Status of function call
+		- debug    : (Bool  ) Debugging mode - commands are not execeuted.
+
+	- 3. Outputs:
+		- success  : (Bool  ) Status of function call where True = Success and 
+							    False = Fail.
+	'''
+
+	jobfile = osprey_job_file(basedir, sub, ses) 										# Osprey Job File
+	outdir  = '{}/reduced'.format(stagecache.output_dir('osprey_prep', basedir, sub, ses)) # Reduced Data Directory
+	sub_log.info('%s %s osprey prep:', sub, ses) 										# Subject Log - prep function
+	sub_log.info('%s %s osprey prep: %s (preprocess = %s)', sub, ses, jobfile, misc.get('preprocess', False)) # Subject Log - Job File
+
+	if debug == True: 																	# If Debug - Print to Screen
+		return success 																	# Debugging - Exit.
+
+	with open(jobfile, 'r') as f: 														# Read Job File
+		job   = json.loads(f.read()) 													# Osprey Job
+	scans   = job.get('files_raw', job.get('files', [])) 								# Original Metabolite Data
+	refs    = job.get('files_ref_raw', job.get('files_ref', [])) 						# Original Water References
+
+	if misc.get('preprocess', False) == False: 											# Osprey Preprocesses
+		if 'files_raw' not in job: 														# Job Points at Original Data
+			return success
+		job['files'] = job.pop('files_raw') 											# Original Data Again
+		if 'files_ref_raw' in job:
+			job['files_ref'] = job.pop('files_ref_raw')
+		sub_log.info('%s %s osprey prep: job points at the original data again', sub, ses) # Subject Log - Restored
+	else: 																				# Reduce Data
+		files, files_ref = [], [] 														# Reduced Data
+		for ii in range(len(scans)): 													# Iterate over Runs
+			ref = refs[ii] if ii < len(refs) else None 									# Reference of Run (if any)
+			paths, infos = preprocess.reduce_pair(scans[ii], ref, outdir) 				# Combine, Align and Average
+			for path, info in zip(paths, infos): 										# Subject Log - Reduced Files
+				if info['reduced'] == False: 											# Original Data Kept
+					sub_log.info('%s %s osprey prep: run-%02d %s kept (not coils/transients only)', sub, ses, ii+1, path.split('/')[-1])
+					continue
+				sub_log.info('%s %s osprey prep: run-%02d %s %d of %d transients, largest shift %.2f Hz', sub, ses, ii+1,
+							 path.split('/')[-1], info['averages'], info['transients'], info['shift_hz'])
+			files.append(paths[0])
+			if ref is not None:
+				files_ref.append(paths[1])
+
+		job['files_raw'] = scans 														# Keep Original Data
+		job['files']     = files 														# Reduced Data
+		if 'files_ref' in job: 															# References Given
+			job['files_ref_raw'] = refs
+			job['files_ref']     = files_ref
+
+	tmpfile = '{}.tmp'.format(jobfile) 													# Write to Temporary File First
+	with open(tmpfile, 'w') as f: 														# Osprey Job Write
+		f.write(json.dumps(job, indent = 4))
+	os.replace(tmpfile, jobfile) 														# Replace Job in one Step
+	sub_log.info('%s %s osprey prep: success = True', sub, ses) 						# Subject Log - Success
+	return True
+
 def osprey_run(basedir, sub, ses, misc, success=True, debug=False): 					# Create Osprey Job
 	'''
 	- 1. Description:
@@ -466,97 +727,854 @@ def osprey_run(basedir, sub, ses, misc, success=True, debug=False): 					# Creat
 		sub_log.info('%s %s osprey run: debugging (Command Not run)', sub, ses) 		# Subject Log - debugging
 		return success 																	# Debugging - Exit.
 
-	my_env    = os.environ.copy()
-	my_env['PATH'] ='C:\\Program Files\\MATLAB\\MATLAB_Runtime\\v912;'     +my_env['PATH']  # Add Matlab Runtime to Path
-	my_env['PATH'] ='C:\\Program Files\\MATLAB\\MATLAB_Runtime\\v912\\bin;' +my_env['PATH'] # Add Matlab Runtime's bin to Path
-	my_env['PATH'] ='C:\\Program Files\\MATLAB\\MATLAB_Runtime\\v912\\runtime\\win64;' +my_env['PATH'] # Add Matlab Runtime's bin to Path
+	executor  = osprey_executor(misc) 													# One-Shot OspreyCMD or Warm Worker Pool
 
 	try:
-		P       = subprocess.Popen(script, cwd=misc['osp_path'], shell=True, env=my_env)# Run Script
-		P.wait() 																		# Wait for Script Completion
+		misc['exit_code'] = executor.run(jobfile) 										# Run Job (Keep Exit Code)
+		misc['usage']     = getattr(executor, 'usage', {}) 								# Resource Usage (One-Shot OspreyCMD Only)
+		success = misc['exit_code'] == 0 												# Non-Zero Exit Code - Failed
 	except Exception as e: 																# Error Handling
+		sub_log.info('%s %s Error: %s', sub, ses, e) 									# Subject Log - Error (i.e. Timeout)
 		success = False 																# Set Success
 
 	sub_log.info('%s %s osprey run: success = %s', sub, ses, success) 					# Subject Log - Base Directory
 	return success
 
+def osprey_results(basedir, sub, ses, misc, success=True, debug=False): 				# Add Osprey Results to the Study Store
+	'''
+	- 1. Description:
+	    - The function adds the Osprey result tables of a session (i.e. 
+	        QuantifyResults and QM tables in bids/derivatives/sub/ses) to the 
+	        study-wide columnar results store in bids/derivatives/results (see 
+	        results.ResultsStore), partitioned by the session date. Earlier 
+	        rows of the session are replaced, so rerunning is safe.
+	    - Every numeric value of the tables is then compared with the running 
+	        statistics of the session's scanner/sequence group and added to 
+	        them (see qastats.OnlineStats). Values more than misc['qa_z'] 
+	        standard deviations from the group mean are logged as alerts in 
+	        the subject log and in {basedir}/qa_alerts.jsonl.
+
+	- 2. Inputs:
+		- basedir  : (String) Base Directory where raw and bids can be found.
+		- sub      : (String) Current Subject as string
+		- ses      : (String) Current Subject's Session as string
+		- misc     : (Dict  ) Miscellaneous Objects that specific functions may need.
+		- success  : (Bool  ) Status of function call
+		- debug    : (Bool  ) Debugging mode - commands are not execeuted.
+
+	- 3. Outputs:
+		- success  : (Bool  ) Status of function call where True = Success and 
+							    False = Fail.
+	'''
+
+	out_dir = stagecache.output_dir('osprey_results', basedir, sub, ses) 				# Osprey Derivatives of Session
+	sub_log.info('%s %s results   :', sub, ses) 										# Subject Log - results function
+	sub_log.info('%s %s results   : %s', sub, ses, out_dir) 							# Subject Log - Derivatives
+
+	if debug == True: 																	# If Debug - Print to Screen
+		return success 																	# Debugging - Exit.
+
+	tables  = results.session_tables(out_dir) if os.path.isdir(out_dir) else {} 		# Result Tables
+	if len(tables) == 0: 																# Osprey Wrote no Tables
+		sub_log.info('%s %s results   : no result tables found', sub, ses) 				# Subject Log - No Tables
+		sub_log.info('%s %s results   : success = False', sub, ses) 					# Subject Log - Success
+		return False
+
+	date    = results.session_date(stagecache.bids_dir(basedir, sub, ses), sub, ses) 	# Session Date (Partition)
+	store   = results.ResultsStore('{}/bids/derivatives/results'.format(basedir)) 		# Study Results Store
+	rows    = store.write_session(sub, ses, date, tables) 								# Add or Replace Session
+	sub_log.info('%s %s results   : %d row(s) of %d table(s), date %s (%s)', sub, ses, rows, len(tables), date, store.ext) # Subject Log - Rows Stored
+
+	index   = BidsIndex('{}/bids'.format(basedir)) 										# BIDS Metadata Index
+	index.update([sub]) 																# Index Subject (Usually Unchanged)
+	ses_    = ses if ses in index.sessions(sub) else '' 								# Session in the Index
+	mrs     = index.files(sub, ses_, suffix='svs') 										# Metabolite Data (Scanner and Sequence)
+	group   = qastats.session_group(index.sidecar(mrs[0]) if len(mrs) > 0 else None) 	# Scanner/Sequence Group
+	index.close() 																		# Close Index
+
+	online  = qastats.OnlineStats('{}/qa_stats.json'.format(basedir), '{}/qa_alerts.jsonl'.format(basedir),
+								  z=misc.get('qa_z', 4.0), min_n=misc.get('qa_min', 20)) # Study QA Statistics
+	alerts  = online.add_session(sub, ses, group, qastats.session_metrics(tables)) 		# Compare and Add Values
+	sub_log.info('%s %s results   : qa group %s, %d alert(s)', sub, ses, group, len(alerts)) # Subject Log - QA
+	for alert in alerts: 																# Iterate over Alerts
+		sub_log.warning('%s %s results   : QA ALERT %s row %d = %.4g (z = %+.1f, mean %.4g, sd %.4g, p05-p95 %.4g-%.4g, n = %d)', # Subject Log - Alert
+						sub, ses, alert['metric'], alert['row'], alert['value'], alert['z'], alert['mean'], alert['sd'],
+						alert['p05'], alert['p95'], alert['n'])
+	sub_log.info('%s %s results   : success = True', sub, ses) 							# Subject Log - Success
+	return True
+
+def osprey_job_file(basedir, sub, ses): 												# Osprey Job File of a Session
+	return '{}/{}_{}_osprey_job.json'.format(stagecache.bids_dir(basedir, sub, ses), sub, ses)
+
+def osprey_batch(sessions, misc, success=True, debug=False): 							# Run Osprey for Several Sessions at Once
+	'''
+	- 1. Description:
+	    - The function combines the osprey job files of several sessions into
+	        a single job (see batching.merge_jobs), calls osprey once, and 
+	        splits the outputs back into the derivatives of every session 
+	        (see batching.split_derivatives). The Matlab Runtime is therefore 
+	        started once per batch instead of once per session.
+
+	        Note: If the job files can not be combined (i.e. different data 
+	          lists), every session is run on its own (see osprey_run).
+
+	- 2. Inputs:
+		- sessions : (List  ) Base Directory, Subject, and Session of every session
+		- misc     : (Dict  ) Miscellaneous Objects that specific functions may need.
+		- success  : (Bool  ) Status of function call
+		- debug    : (Bool  ) Debugging mode - commands are not execeuted.
+
+	- 3. Outputs:
+		- success  : (List  ) Status of every session where True = Success and 
+							    False = Fail.
+	'''
+
+	global sub_log 																		# osprey_run uses the Subject Log
+
+	logs      = [logging.getLogger('{}_{}'.format(sub, ses)) for basedir, sub, ses in sessions] # Subject Logs (Opened by run_batch)
+	basedir   = sessions[0][0] 															# Base Directory (Same Study)
+	jobfiles  = [osprey_job_file(*session) for session in sessions] 					# Osprey Job Files
+	outdirs   = [] 																		# Session Output Folders
+	batchdir  = batching.batch_dir(basedir) 											# Batch Output Folder
+
+	try: 																				# Combine Job Files
+		for jobfile in jobfiles: 														# Iterate over Job Files
+			outdirs.append(batching.load_job(jobfile)['outputFolder'][0]) 				# Session Output Folder
+		jobfile, owners, stems = batching.merge_jobs(jobfiles, batchdir) 				# Combined Job File
+	except (OSError, ValueError, KeyError, IndexError) as e: 							# Can not Combine - Run Sessions on their own
+		results = [] 																	# Success of every Session
+		for (basedir, sub, ses), log in zip(sessions, logs): 							# Iterate over Sessions
+			log.info('%s %s osprey run: not batched (%s)', sub, ses, e) 				# Subject Log - Not Batched
+			sub_log = log 																# Subject Log of Session
+			results.append(osprey_run(basedir, sub, ses, misc, debug=debug)) 			# Run Osprey
+		return results
+
+	script    = 'OspreyCMD "{}"'.format(jobfile) 										# Osprey run script
+	for (basedir, sub, ses), log in zip(sessions, logs): 								# Iterate over Sessions
+		log.info('%s %s osprey run:'         , sub, ses) 								# Subject Log - osprey run function
+		log.info('%s %s osprey run: Starting (batch of %d)', sub, ses, len(sessions)) 	# Subject Log - osprey run Starting
+		log.info('%s %s osprey run: %s', sub, ses, script) 								# Subject Log - Script to Call
+
+	if debug == True: 																	# If Debug - Print to Screen
+		return [success] * len(sessions) 												# Debugging - Exit.
+
+	try:
+		executor = osprey_executor(misc) 												# One-Shot OspreyCMD or Warm Worker Pool
+		misc['exit_code'] = executor.run(jobfile) 										# Run Job (Keep Exit Code)
+		misc['usage']     = getattr(executor, 'usage', {}) 								# Resource Usage (One-Shot OspreyCMD Only)
+		success = misc['exit_code'] == 0 												# Non-Zero Exit Code - Failed
+		if success == True: 															# Return Outputs to Sessions
+			batching.split_derivatives(batchdir, owners, stems, outdirs) 				# Split Derivatives
+	except Exception as e: 																# Error Handling
+		for (basedir, sub, ses), log in zip(sessions, logs): 							# Iterate over Sessions
+			log.info('%s %s Error: %s', sub, ses, e) 									# Subject Log - Error
+		success = False 																# Set Success
+
+	for (basedir, sub, ses), log in zip(sessions, logs): 								# Iterate over Sessions
+		log.info('%s %s osprey run: batch = %s', sub, ses, batchdir) 					# Subject Log - Batch Directory
+		log.info('%s %s osprey run: success = %s', sub, ses, success) 					# Subject Log - Success
+	return [success] * len(sessions)
+
+batched   = {'bidscoin'  : bidscoin_batch, 												# Stages that can Run Several Sessions at Once
+			 'osprey_run': osprey_batch}
+
+def osprey_batch_key(session, misc): 													# Batch Key of an osprey_run Session
+	basedir, sub, ses = session 														# Unpack Session
+	return (basedir, batching.job_key(osprey_job_file(basedir, sub, ses))) 				# Same Study and Settings
+
+def run_stage(func, basedir, sub, ses, misc): 											# Run one Stage in a Worker Process
+	'''
+	- 1. Description:
+	    - Runs a single stage function (dicomsort, bidscoin, osprey_job, 
+	        osprey_qc, osprey_prep, osprey_run, osprey_results) for one 
+	        subject/session. This is executed within the worker processes of 
+	        the StageScheduler, so the Subject Log is opened for the duration 
+	        of the stage and closed again afterwards.
+
+	        Note: Each successful stage records a fingerprint of its inputs next 
+	          to its outputs (see stagecache). A stage whose inputs did not change
+	          since it last succeeded is skipped, unless misc['cache'] is False.
+
+	- 2. Inputs:
+		- func     : (Func  ) Stage function to run
+		- basedir  : (String) Base Directory where raw and bids can be found.
+		- sub      : (String) Current Subject as string
+		- ses      : (String) Current Subject's Session as string
+		- misc     : (Dict  ) Miscellaneous Objects that specific functions may need.
+
+	- 3. Outputs:
+		- success  : (Bool  ) Status of function call where True = Success and 
+							    False = Fail.
+		- details  : (Dict  ) Start/End Date/Time, wall time, CPU time and peak 
+							    RSS of the child processes, and Exit Code of the 
+							    stage (for the stage checkpoints and metrics)
+	'''
+
+	global sub_log 																		# Stage Functions use the Subject Log
+
+	misc    = dict(misc) 																# Stage Functions Store the Exit Code in misc
+	details = {'start': datetime.now().strftime(ParticipantLedger.datefmt)} 			# Stage Start
+	start   = t0.time() 																# Wall Time Start
+
+	comb    = '{}_{}'.format(sub, ses) 													# Subject and Session Combined
+	stage   = func.__name__ 															# Stage Name
+	close_log(logging.getLogger(comb), release=False) 									# Drop Handlers Inherited from Main Process
+	sub_log = setup_log(comb, '{}/raw/{}/{}.log'.format(basedir, sub, comb), 			# Subject Log - Open File
+						fields={'sub': sub, 'ses': ses, 'stage': stage})
+	try: 																				# Error Handling (Note subject fails and keep executing)
+		digest  = None 																	# Fingerprint of Stage Inputs
+		if misc.get('cache', True): 													# Fingerprint Inputs before Running
+			digest = stagecache.fingerprint(stage, basedir, sub, ses, misc) 			# Stage Inputs
+			if stagecache.is_current(stage, basedir, sub, ses, digest): 				# Inputs Unchanged
+				sub_log.info('%s %s %-10s: inputs unchanged (cached), skipped', sub, ses, stage) # Subject Log - Cached
+				success = True 															# Nothing to Run
+				details['cached'] = True 												# Skipped
+				return success, details
+
+		success = func(basedir, sub, ses, misc) 										# Run Current Command
+
+		if success == True and misc.get('cache', True): 								# Record Fingerprint
+			if stage in stagecache.inplace: 											# Stage Modified its Inputs
+				digest = stagecache.fingerprint(stage, basedir, sub, ses, misc) 		# Stage Inputs after Running
+			stagecache.record(stage, basedir, sub, ses, digest) 						# Store Next to Outputs
+		elif success == False: 															# Stage Failed
+			stagecache.clear(stage, basedir, sub, ses) 									# Never Skip a Failed Stage
+	except Exception as e: 																# Error Handling
+		sub_log.info('%s %s Error: %s', sub, ses, e) 									# Subject Log - Error
+		success = False 																# Set Success
+	finally:
+		close_log(sub_log, release=False) 												# Subject Log - Detach (Closed when Session Finishes)
+		details['end']       = datetime.now().strftime(ParticipantLedger.datefmt) 		# Stage End
+		details['exit_code'] = misc.get('exit_code') 									# Exit Code of External Tool (if any)
+		details['wall']      = t0.time() - start 										# Wall Time
+		details.update(misc.get('usage', {})) 											# CPU Time and Peak RSS of External Tool
+
+	return success, details
+
+def run_batch(func, sessions, misc): 													# Run one Batched Stage in a Worker Process
+	'''
+	- 1. Description:
+	    - Runs a batched stage (see batched, i.e. osprey_batch) for several 
+	        subjects/sessions within a single worker process of the 
+	        StageScheduler. Sessions whose inputs did not change are skipped 
+	        (see run_stage); a single remaining session is run by run_stage.
+
+	- 2. Inputs:
+		- func     : (Func  ) Stage function (i.e. osprey_run)
+		- sessions : (List  ) Base Directory, Subject, and Session of every session
+		- misc     : (Dict  ) Miscellaneous Objects that specific functions may need.
+
+	- 3. Outputs:
+		- results  : (List  ) Success and details of every session
+	'''
+
+	stage   = func.__name__ 															# Stage Name
+	misc    = dict(misc) 																# Stage Functions Store the Exit Code in misc
+	start   = datetime.now().strftime(ParticipantLedger.datefmt) 						# Stage Start
+	wall    = t0.time() 																# Wall Time Start
+	success = {} 																		# Session -> Success
+	logs    = {} 																		# Session -> Subject Log
+	digests = {} 																		# Session -> Fingerprint of Stage Inputs
+
+	for basedir, sub, ses in sessions: 													# Iterate over Sessions
+		session = (basedir, sub, ses) 													# Session Key
+		comb    = '{}_{}'.format(sub, ses) 												# Subject and Session Combined
+		close_log(logging.getLogger(comb), release=False) 								# Drop Handlers Inherited from Main Process
+		logs[session] = setup_log(comb, '{}/raw/{}/{}.log'.format(basedir, sub, comb), 	# Subject Log - Open File
+								  fields={'sub': sub, 'ses': ses, 'stage': stage})
+		if misc.get('cache', True): 													# Fingerprint Inputs before Running
+			digests[session] = stagecache.fingerprint(stage, basedir, sub, ses, misc) 	# Stage Inputs
+			if stagecache.is_current(stage, basedir, sub, ses, digests[session]): 		# Inputs Unchanged
+				logs[session].info('%s %s %-10s: inputs unchanged (cached), skipped', sub, ses, stage) # Subject Log - Cached
+				success[session] = True 												# Nothing to Run
+
+	cached  = set(success.keys()) 														# Sessions Skipped (Inputs Unchanged)
+	todo    = [session for session in sessions if session not in success] 				# Sessions to Run
+	if len(todo) == 1: 																	# Nothing to Batch
+		for log in logs.values(): 														# Iterate over Subject Logs
+			close_log(log, release=False) 												# Subject Log - Detach
+		success[todo[0]], details = run_stage(func, *todo[0], misc) 					# Run Single Session
+		misc['exit_code'] = details.get('exit_code') 									# Exit Code of External Tool
+		misc['usage']     = {key: details[key] for key in ['cpu', 'maxrss'] if key in details} # Resource Usage
+		todo    = []
+
+	try: 																				# Error Handling (Note subjects fail and keep executing)
+		if len(todo) > 0: 																# Sessions to Run Together
+			for session, result in zip(todo, batched[stage](todo, misc)): 				# Run Batch
+				success[session] = result 												# Session Success
+				if result == True and misc.get('cache', True): 							# Record Fingerprint
+					stagecache.record(stage, *session, digests[session]) 				# Store Next to Outputs
+				elif result == False: 													# Stage Failed
+					stagecache.clear(stage, *session) 									# Never Skip a Failed Stage
+	except Exception as e: 																# Error Handling
+		for session in todo: 															# Iterate over Batch
+			logs[session].info('%s %s Error: %s', session[1], session[2], e) 			# Subject Log - Error
+			success[session] = False 													# Set Success
+	finally:
+		for log in logs.values(): 														# Iterate over Subject Logs
+			close_log(log, release=False) 												# Subject Log - Detach (Closed when Session Finishes)
+
+	details = {'start'    : start, 														# Stage Start
+			   'end'      : datetime.now().strftime(ParticipantLedger.datefmt), 		# Stage End
+			   'exit_code': misc.get('exit_code'), 										# Exit Code of External Tool (if any)
+			   'wall'     : t0.time() - wall, 											# Wall Time (Whole Batch)
+			   'batch'    : len(sessions)} 												# Sessions in Batch
+	details.update(misc.get('usage', {})) 												# CPU Time and Peak RSS (Whole Batch)
+	return [(success[session], dict(details, cached=session in cached)) for session in sessions]
+
+def start_session(basedir, sub, ses): 													# Subject Log Header
+	'''
+	- 1. Description:
+		- Writes the Subject Log header before a subject/session is queued.
+
+	- 2. Inputs:
+		- basedir  : (String) Base Directory where raw and bids can be found.
+		- sub      : (String) Current Subject as string
+		- ses      : (String) Current Subject's Session as string
+	'''
+
+	comb    = '{}_{}'.format(sub, ses) 													# Subject and Session Combined
+	logfile = '{}/raw/{}/{}.log'.format(basedir, sub, comb) 							# Subject Log File
+	print('({}) Subject Log: {}'.format(now(), logfile)) 								# Watchman Log - Note Where Subject File Will be Found
+
+	sub_log = setup_log(comb, logfile, fields={'sub': sub, 'ses': ses}) 				# Subject Log - Create File
+	sub_log.info(' ') 																	# Subject Log - Space Between Entries
+	sub_log.info('--'*30) 																# Subject Log - Dashed Line Between Entries
+	sub_log.info('%s %s Base Dir  : %s', sub, ses, basedir) 							# Subject Log - Base Directory
+	close_log(sub_log, release=False) 													# Subject Log - Detach (Stages Follow)
+
+def finish_session(session, stage, success): 											# Subject Log Footer
+	'''
+	- 1. Description:
+		- Called by the StageScheduler once a subject/session has finished or 
+		    failed. Notes the skipped stages and closes the Subject Log.
+
+	- 2. Inputs:
+		- session  : (Tuple ) Base Directory, Subject, and Session
+		- stage    : (String) Last stage that was run
+		- success  : (Bool  ) Status of the last stage
+	'''
+
+	basedir, sub, ses = session 														# Unpack Session
+	use_study(basedir) 																	# Study Log and Ledger of Session
+	comb    = '{}_{}'.format(sub, ses) 													# Subject and Session Combined
+	sub_log = setup_log(comb, '{}/raw/{}/{}.log'.format(basedir, sub, comb), fields={'sub': sub, 'ses': ses}) # Subject Log - Open File
+
+	for command in commands_[commands_.index(stage)+1:]: 								# Iterate Over Remaining Commands
+		sub_log.info('%s %s Skipped ** ', sub, command) 								# Subject Log - Failed Previous Steps (skipping)
+
+	sub_log.info('Exiting....') 														# Subject Log - Exiting
+	sub_log.info('--'*30) 																# Subject Log - Dashed Line to Separate Entries
+	close_log(sub_log) 																	# Subject Log - Close File
+
+	study_log.info('%s %s Finished  : %s (success = %s)', sub, ses, stage, success) 	# Study Log - Session Finished
+	ledger.set_status(sub, ses, 'success' if success else 'failed', stage) 				# Participant Ledger - Status
+
+def checkpoint_stage(session, stage, status, details): 									# Stage Checkpoint
+	'''
+	- 1. Description:
+		- Called by the StageScheduler when a stage starts (running) and ends 
+		    (success or failed). Records the stage checkpoint in the Participant 
+		    Ledger, so an interrupted or failed session can be resumed from its
+		    first unfinished stage (--resume), and writes a stage metrics record
+		    (queue wait, wall time, CPU time, peak RSS) for finished stages.
+
+	- 2. Inputs:
+		- session  : (Tuple ) Base Directory, Subject, and Session
+		- stage    : (String) Stage name
+		- status   : (String) Stage status (running, success, failed)
+		- details  : (Dict  ) Start/End Date/Time, Exit Code and metrics of the stage
+	'''
+
+	basedir, sub, ses = session 														# Unpack Session
+	use_study(basedir) 																	# Study Log and Ledger of Session
+	ledger.checkpoint(sub, ses, stage, status, details.get('start', now()), 			# Participant Ledger - Checkpoint
+					  details.get('end'), details.get('exit_code'))
+	if status == 'failed' and details.get('exit_code') is not None: 					# Note Exit Code
+		study_log.info('%s %s Failed    : %s (exit code %s)', sub, ses, stage, details['exit_code']) # Study Log - Exit Code
+	if status != 'running': 															# Stage Finished
+		stage_metrics.record(sub, ses, stage, status, details) 							# Stage Metrics Record
+
+def report_crashes(scheduler): 															# Log Stage Calls Lost with a Worker
+	'''
+	- 1. Description:
+		- Logs the stage calls that failed because a worker process died (i.e.
+		    killed for memory) to the study log of their sessions. The
+		    StageScheduler has already failed them and replaced its pool, so
+		    the run (or daemon) keeps going.
+	'''
+
+	for sessions, stage in scheduler.crashed: 											# Iterate over Lost Calls
+		for basedir, sub, ses in (sessions if isinstance(sessions, list) else [sessions]): # Batch or Single Session
+			use_study(basedir) 															# Study Log of Session
+			study_log.info('%s %s Crashed   : %s (worker process died, pool restarted)', sub, ses, stage) # Study Log - Lost Worker
+	scheduler.crashed.clear() 															# Reported
+
+def use_study(basedir): 																# Make a Study Current
+	'''
+	- 1. Description:
+		- Points the study globals (study_log, ledger, stage_metrics) at the 
+		    study of basedir, so the functions that log to the study log or 
+		    update the participant ledger serve the right study when one 
+		    scheduler runs several studies.
+	'''
+
+	global study_log, ledger, stage_metrics
+	study = studies[basedir] 															# Study Objects
+	study_log, ledger, stage_metrics = study['log'], study['ledger'], study['metrics']
+
+def open_study(basedir, args, misc, stages): 											# Open the Logs, Ledger and Watcher of a Study
+	'''
+	- 1. Description:
+		- Opens the study log, participant ledger, raw scanner, stage metrics 
+		    and upload watcher of a study, records its new subjects/sessions and 
+		    lists the sessions to reprocess or resume (--reprocess, --resume). 
+		    The study becomes the current study (see use_study).
+
+	- 2. Inputs:
+		- basedir  : (String) Base Directory where raw and bids can be found.
+		- args     : (Object) Command line arguments
+		- misc     : (Dict  ) Miscellaneous Objects that specific functions may need.
+		- stages   : (List  ) Ordered stage names
+
+	- 3. Outputs:
+		- study    : (Dict  ) name, log, ledger, scanner, metrics, watcher, ready 
+							    (sessions to queue now) and starts (first stage of 
+							    resumed sessions)
+	'''
+
+	name       = basedir.split('/')[-1] 												# Study Name
+	if [base.split('/')[-1] for base in args.base].count(name) > 1: 					# Studies with the Same Folder Name
+		name   = '_'.join(basedir.strip('/').split('/')[-2:]) 							# Parent Folder Tells them Apart (Log and Textfile)
+	promfile   = args.prom_file 														# Prometheus Textfile
+	if promfile is not None and len(args.base) > 1: 									# One Textfile per Study (Same Collector Directory)
+		promfile = '{}_{}.prom'.format(os.path.splitext(promfile)[0], name)
+
+	print('({}) Study Log: {}/{}.log'.format(now(), basedir, basedir.split('/')[-1])) 	# Watchman Log - Note Where Subject File Will be Found
+	study      = {'name'   : name, 														# Study Objects
+				  'log'    : setup_log(name, '{}/{}.log'.format(basedir, basedir.split('/')[-1])), # Study Log File
+				  'ledger' : ParticipantLedger('{}/raw/participant_log.db'.format(basedir), # Indexed Participant Ledger (Maintains Participant File)
+											   '{}/raw/participant_log.csv'.format(basedir)),
+				  'scanner': RawScanner('{}/raw'.format(basedir)), 						# Incremental Raw Directory Scanner
+				  'metrics': metrics.StageMetrics('{}/stage_metrics.jsonl'.format(basedir), promfile, name), # Stage Metrics (JSON Lines and Prometheus)
+				  'ready'  : [], 														# Sessions to Process without Waiting for Upload
+				  'starts' : {}} 														# First Stage of Resumed Sessions
+	studies[basedir] = study
+	use_study(basedir) 																	# Current Study
+
+	study_log.info(' ') 																# Study Log - 
+	study_log.info('--'*30) 															# Study Log - Dashed Line to Separate Entries
+	study_log.info('Base Dir: %s', basedir) 											# Study Log - Base Directory
+	study_log.info('Osp  Dir: %s', args.osprey) 										# Study Log - Osprey Directory
+	subs       = update_partfile(basedir, ledger, study['scanner']) 					# Update Participant Ledger and get New subjects for Analysis
+
+	watch      = {'quiet'    : args.quiet, 												# Upload Completion Settings
+				  'sentinels': args.sentinel or ['.upload_complete'], 					# Sentinel Files
+				  'manifests': args.manifest or ['upload_manifest.json'], 				# Manifest Files
+				  'timeout'  : args.upload_timeout} 									# Upload Timeout
+	if args.stream: 																	# Sort while Uploading
+		watcher = StreamingWatcher(basedir, require=args.stream_require, scheme=args.sort_scheme, # Required Series Start Processing
+								   series_quiet=args.stream_quiet, link=args.sort_link, threads=args.sort_threads, **watch)
+		study_log.info('Stream    : sorting while uploading (required series: %s)', ' '.join(args.stream_require) or 'none') # Study Log - Streaming
+	else:
+		watcher = UploadWatcher(basedir, **watch) 										# Upload Completion Detector
+	for sub in subs: 																	# Iterate over Subjects
+		for ses in subs[sub]: 															# Iterate over Sessions
+			watcher.add(sub, ses) 														# Watch Session Upload
+	study['watcher'] = watcher
+	study_log.info('Waiting for %2d Session(s) to Upload....', len(watcher.pending)) 	# Study Log - Waiting for Upload
+
+	ready      = study['ready'] 														# Sessions to Process without Waiting for Upload
+	if args.reprocess is not None: 														# Reprocess Known Sessions
+		for sub, ses in ledger.sessions(): 												# Iterate over Known Sessions
+			if len(args.reprocess) == 0 or sub in args.reprocess or '{}_{}'.format(sub, ses) in args.reprocess: # Selected Session
+				if (sub, ses) not in watcher.pending: 									# Not Uploading
+					ready.append((sub, ses, 'reprocess')) 								# Process Now
+		study_log.info('Reprocess : %d session(s) (cache = %s)', len(ready), misc['cache']) # Study Log - Reprocess
+
+	starts     = study['starts'] 														# First Stage of Resumed Sessions
+	if args.resume: 																	# Resume Unfinished Sessions
+		queued = set((sub, ses) for sub, ses, reason in ready) 							# Already Reprocessed
+		for sub, ses in ledger.sessions(exclude=('success', 'logged')): 				# Iterate over Unfinished Sessions
+			if (sub, ses) in watcher.pending or (sub, ses) in queued: 					# Uploading or Already Queued
+				continue
+			stage = ledger.resume_stage(sub, ses, stages) 								# First Unfinished Stage
+			if stage is None: 															# Every Stage Succeeded
+				ledger.set_status(sub, ses, 'success', stages[-1]) 						# Participant Ledger - Finished
+				continue
+			starts[(sub, ses)] = stage 													# Resume at Stage
+			ready.append((sub, ses, 'resume at {}'.format(stage))) 						# Process Now
+		study_log.info('Resume    : %d session(s)', len(starts)) 						# Study Log - Resume
+	return study
+
+def session_lane(basedir, sub, ses, priorities): 										# Priority Lane of a Session
+	'''
+	- 1. Description:
+		- Matches the priority patterns (see --priority) against the study 
+		    name, the subject, the session, sub_ses, and the names of the 
+		    files and series folders in the raw session directory (i.e. 
+		    *phantom* or *QA*). The most urgent matching lane wins.
+
+	- 2. Inputs:
+		- basedir  : (String) Base Directory where raw and bids can be found.
+		- sub      : (String) Current Subject as string
+		- ses      : (String) Current Subject's Session as string
+		- priorities: (List ) (Pattern, Lane) (see parse_priorities)
+
+	- 3. Outputs:
+		- lane     : (String) Priority lane (see scheduler.lanes; normal if none match)
+	'''
+
+	if len(priorities) == 0: 															# No Patterns
+		return 'normal'
+	names = [basedir.split('/')[-1], sub, ses, '{}_{}'.format(sub, ses)] 				# Study and Session Names
+	rawdir = stagecache.raw_dir(basedir, sub, ses) 										# Raw Session Directory
+	try: 																				# Series Folders and Files (Two Levels)
+		for entry in os.scandir(rawdir):
+			names.append(entry.name)
+			if entry.is_dir():
+				names.extend(os.listdir(entry.path))
+	except OSError: 																	# Raw Data Removed
+		pass
+
+	matched = [lane for pattern, lane in priorities if any(fnmatch.fnmatch(name, pattern) for name in names)]
+	return min(matched + ['normal'], key=lambda lane: lanes[lane]) 						# Most Urgent Lane
+
+def parse_priorities(values): 															# Priority Patterns
+	'''
+	- 1. Description:
+		- Converts the command line priorities (i.e. *phantom*=urgent) into 
+		    (pattern, lane) pairs for session_lane.
+
+	- 2. Inputs:
+		- values   : (List  ) Strings formatted as pattern=lane
+
+	- 3. Outputs:
+		- pairs    : (List  ) (Pattern, Lane)
+	'''
+
+	pairs = [] 																			# Patterns and Lanes
+	for value in values: 																# Iterate over Priorities
+		pattern, _, lane = value.rpartition('=') 										# Split Pattern and Lane
+		lane = lane.strip() 															# Lane Name
+		if pattern == '' or lane not in lanes: 											# Unknown Lane
+			raise ValueError('{} is not pattern=lane (lanes: {})'.format(value, ', '.join(lanes)))
+		pairs.append((pattern, lane))
+	return pairs
+
+def parse_limits(limits, stages, cast=int): 											# Per-Stage Concurrency Limits
+	'''
+	- 1. Description:
+		- Converts the command line stage limits (i.e. osprey_run=3) into a 
+		    dictionary for the StageScheduler. Also used for the memory 
+		    estimates (i.e. osprey_run=4000, in MB) with cast=float.
+
+	- 2. Inputs:
+		- limits   : (List  ) Strings formatted as stage=N
+		- stages   : (List  ) Known stage names
+		- cast     : (Type  ) Type of the values
+
+	- 3. Outputs:
+		- limdict  : (Dict  ) Stage names (keys) and concurrency limits (values)
+	'''
+
+	limdict = {} 																		# Stage Limits
+	for limit in limits: 																# Iterate over Limits
+		stage, _, value = limit.partition('=') 											# Split Stage and Value
+		stage = stage.strip() 															# Stage Name
+		if stage not in stages: 														# Unknown Stage
+			raise ValueError('unknown stage {} (choose from {})'.format(stage, ', '.join(stages)))
+		limdict[stage] = cast(value) 													# Add Stage Limit
+	return limdict
+
+def parse_thresholds(values, defaults): 												# Pre-Flight QC Thresholds
+	'''
+	- 1. Description:
+		- Converts the command line QC thresholds (i.e. min_snr=10) into a 
+		    dictionary for preflight.check_pair.
+
+	- 2. Inputs:
+		- values   : (List  ) Strings formatted as name=value
+		- defaults : (Dict  ) Known thresholds and their defaults
+
+	- 3. Outputs:
+		- thresh   : (Dict  ) Threshold names (keys) and values (values)
+	'''
+
+	thresh = {} 																		# Changed Thresholds
+	for value in values: 																# Iterate over Thresholds
+		name, _, number = value.partition('=') 											# Split Name and Value
+		name = name.strip() 															# Threshold Name
+		if name not in defaults: 														# Unknown Threshold
+			raise ValueError('unknown threshold {} (choose from {})'.format(name, ', '.join(defaults)))
+		thresh[name] = float(number) 													# Add Threshold
+	return thresh
+
+def print_stats(argv): 																	# main.py stats - Stage Duration Percentiles
+	'''
+	- 1. Description:
+		- Prints p50/p95 stage durations (and queue waits, CPU time, peak RSS)
+		    across a study from its stage metrics (stage_metrics.jsonl).
+
+	- 2. Inputs:
+		- argv     : (List  ) Command line arguments after 'stats'
+	'''
+
+	parser   = argparse.ArgumentParser(prog='main.py stats', description='Stage duration percentiles of a study')
+	parser.add_argument('-b', '--base'  , help='Base   Directory: where /raw and /bids are located'  , type=str, required=True) # Base Directory
+	parser.add_argument('--stage'       , help='Only summarize this stage (repeatable)'             , action='append') # Stages
+	parser.add_argument('--since'       , help='Only records after this date (i.e. 2024-01-31)'     , type=str) # First Date
+	args     = parser.parse_args(argv) 													# Input Arguments
+
+	jsonfile = '{}/stage_metrics.jsonl'.format(args.base.replace('\\', '/').rstrip('/')) # Stage Metrics
+	if os.path.exists(jsonfile) == False: 												# No Metrics Yet
+		print('No stage metrics found: {}'.format(jsonfile))
+		sys.exit(1)
+
+	records  = metrics.load(jsonfile) 													# Stage Records
+	if args.stage: 																		# Selected Stages
+		records = [record for record in records if record['stage'] in args.stage]
+	if args.since: 																		# Selected Dates
+		records = [record for record in records if record['time'] >= args.since]
+
+	print('{} record(s) from {}'.format(len(records), jsonfile)) 						# Number of Records
+	print(metrics.format_summary(metrics.summarize(records))) 							# Summary Table
+
 if __name__ == '__main__':
 
+	if sys.argv[1:2] == ['stats']: 														# Subcommand - Stage Statistics
+		print_stats(sys.argv[2:])
+		sys.exit(0)
+
 	print(' ')    																		# Watchman Log - Space Between Entries
 	print('-- '*30) 																	# Watchman Log - Dashed Line Between Entries
 
 	parser     = argparse.ArgumentParser() 												# Input Argument Parser
-	parser.add_argument('-b', '--base'  , help='Base   Directory: where /raw and /bids are located'  , type=str) # Base Directory
+	parser.add_argument('-b', '--base'  , help='Base   Directory: where /raw and /bids are located (repeatable, one per study)', action='append') # Base Directories
 	parser.add_argument('-o', '--osprey', help='Osprey Directory: where executable osprey is located', type=str) # Osprey Directory
+	parser.add_argument('-j', '--jobs'  , help='Number of stages to run in parallel (default 1)'      , type=int, default=1) # Worker Processes
+	parser.add_argument('-l', '--limit' , help='Per-stage limit as stage=N (i.e. osprey_run=3)'     , action='append', default=[]) # Stage Limits
+	parser.add_argument('--memory'      , help='Memory of one stage call as stage=MB (i.e. osprey_run=4000)', action='append', default=[]) # Stage Memory Estimates
+	parser.add_argument('--memory-budget', help='Memory of all running stage calls in MB (default 80%% of the node with --memory)', type=float) # Memory Budget
+	parser.add_argument('--priority'    , help='Priority lane as pattern=lane (i.e. *phantom*=urgent; lanes urgent, high, normal, low)', action='append', default=[]) # Priority Lanes
+	parser.add_argument('--quiet'       , help='Seconds without changes before an upload is complete', type=float, default=60) # Upload Quiet Window
+	parser.add_argument('--poll'        , help='Seconds between upload completion checks'            , type=float, default=5 ) # Upload Poll Interval
+	parser.add_argument('--sentinel'    , help='File marking a completed upload (.upload_complete)'  , action='append') # Upload Sentinel Files
+	parser.add_argument('--manifest'    , help='File listing expected files (upload_manifest.json)'  , action='append') # Upload Manifest Files
+	parser.add_argument('--upload-timeout', help='Seconds after which an upload is processed anyway'   , type=float, default=3600) # Upload Timeout
+	parser.add_argument('--stream'      , help='Sort dicoms while they upload (streaming ingest)'   , action='store_true') # Streaming Ingest
+	parser.add_argument('--stream-require', help='Series folders that start processing when complete (i.e. SE GR)', nargs='*', default=[]) # Required Series
+	parser.add_argument('--stream-quiet', help='Seconds without new images before a series is complete', type=float, default=30) # Series Quiet Window
+	parser.add_argument('--daemon'      , help='Keep running and process sessions as they arrive'    , action='store_true') # Daemon Mode
+	parser.add_argument('--scan'        , help='Seconds between raw scans in daemon mode (0 = off)'  , type=float, default=60) # Daemon Polling Watcher
+	parser.add_argument('--enqueue'     , help='Send changed paths (or stdin) to the running daemon' , nargs='*') # Watchman Trigger
+	parser.add_argument('--reprocess'   , help='Re-run known sessions (all, or sub-01 / sub-01_ses-01)', nargs='*') # Reprocess Sessions
+	parser.add_argument('--no-cache'    , help='Run every stage, even if its inputs did not change'  , action='store_true') # Disable Stage Cache
+	parser.add_argument('--resume'      , help='Resume unfinished sessions at their first unfinished stage', action='store_true') # Resume Sessions
+	parser.add_argument('--batch'       , help='Sessions per Osprey run (1 = no batching)'          , type=int, default=1) # Batched Osprey Jobs
+	parser.add_argument('--batch-wait'  , help='Seconds a session waits for its Osprey batch to fill', type=float, default=300) # Batch Maximum Wait
+	parser.add_argument('--sorter'      , help='Dicom sorter: builtin (default) or dicomsort'       , type=str, default='builtin', choices=['builtin', 'dicomsort']) # Dicom Sorter
+	parser.add_argument('--sort-scheme' , help='Dicom folder scheme (default {ScanningSequence})'   , type=str, default='{ScanningSequence}') # Folder Scheme
+	parser.add_argument('--sort-threads', help='Header reads at the same time (built-in sorter)'    , type=int, default=8) # Sorter Threads
+	parser.add_argument('--sort-link'   , help='Hardlink dicoms into their folders instead of moving', action='store_true') # Hardlink Dicoms
+	parser.add_argument('--bids-batch'  , help='Sessions per bidscoiner call (1 = no batching)'     , type=int, default=1) # Batched bidscoiner Calls
+	parser.add_argument('--bids-batch-wait', help='Seconds a session waits for its bidscoiner batch to fill', type=float, default=30) # Batch Maximum Wait
+	parser.add_argument('--basis-dir'   , help='Basis set tree to select each session\'s basis set from (i.e. osprey/basissets)', type=str) # Basis Set Tree
+	parser.add_argument('--qa-z'        , help='Standard deviations from the group mean that raise a QA alert', type=float, default=4.0) # QA Alert Threshold
+	parser.add_argument('--qc'          , help='Pre-flight QC threshold as name=value (i.e. min_snr=10)', action='append', default=[]) # QC Thresholds
+	parser.add_argument('--qc-action'   , help='Sessions failing pre-flight QC: skip Osprey or flag and run', type=str, default='skip', choices=['skip', 'flag']) # QC Action
+	parser.add_argument('--preprocess'  , help='Combine coils, align and average transients before Osprey', action='store_true') # Preprocess for Osprey
+	parser.add_argument('--qa-min' , help='Results of a scanner/sequence group before QA alerts', type=int, default=20) # QA Minimum Group Size
+	parser.add_argument('--osprey-pool' , help='Number of warm Osprey workers (0 = OspreyCMD per job)', type=int, default=0) # Warm Worker Pool
+	parser.add_argument('--osprey-worker', help='Command that starts a warm Osprey worker'          , type=str, default='OspreyWorker') # Worker Command
+	parser.add_argument('--osprey-timeout', help='Seconds before an Osprey job is stopped'          , type=float) # Osprey Timeout
+	parser.add_argument('--log-format'  , help='Subject and study log format: text (.log) or json (.jsonl)', type=str, default='text', choices=logqueue.formats) # Log Format
+	parser.add_argument('--prom-file'   , help='Prometheus textfile for stage metrics (i.e. in the node_exporter textfile directory)', type=str) # Prometheus Textfile
 	args       = parser.parse_args() 													# Input Arguments
 
 	now        =  lambda: datetime.now().strftime('%m/%d/%Y %I:%M:%S %p') 				# Watchman Log - Shorthand function to get Date/Time
 	print('({})'.format(now()))  														# Watchman Log - Date/Time
 
-	basedir    = args.base 																# Base Directory
-	basedir    = basedir.replace('\\', '/') 											# Use Forward Slash on all Operating Systems
-	study      = basedir.split('/')[-1] 												# Study Name
-	rawdir     = '{}/raw'.format(basedir) 												# Base Directory
+	if args.base is None: 																# No Study Given
+		parser.error('-b/--base is required')
+	args.base  = [base.replace('\\', '/').rstrip('/') for base in args.base] 			# Use Forward Slash on all Operating Systems
+	basedir    = args.base[0] 															# Base Directory (First Study)
+
+	if args.enqueue is not None: 														# Watchman Trigger - Hand Paths to Daemon
+		if len(args.base) > 1: 															# Paths Belong to one Study
+			parser.error('--enqueue: give the base directory of a single study')
+		paths  = args.enqueue if len(args.enqueue) > 0 else sys.stdin.read().splitlines() # Changed Paths (Arguments or stdin)
+		if send_paths(basedir, paths): 													# Daemon Received Paths
+			print('({}) Queued    : {} path(s) sent to daemon'.format(now(), len(paths))) # Watchman Log - Queued
+			sys.exit(0)
+		print('({}) No daemon running, processing directly'.format(now())) 				# Watchman Log - No Daemon
+
+	for basedir in args.base: 															# Iterate over Studies
+		if args.daemon and send_paths(basedir, []): 									# Daemon Already Running
+			print('({}) Daemon already running for {}'.format(now(), basedir)) 			# Watchman Log - Already Running
+			sys.exit(1)
 	
 	misc       = {} 																	# Miscellaneous objects that we might need later....
 	misc['osp_path'] = args.osprey 														# Osprey Path
-
-	print('({}) Study Log: {}/{}.log'.format(now(), basedir, study)) 					# Watchman Log - Note Where Subject File Will be Found
-	study_log  = setup_log(study, '{}/{}.log'.format(basedir, study)) 					# Study Log File
-	study_log.info(' ') 																# Study Log - 
-	study_log.info('--'*30) 															# Study Log - Dashed Line to Separate Entries
-	study_log.info('Base Dir: %s', basedir) 											# Study Log - Base Directory
-	study_log.info('Osp  Dir: %s', args.osprey) 										# Study Log - Osprey Directory
-	
-	partfile   = '{}/raw/participant_log.csv'.format(basedir)	 						# Maintains List of All Participants (Determines if Analyzed)
-	if os.path.exists(partfile) == False: 												# Participant File Does Not Exist
-		subs   = create_partfile(basedir, partfile) 									# Create Participant File and get New subjects for Analysis 
-	else: 																				# Participant File Exists
-		subs   = update_partfile(basedir, partfile) 									# Update Participant File and get New subjects for Analysis
-
-	study_log.info('Waiting for %2d Subject(s) to Upload....', len(list(subs.keys())))  # Study Log - Base Directory
-	if len(list(subs.keys())) > 0: 														# Found Subjects
-		t0.sleep(10)  		    														# Build in latency to ensure all files finished transferring
-		t0.sleep(60*len(list(subs.keys()))) 											# Add Additional Minute per Subject
-	study_log.info('Continuing....') 													# Study Log - Base Directory
+	misc['cache']    = args.no_cache == False 											# Skip Stages with Unchanged Inputs
+	misc['osp_timeout'] = args.osprey_timeout 											# Osprey Job Timeout
+	misc['sorter']      = args.sorter 													# Dicom Sorter
+	misc['sort_scheme'] = args.sort_scheme 												# Dicom Folder Scheme
+	misc['sort_threads'] = args.sort_threads 											# Sorter Threads
+	misc['sort_link']   = args.sort_link 												# Hardlink instead of Move
+	misc['qa_z']        = args.qa_z 													# QA Alert Threshold
+	misc['basis_dir']   = args.basis_dir 												# Basis Set Tree
+	if args.basis_dir is not None and os.path.isdir(args.basis_dir) == False: 			# Basis Set Tree Missing
+		parser.error('--basis-dir: {} is not a directory'.format(args.basis_dir)) 		# Exit with Usage Message
+	misc['qa_min']      = args.qa_min 													# QA Minimum Group Size
+	misc['qc_action']   = args.qc_action 												# Skip or Flag Sessions Failing QC
+	misc['preprocess']  = args.preprocess 												# Reduce Data before Osprey
+	try: 																				# Pre-Flight QC Thresholds
+		misc['qc']      = parse_thresholds(args.qc, preflight.thresholds) 				# Parse name=value
+	except ValueError as e: 															# Invalid Threshold
+		parser.error('--qc: {}'.format(e)) 												# Exit with Usage Message
 
 										 												# This can be moved to a Config File
 	commands  = {'dicomsort' : dicomsort , 												# Sort Dicoms
 				 'bidscoin'  : bidscoin  , 												# Bids-ify
 				 'osprey_job': osprey_job, 												# Create Osprey Job File
-				 'osprey_run': osprey_run} 												# Run Osprey
+				 'osprey_qc' : osprey_qc , 												# Pre-Flight QC
+				 'osprey_prep': osprey_prep, 											# Preprocess for Osprey (--preprocess)
+				 'osprey_run': osprey_run, 												# Run Osprey
+				 'osprey_results': osprey_results} 										# Add Results to Study Store
 	commands_ = list(commands.keys()) 													# Current Command List
 
-	success   = 1 																		# Check For Errors - Success = True
-	nsub_keys = list(subs.keys()) 														# New Subject Dictionary Keys
+	try: 																				# Per-Stage Limits
+		limits = parse_limits(args.limit, commands_) 									# Parse stage=N
+		limits.setdefault('osprey_results', 1) 											# One Writer of the Results Store
+	except ValueError as e: 															# Invalid Limit
+		parser.error('--limit: {}'.format(e)) 											# Exit with Usage Message
+
+	try: 																				# Per-Stage Memory Estimates
+		memory = parse_limits(args.memory, commands_, cast=float) 						# Parse stage=MB
+	except ValueError as e: 															# Invalid Estimate
+		parser.error('--memory: {}'.format(e)) 											# Exit with Usage Message
+	budget    = args.memory_budget 														# Memory Budget (MB)
+	if budget is None and len(memory) > 0 and metrics.physical_memory(): 				# Default - 80% of the Node
+		budget = 0.8 * metrics.physical_memory() / 2**20
+
+	try: 																				# Priority Lanes
+		priorities = parse_priorities(args.priority) 									# Parse pattern=lane
+	except ValueError as e: 															# Invalid Priority
+		parser.error('--priority: {}'.format(e)) 										# Exit with Usage Message
+
+	batches   = {} 																		# Batched Stages
+	if args.bids_batch > 1: 															# Batch bidscoiner Calls
+		batches['bidscoin']   = {'size'  : args.bids_batch, 							# Sessions per Batch
+								 'wait'  : args.bids_batch_wait, 						# Maximum Wait
+								 'key'   : bidscoin_batch_key, 							# Same Study
+								 'runner': run_batch} 									# Batch Runner
+	if args.batch > 1: 																	# Batch Osprey Runs
+		batches['osprey_run'] = {'size'  : args.batch, 									# Sessions per Batch
+								 'wait'  : args.batch_wait, 							# Maximum Wait
+								 'key'   : osprey_batch_key, 							# Same Study and Settings
+								 'runner': run_batch} 									# Batch Runner
+
+	log_queue  = logqueue.LogQueue(args.log_format).start() 							# One Writer Thread for all Logs (Stages only Queue Records)
+	studies    = OrderedDict() 															# Base Directory -> Study Objects (see open_study)
+	for basedir in args.base: 															# Iterate over Studies
+		study  = open_study(basedir, args, misc, commands_) 							# Study Log, Ledger and Upload Watcher
+		study_log.info('Jobs      : %d (limits: %s)', args.jobs, limits) 				# Study Log - Concurrency
+		if len(args.base) > 1: 															# Shared Scheduler
+			study_log.info('Studies   : %d sharing the limits (%s)', len(args.base), ', '.join(args.base)) # Study Log - Studies
+		if len(memory) > 0: 															# Memory Budget
+			study_log.info('Memory    : %s MB of %s MB', memory, budget) 				# Study Log - Memory
+		if len(priorities) > 0: 														# Priority Lanes
+			study_log.info('Priority  : %s', ', '.join('{}={}'.format(*pair) for pair in priorities)) # Study Log - Lanes
+		if args.batch > 1: 																# Batched Osprey Runs
+			study_log.info('Batch     : %d session(s) per osprey run (wait %s s)', args.batch, args.batch_wait) # Study Log - Batching
+		if args.bids_batch > 1: 														# Batched bidscoiner Calls
+			study_log.info('Batch     : %d session(s) per bidscoiner call (wait %s s)', args.bids_batch, args.bids_batch_wait) # Study Log - Batching
+
+	pool       = None 																	# Warm Osprey Worker Pool
+	if args.osprey_pool > 0: 															# Start Warm Workers
+		pool   = WorkerPool(args.osprey_worker, workers=args.osprey_pool, cwd=args.osprey, # Initialize Matlab Runtime Once per Worker
+						   env=osprey_env(), timeout=args.osprey_timeout)
+		misc['executor'] = pool.executor() 												# Stage Workers Send Jobs to the Pool
+		for basedir in studies: 														# Iterate over Studies
+			use_study(basedir)
+			study_log.info('Osprey    : %d warm worker(s) (%s)', args.osprey_pool, args.osprey_worker) # Study Log - Worker Pool
+
+	if args.daemon: 																	# Daemon Mode
+		signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0)) 				# Stop Cleanly on Termination
+		for basedir, study in studies.items(): 											# One Listener per Study (Watchman Triggers per Study)
+			use_study(basedir)
+			study['events'] = EventQueue() 												# Coalescing Work Queue
+			study['server'] = PipelineServer(basedir, study['events']) 					# Receive Paths from Watchman Triggers
+			study['next_scan'] = t0.time() + args.scan 									# Next Polling Scan
+			study_log.info('Daemon    : listening on %s:%d (scan every %s s)', *study['server'].listener.address, args.scan) # Study Log - Daemon
 
-	for ii in range(len(nsub_keys)): 													# Iterate over Subjects
-		sub   = nsub_keys[ii] 															# Current Subject
-		subdir= '{}/{}'.format(rawdir, sub) 											# Subject Directory (No Session)
-
-		for jj in range(len( subs[sub] )): 												# Iterate over Sessions
-			ses     = subs[sub][jj] 													# Current Session
-			comb    = '{}_{}'.format(sub, ses) 											# Subject and Session Combined - Helps Determine New Sessions within Previous Subjects
-
-			print('({}) Subject Log: {}/{}.log'.format(now(), subdir, comb)) 			# Watchman Log - Note Where Subject File Will be Found
-
-			sub_log = setup_log(comb, '{}/{}.log'.format(subdir, comb)) 				# Subject Log - Create File
-			sub_log.info(' ') 															# Subject Log - Space Between Entries
-			sub_log.info('--'*30) 														# Subject Log - Dashed Line Between Entries
-			sub_log.info('%s %s Base Dir  : %s', sub, ses, basedir) 					# Subject Log - Base Directory
-
-			for jj in range(len(commands_)): 											# Iterate Over Commands
-				if success == True:				 										# Ensure Successful Completion of Previous
-					success = commands[commands_[jj]](basedir, sub, ses, misc)			# Run Current Command
-
-				else:
-					sub_log.info('%s %s Skipped ** ', sub, commands_[jj]) 				# Subject Log - Failed Previous Steps (skipping)
-
-			sub_log.info('Exiting....') 												# Subject Log - Exiting
-			sub_log.info('--'*30) 														# Subject Log - Dashed Line to Separate Entries
-
-	study_log.info('Exiting....') 														# Study Log - Exiting
-	study_log.info('--'*30) 															# Study Log - Dashed Line to Separate Entries
+	try:
+		with StageScheduler(commands, run_stage, jobs=args.jobs, limits=limits, 		# Concurrent Subject/Session Stages (all Studies)
+							callback=finish_session, progress=checkpoint_stage, batches=batches,
+							initializer=logqueue.attach, initargs=(log_queue.queue,), 	# Workers Queue their Logs
+							memory=memory, budget=budget) as scheduler: 				# Memory Budget
+			while (args.daemon or scheduler.idle == False or 							# Daemon or Sessions Running
+				   any(len(study['watcher'].pending) + len(study['ready']) > 0 for study in studies.values())): # Sessions Uploading
+				uploading = False 														# Any Study still Uploading
+				for basedir, study in studies.items(): 									# Iterate over Studies
+					use_study(basedir) 													# Study Log and Ledger
+					scanner, watcher = study['scanner'], study['watcher']
+					if args.daemon: 													# Daemon Mode - Find New Sessions
+						subs   = {} 													# New Subjects and Sessions
+						queued = study['events'].drain() 								# Coalesced Watchman Events
+						if len(queued) > 0: 											# Events Received
+							subs = update_events(basedir, ledger, scanner, queued) 		# List Subjects Named by Events
+						if args.scan > 0 and t0.time() >= study['next_scan']: 			# Polling Watcher
+							for sub, sess in update_partfile(basedir, ledger, scanner).items(): # Scan Raw Directory
+								subs.setdefault(sub, []).extend(sess) 					# Add New Sessions
+							study['next_scan'] = t0.time() + args.scan 					# Next Polling Scan
+						for sub in subs: 												# Iterate over New Subjects
+							for ses in subs[sub]: 										# Iterate over New Sessions
+								watcher.add(sub, ses) 									# Watch Session Upload
+
+					waiting = [] 														# Sessions still Running (i.e. Late Files of a Streamed Session)
+					for sub, ses, reason in study['ready'] + watcher.poll(): 			# Iterate over Uploaded Sessions
+						lane = session_lane(basedir, sub, ses, priorities) 				# Priority Lane
+						if scheduler.submit(basedir, sub, ses, misc, start=study['starts'].get((sub, ses)), # Queue Subject/Session
+											priority=lanes[lane]) == False: 			# Still Queued or Running - Queue once Finished
+							waiting.append((sub, ses, reason))
+							continue
+						study['starts'].pop((sub, ses), None) 							# Resumed Stage Used
+						study_log.info('%s %s Uploaded  : %s (%s)', sub, ses, reason, lane) # Study Log - Session Ready
+						start_session(basedir, sub, ses) 								# Subject Log - Header
+						ledger.set_status(sub, ses, 'queued') 							# Participant Ledger - Queued
+					study['ready'] = waiting 											# Reprocessed Sessions Queued (Running Sessions Wait)
+					uploading = uploading or len(watcher.pending) > 0
+
+				if args.daemon or uploading: 											# Sessions still Uploading (or Waiting for Events)
+					scheduler.step(timeout=args.poll) 									# Run Stages until next Upload Check
+				else: 																	# All Sessions Uploaded
+					scheduler.drain() 													# No more Sessions - Do not Wait for Batches to Fill
+					scheduler.step() 													# Run Stages
+				report_crashes(scheduler) 												# Worker Lost - Scheduler Recovered, Keep Serving
+	except KeyboardInterrupt: 															# Stopped by User
+		for basedir in studies: 														# Iterate over Studies
+			use_study(basedir)
+			study_log.info('Interrupted....') 											# Study Log - Interrupted
+	finally:
+		for study in studies.values(): 													# Iterate over Studies
+			if study.get('server') is not None: 										# Daemon Mode
+				study['server'].close() 												# Stop Listening (Remove Address File)
+		if pool is not None: 															# Warm Osprey Workers
+			for basedir in studies: 													# Iterate over Studies
+				use_study(basedir)
+				study_log.info('Osprey    : %d job(s) in %.1f s, %d timeout(s)', pool.stats['jobs'], # Study Log - Worker Pool
+							   pool.stats['seconds'], pool.stats['timeouts'])
+			pool.close() 																# Stop Workers
+
+	for basedir in studies: 															# Iterate over Studies
+		use_study(basedir)
+		ledger.close() 																	# Participant Ledger - Close
+		study_log.info('Exiting....') 													# Study Log - Exiting
+		study_log.info('--'*30) 														# Study Log - Dashed Line to Separate Entries
+		close_log(study_log) 															# Study Log - Close File
+	log_queue.stop() 																	# Write Queued Records
 
 	print('-- '*30) 																	# Watchman Log - Dashed Line Between Entries
 	print(' ')    																		# Watchman Log - Space Between Entries
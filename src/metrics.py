@@ -0,0 +1,198 @@
+from datetime import datetime 															# Date and Time
+import subprocess 																		# Child Process Timeouts
+import threading 																		# Records Written from Callbacks
+import time as t0 																		# Timer
+import json 																			# JSON Files
+import sys 																				# System Operations
+import os 																				# Operating System
+
+fields = ['sub', 'ses', 'stage', 'status', 'queue_wait', 'wall', 'cpu', 'maxrss', 'exit_code'] # Stage Record Fields
+
+def wait(process, timeout=None): 														# Wait for a Child Process and its Resource Usage
+	'''
+	- 1. Description:
+		- Waits for a child process (subprocess.Popen) and collects its resource
+		    usage with os.wait4: CPU time (user + system) and peak resident set
+		    size, both including the children it waited for (i.e. the programs
+		    started by a shell). On systems without os.wait4 (Windows) only the
+		    exit code is returned.
+
+	- 2. Inputs:
+		- process  : (Popen ) Child process
+		- timeout  : (Float ) Seconds to wait (subprocess.TimeoutExpired after)
+
+	- 3. Outputs:
+		- exit_code: (Int   ) Exit code of the child process
+		- usage    : (Dict  ) cpu (Seconds) and maxrss (Bytes); empty if unknown
+	'''
+
+	if hasattr(os, 'wait4') == False: 													# No Resource Usage Available
+		return process.wait(timeout=timeout), {}
+
+	start = t0.time() 																	# Wait Start
+	try:
+		while True: 																	# Until the Child Exits
+			pid, status, rusage = os.wait4(process.pid, 0 if timeout is None else os.WNOHANG) # Wait and Collect Usage
+			if pid != 0: 																# Child Exited
+				break
+			if t0.time() - start >= timeout: 											# Waited too Long
+				raise subprocess.TimeoutExpired(process.args, timeout)
+			t0.sleep(0.2) 																# Check Again
+	except ChildProcessError: 															# Already Waited for
+		return process.wait(), {}
+
+	process.returncode = os.waitstatus_to_exitcode(status) 								# Exit Code (Popen can no longer Wait)
+	scale  = 1 if sys.platform == 'darwin' else 1024 									# ru_maxrss in Bytes (macOS) or Kilobytes
+	return process.returncode, {'cpu'   : rusage.ru_utime + rusage.ru_stime, 			# CPU Time
+								'maxrss': rusage.ru_maxrss * scale} 					# Peak Resident Set Size
+
+def physical_memory(): 																	# Physical Memory of the Node (Bytes)
+	try: 																				# Not Available on every Platform (i.e. Windows)
+		return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+	except (AttributeError, ValueError, OSError): 										# Unknown
+		return None
+
+def percentile(values, q): 																# Percentile (Linear Interpolation)
+	values = sorted(values) 															# Sorted Values
+	if len(values) == 0: 																# No Values
+		return None
+	pos    = (len(values) - 1) * q / 100 												# Fractional Position
+	lo     = int(pos) 																	# Lower Neighbour
+	hi     = min(lo + 1, len(values) - 1) 												# Upper Neighbour
+	return values[lo] + (values[hi] - values[lo]) * (pos - lo)
+
+class StageMetrics(): 																	# Structured Stage Records
+	'''
+	- 1. Description:
+		- Writes one record per stage call (sub, ses, stage, status, queue wait,
+		    wall time, child CPU time, peak RSS, exit code) to a JSON lines file,
+		    and keeps a Prometheus textfile-collector file with per-stage totals
+		    up to date (i.e. for node_exporter --collector.textfile.directory).
+
+		  Note: The Prometheus file is replaced in one step after every record,
+		    so the collector never reads a partially written file. Totals start
+		    from zero whenever the pipeline is started (Prometheus counters).
+
+	- 2. Inputs:
+		- jsonfile : (String) JSON lines file (i.e. {basedir}/stage_metrics.jsonl)
+		- promfile : (String) Prometheus textfile (None = no Prometheus output)
+		- study    : (String) Study name (Prometheus label)
+	'''
+
+	def __init__(self, jsonfile, promfile=None, study=''):
+
+		self.jsonfile = jsonfile 														# JSON Lines File
+		self.promfile = promfile 														# Prometheus Textfile
+		self.study    = study 															# Study Label
+		self.lock     = threading.Lock() 												# One Writer at a Time
+		self.totals   = {} 																# (Stage, Status) -> Totals
+
+	def record(self, sub, ses, stage, status, details): 								# Record a Stage Call
+		'''
+		- 1. Description:
+			- Append a stage record and update the Prometheus totals.
+
+		- 2. Inputs:
+			- sub      : (String) Current Subject as string
+			- ses      : (String) Current Subject's Session as string
+			- stage    : (String) Stage name
+			- status   : (String) Stage status (success, failed)
+			- details  : (Dict  ) Stage details (queue_wait, wall, cpu, maxrss, exit_code, cached)
+		'''
+
+		record = {'time': datetime.now().isoformat(timespec='seconds'), 				# Record Time
+				  'sub' : sub, 'ses': ses, 'stage': stage, 'status': status} 			# Session and Stage
+		for field in fields[4:] + ['cached']: 											# Measurements
+			record[field] = details.get(field)
+
+		with self.lock: 																# One Writer at a Time
+			with open(self.jsonfile, 'a') as f: 										# Append Record
+				f.write(json.dumps(record) + '\n')
+
+			totals = self.totals.setdefault((stage, status), {'count': 0, 'wall': 0.0, 'cpu': 0.0, 'queue_wait': 0.0, 'maxrss': 0})
+			totals['count']      += 1 													# Stage Calls
+			totals['wall']       += record['wall'] or 0 								# Wall Time
+			totals['cpu']        += record['cpu'] or 0 									# Child CPU Time
+			totals['queue_wait'] += record['queue_wait'] or 0 							# Queue Wait
+			totals['maxrss']      = max(totals['maxrss'], record['maxrss'] or 0) 		# Peak RSS
+			if self.promfile is not None: 												# Prometheus Output
+				self.write_prom()
+
+	def write_prom(self): 																# Write Prometheus Textfile
+		metrics = [('runs_total'                , 'counter', 'Stage calls'                       , 'count'),
+				   ('wall_seconds_total'        , 'counter', 'Wall time of stage calls'          , 'wall'),
+				   ('cpu_seconds_total'         , 'counter', 'CPU time of stage child processes' , 'cpu'),
+				   ('queue_wait_seconds_total'  , 'counter', 'Time sessions waited for the stage', 'queue_wait'),
+				   ('max_rss_bytes'             , 'gauge'  , 'Peak RSS of a stage child process' , 'maxrss')]
+
+		lines   = [] 																	# Textfile Lines
+		for name, kind, helptext, key in metrics: 										# Iterate over Metrics
+			name = 'mrs_pipeline_stage_{}'.format(name) 								# Metric Name
+			lines.append('# HELP {} {}'.format(name, helptext))
+			lines.append('# TYPE {} {}'.format(name, kind))
+			for (stage, status), totals in sorted(self.totals.items()): 				# Iterate over Stages
+				lines.append('{}{{study="{}",stage="{}",status="{}"}} {}'.format(name, self.study, stage, status, totals[key]))
+
+		tmpfile = '{}.tmp'.format(self.promfile) 										# Write to Temporary File First
+		with open(tmpfile, 'w') as f: 													# Write Textfile
+			f.write('\n'.join(lines) + '\n')
+		os.replace(tmpfile, self.promfile) 												# Replace Textfile in one Step
+
+def load(jsonfile): 																	# Read Stage Records
+	records = [] 																		# Stage Records
+	with open(jsonfile, 'r') as f: 														# Read JSON Lines
+		for line in f: 																	# Iterate over Records
+			try:
+				records.append(json.loads(line))
+			except ValueError: 															# Partially Written Line
+				continue
+	return records
+
+def summarize(records): 																# Stage Duration Percentiles
+	'''
+	- 1. Description:
+		- Summarize stage records per stage: number of calls, failures, p50 and
+		    p95 of wall time and queue wait, mean child CPU time and peak RSS.
+		    Cached (skipped) stage calls are counted but not included in the
+		    durations.
+
+	- 2. Inputs:
+		- records  : (List  ) Stage records (see StageMetrics.record)
+
+	- 3. Outputs:
+		- summary  : (List  ) One dictionary per stage (in order of appearance)
+	'''
+
+	stages  = {} 																		# Stage -> Records
+	for record in records: 																# Iterate over Records
+		stages.setdefault(record['stage'], []).append(record)
+
+	summary = [] 																		# Stage Summaries
+	for stage, recs in stages.items(): 													# Iterate over Stages
+		ran   = [rec for rec in recs if rec.get('cached') != True] 						# Stage Calls that Ran
+		walls = [rec['wall'] for rec in ran if rec.get('wall') is not None] 			# Wall Times
+		waits = [rec['queue_wait'] for rec in recs if rec.get('queue_wait') is not None] # Queue Waits
+		cpus  = [rec['cpu'] for rec in ran if rec.get('cpu') is not None] 				# Child CPU Times
+		rss   = [rec['maxrss'] for rec in ran if rec.get('maxrss') is not None] 		# Peak RSS
+		summary.append({'stage'    : stage, 											# Stage Name
+						'calls'    : len(recs), 										# Stage Calls
+						'failed'   : sum(rec['status'] == 'failed' for rec in recs), 	# Failed Calls
+						'cached'   : len(recs) - len(ran), 								# Skipped Calls
+						'wall_p50' : percentile(walls, 50), 							# Median Wall Time
+						'wall_p95' : percentile(walls, 95), 							# 95th Percentile Wall Time
+						'wait_p50' : percentile(waits, 50), 							# Median Queue Wait
+						'wait_p95' : percentile(waits, 95), 							# 95th Percentile Queue Wait
+						'cpu_mean' : sum(cpus) / len(cpus) if len(cpus) > 0 else None, 	# Mean Child CPU Time
+						'rss_max'  : max(rss) if len(rss) > 0 else None}) 				# Peak RSS
+	return summary
+
+def format_summary(summary): 															# Stage Summary Table
+	fmt   = lambda value, scale=1: '-' if value is None else '{:.1f}'.format(value / scale) # Number or Dash
+	lines = ['{:<12}{:>7}{:>7}{:>7}{:>10}{:>10}{:>10}{:>10}{:>10}{:>10}'.format(
+			 'stage', 'calls', 'failed', 'cached', 'wall p50', 'wall p95', 'wait p50', 'wait p95', 'cpu mean', 'rss MB')]
+	for row in summary: 																# Iterate over Stages
+		lines.append('{:<12}{:>7}{:>7}{:>7}{:>10}{:>10}{:>10}{:>10}{:>10}{:>10}'.format(
+					 row['stage'], row['calls'], row['failed'], row['cached'],
+					 fmt(row['wall_p50']), fmt(row['wall_p95']), fmt(row['wait_p50']), fmt(row['wait_p95']),
+					 fmt(row['cpu_mean']), fmt(row['rss_max'], 1024 * 1024)))
+	return '\n'.join(lines)
@@ -0,0 +1,145 @@
+import struct 																			# Header Unpacking
+import gzip 																			# Compressed NIfTI Files
+import json 																			# NIfTI-MRS Header Extension
+import os 																				# Operating System
+
+import numpy as np 																		# Data Arrays
+
+datatypes = {2: np.uint8, 4: np.int16, 8: np.int32, 16: np.float32, 32: np.complex64, 	# NIfTI Datatype Codes
+			 64: np.float64, 512: np.uint16, 1792: np.complex128}
+
+def read_header(raw): 																	# Parse a NIfTI-1 or NIfTI-2 Header
+	'''
+	- 1. Description:
+		- Reads the dimensions, datatype, voxel sizes, data offset, scaling and
+		    intent name of a NIfTI-1 (348 byte) or NIfTI-2 (540 byte) header in
+		    either byte order, and the header extensions that follow it.
+
+	- 2. Inputs:
+		- raw      : (Bytes ) Start of the file (at least up to the data offset)
+
+	- 3. Outputs:
+		- header   : (Dict  ) version, order, shape, datatype, pixdim, offset,
+							    slope, inter, intent, extensions (code -> bytes)
+							    and raw (header bytes, see write_nifti)
+	'''
+
+	for order in '<>': 																	# Byte Order from Header Size
+		size = struct.unpack_from(order + 'i', raw, 0)[0]
+		if size in (348, 540):
+			break
+	else:
+		raise ValueError('not a NIfTI file')
+
+	if size == 348: 																	# NIfTI-1
+		dim    = struct.unpack_from(order + '8h', raw, 40)
+		dtype, = struct.unpack_from(order + 'h', raw, 70)
+		pixdim = struct.unpack_from(order + '8f', raw, 76)
+		offset, slope, inter = struct.unpack_from(order + '3f', raw, 108)
+		intent = raw[328:344]
+	else: 																				# NIfTI-2
+		dtype, = struct.unpack_from(order + 'h', raw, 12)
+		dim    = struct.unpack_from(order + '8q', raw, 16)
+		pixdim = struct.unpack_from(order + '8d', raw, 104)
+		offset, = struct.unpack_from(order + 'q', raw, 168)
+		slope, inter = struct.unpack_from(order + '2d', raw, 176)
+		intent = raw[508:524]
+
+	extensions = {} 																	# Code -> Content
+	pos = size + 4 																		# After the Extension Flag
+	if len(raw) >= pos and raw[size] != 0: 												# Extensions Present
+		while pos + 8 <= int(offset): 													# Iterate over Extensions
+			esize, ecode = struct.unpack_from(order + '2i', raw, pos)
+			if esize < 8: 																# Malformed Extension
+				break
+			extensions[ecode] = bytes(raw[pos + 8:pos + esize])
+			pos += esize
+
+	if dtype not in datatypes: 															# Unsupported Datatype
+		raise ValueError('unsupported NIfTI datatype {}'.format(dtype))
+	return {'version': 1 if size == 348 else 2, 'order': order, 'shape': tuple(int(d) for d in dim[1:1 + dim[0]]),
+			'datatype': np.dtype(datatypes[dtype]).newbyteorder(order), 'pixdim': list(pixdim),
+			'offset': int(offset), 'slope': slope, 'inter': inter,
+			'intent': bytes(intent).split(b'\x00')[0].decode(errors='replace'), 'extensions': extensions,
+			'raw': bytes(raw[:size])}
+
+def read_nifti(path): 																	# Read a NIfTI(-MRS) File
+	'''
+	- 1. Description:
+		- Reads a NIfTI file without copying its data: an uncompressed .nii is
+		    memory-mapped, a .nii.gz is decompressed once and the array is a
+		    view of the decompressed bytes. The array is column major (as
+		    stored), with the shape of the header. The NIfTI-MRS header
+		    extension (code 44) is returned parsed.
+
+	- 2. Inputs:
+		- path     : (String) .nii or .nii.gz file
+
+	- 3. Outputs:
+		- header   : (Dict  ) See read_header
+		- mrs      : (Dict  ) NIfTI-MRS header extension ({} if none)
+		- data     : (Array ) Data array (read-only)
+	'''
+
+	if path.endswith('.gz'): 															# Decompress (No Random Access)
+		with gzip.open(path, 'rb') as f:
+			raw = np.frombuffer(f.read(), dtype=np.uint8)
+	else: 																				# Map File
+		raw = np.memmap(path, dtype=np.uint8, mode='r')
+
+	header = read_header(raw[:max(548, min(len(raw), 1 << 20))].tobytes()) 				# Header and Extensions (up to 1 MB)
+	if header['offset'] > 1 << 20: 														# Very Large Extensions
+		header = read_header(raw[:header['offset']].tobytes())
+	count  = int(np.prod(header['shape'])) 												# Values in File
+	data   = raw[header['offset']:header['offset'] + count * header['datatype'].itemsize]
+	data   = data.view(header['datatype']).reshape(header['shape'], order='F') 			# Column Major as Stored
+
+	mrs    = {} 																		# NIfTI-MRS Header Extension
+	if 44 in header['extensions']: 														# Extension Present
+		mrs = json.loads(header['extensions'][44].rstrip(b'\x00 ').decode(errors='replace'))
+	return header, mrs, data
+
+def write_nifti(path, header, data, mrs=None): 											# Write a NIfTI(-MRS) File
+	'''
+	- 1. Description:
+		- Writes data with the header of another file (see read_nifti): its
+		    version, byte order, orientation and voxel sizes are kept, and the
+		    dimensions, datatype, data offset and NIfTI-MRS header extension
+		    are replaced. A path ending in .gz is compressed (fast level).
+
+	- 2. Inputs:
+		- path     : (String) .nii or .nii.gz file
+		- header   : (Dict  ) Header of the original file (see read_header)
+		- data     : (Array ) Data array (i.e. complex64, up to 7 dimensions)
+		- mrs      : (Dict  ) NIfTI-MRS header extension (None = none)
+	'''
+
+	order  = header['order'] 															# Byte Order of Original
+	codes  = {np.dtype(dtype): code for code, dtype in datatypes.items()} 				# Datatype -> Code
+	data   = np.asarray(data)
+	dtype  = codes[data.dtype.newbyteorder('=')] 										# NIfTI Datatype Code
+	dim    = [data.ndim] + list(data.shape) + [1] * (7 - data.ndim) 					# Dimensions
+
+	ext    = b'' 																		# Header Extension
+	if mrs is not None: 																# NIfTI-MRS JSON (ecode 44)
+		content = json.dumps(mrs).encode()
+		content += b' ' * (-(len(content) + 8) % 16) 									# Extensions are Multiples of 16 Bytes
+		ext     = struct.pack(order + '2i', len(content) + 8, 44) + content
+	raw    = bytearray(header['raw']) 													# Original Header
+	offset = len(raw) + 4 + len(ext) 													# Data after Extension Flag and Extension
+
+	if header['version'] == 1: 															# NIfTI-1
+		struct.pack_into(order + '8h', raw, 40, *dim)
+		struct.pack_into(order + '2h', raw, 70, dtype, data.dtype.itemsize * 8) 		# Datatype and Bits per Voxel
+		struct.pack_into(order + 'f', raw, 108, offset)
+	else: 																				# NIfTI-2
+		struct.pack_into(order + '2h', raw, 12, dtype, data.dtype.itemsize * 8) 		# Datatype and Bits per Voxel
+		struct.pack_into(order + '8q', raw, 16, *dim)
+		struct.pack_into(order + 'q', raw, 168, offset)
+
+	content = bytes(raw) + struct.pack('4b', 1 if len(ext) > 0 else 0, 0, 0, 0) + ext
+	content += data.astype(data.dtype.newbyteorder(order)).tobytes(order='F') 			# NIfTI Stores Column Major
+	tmpfile = '{}.{}.tmp'.format(path, os.getpid()) 									# Write to Temporary File First
+	with (gzip.open(tmpfile, 'wb', compresslevel=1) if path.endswith('.gz') else open(tmpfile, 'wb')) as f:
+		f.write(content)
+	os.replace(tmpfile, path) 															# Replace File in one Step
@@ -0,0 +1,194 @@
+import numpy as np 																		# Vectorised Spectra
+
+from nifti import read_nifti 															# Memory-Mapped NIfTI-MRS
+
+thresholds = {'min_snr'       : 5.0, 													# NAA Peak over Noise (Averaged Spectrum)
+			  'max_fwhm'      : 20.0, 													# Water Linewidth of the Reference (Hz)
+			  'max_drift'     : 10.0, 													# Frequency Drift over the Transients (Hz)
+			  'min_transients': 1, 														# Usable Transients
+			  'max_water'     : 0.5} 													# Water Peak of the Scan over the Reference (Water-Only Scans)
+windows    = {'naa'  : (1.8, 2.3), 														# ppm Windows
+			  'water': (4.4, 4.9),
+			  'noise': (-4.0, -1.0)}
+
+def load_fids(path): 																	# Transients of a NIfTI-MRS File
+	'''
+	- 1. Description:
+		- Reads a single voxel NIfTI-MRS file as FIDs of shape (points, coils,
+		    transients). The coil dimension is the one tagged DIM_COIL in the
+		    header extension; every other higher dimension (DIM_DYN, DIM_EDIT,
+		    ...) counts as transients.
+
+	- 2. Inputs:
+		- path     : (String) NIfTI-MRS file
+
+	- 3. Outputs:
+		- fids     : (Array ) complex FIDs (points, coils, transients)
+		- info     : (Dict  ) dwell (s), freq (MHz) and voxel (mm)
+	'''
+
+	header, mrs, data = read_nifti(path)
+	fids   = transients(data, mrs) 														# (points, coils, transients)
+
+	freq   = mrs.get('SpectrometerFrequency', [123.2]) 									# MHz
+	info   = {'dwell': header['pixdim'][4], 'freq': freq[0] if isinstance(freq, list) else freq,
+			  'voxel': [round(float(v), 3) for v in header['pixdim'][1:4]], 'points': fids.shape[0]}
+	return fids, info
+
+def coil_weights(fids, usable): 														# Coil Combination Weights
+	first   = fids[:4][:, :, usable].mean(axis=(0, 2)) if usable.any() else np.ones(fids.shape[1]) # Mean First Points per Coil
+	return np.conj(first) / max(np.sum(np.abs(first)), 1e-30) 							# Phase Aligned, Signal Weighted
+
+def transients(data, mrs): 																# FIDs of a Single Voxel NIfTI-MRS Array
+	shape  = list(data.shape) + [1] * (7 - data.ndim) 									# Pad to 7 Dimensions
+	data   = data.reshape(shape, order='F')[0, 0, 0] 									# Single Voxel (points, dim_5, dim_6, dim_7)
+	tags   = [mrs.get('dim_{}'.format(d), 'DIM_DYN') for d in (5, 6, 7)] 				# Higher Dimension Tags
+	coil   = [i + 1 for i, tag in enumerate(tags) if tag == 'DIM_COIL'] 				# Coil Axis
+	data   = np.moveaxis(data, coil[0], 1) if len(coil) > 0 else data[:, None] 			# (points, coils, ...)
+	return data.reshape(data.shape[0], data.shape[1], -1, order='F') 					# (points, coils, transients)
+
+def usable_transients(fids): 															# Transients that are not Missing
+	energy = np.sum(np.abs(fids) ** 2, axis=(0, 1)) 									# Signal per Transient
+	return np.isfinite(energy) & (energy > 0) 											# Missing Transients are Zero (or NaN)
+
+def combine(fids, weights=None): 														# Coil Combination and Usable Transients
+	'''
+	- 1. Description:
+		- Combines the coils of every transient, weighted by the conjugate of
+		    their mean first points (phase aligned and signal weighted), and
+		    marks the transients that are empty or not finite.
+
+	- 2. Inputs:
+		- fids     : (Array ) complex FIDs (points, coils, transients)
+		- weights  : (Array ) Coil weights (i.e. of the water reference; None = from fids)
+
+	- 3. Outputs:
+		- combined : (Array ) complex FIDs (points, transients)
+		- usable   : (Array ) bool per transient
+	'''
+
+	usable   = usable_transients(fids) 													# Missing Transients
+	weights  = coil_weights(fids, usable) if weights is None else weights 				# Coil Weights
+	combined = np.einsum('nct,c->nt', fids, weights.astype(fids.dtype)) 				# (points, transients)
+	return combined, usable
+
+def spectrum(fids, info, fill=4): 														# Spectra and ppm Axis
+	points = fids.shape[0] * fill 														# Zero-Filled Points
+	spec   = np.fft.fftshift(np.fft.fft(fids, n=points, axis=0), axes=0) 				# Spectra (along points)
+	ppm    = 4.65 + np.fft.fftshift(np.fft.fftfreq(points, info['dwell'])) / info['freq'] # Chemical Shift Axis
+	return spec, ppm
+
+def window(ppm, name): 																	# Points of a ppm Window
+	lo, hi = windows[name]
+	return (ppm >= lo) & (ppm <= hi)
+
+def peak(spec, ppm, name): 																# Tallest Peak in a Window (Magnitude)
+	inside = np.flatnonzero(window(ppm, name))
+	if len(inside) == 0: 																# Window outside Spectral Width
+		return None, 0.0
+	index  = inside[np.argmax(np.abs(spec[inside]))]
+	return index, float(np.abs(spec[index]))
+
+def fwhm(spec, index, hz_per_point): 													# Linewidth of a Peak (Hz)
+	real  = np.real(spec * np.exp(-1j * np.angle(spec[index]))) 						# Phased at the Peak (Absorption)
+	half  = real[index] / 2
+	left  = index 																		# Walk Down to Half Maximum
+	while left > 0 and real[left] > half:
+		left -= 1
+	right = index
+	while right < len(real) - 1 and real[right] > half:
+		right += 1
+	if real[left] > half or real[right] > half: 										# Peak Wider than Spectrum
+		return float('inf')
+	lpos  = left + (half - real[left]) / (real[left + 1] - real[left]) 					# Interpolated Crossings
+	rpos  = right - (half - real[right]) / (real[right - 1] - real[right])
+	return float((rpos - lpos) * hz_per_point)
+
+def drift(combined, info, blocks=8): 													# Frequency Drift over Transients (Hz)
+	'''
+	- 1. Description:
+		- Averages the transients in up to blocks consecutive blocks, finds
+		    the NAA peak of every block at once (zero-filled spectra and
+		    parabolic interpolation) and returns its frequency range.
+	'''
+
+	count  = combined.shape[1] // max(1, min(blocks, combined.shape[1])) 				# Transients per Block
+	blocks = combined.shape[1] // count
+	if blocks < 2: 																		# Single Block
+		return 0.0
+	spec, ppm = spectrum(combined[:, :blocks * count].reshape(combined.shape[0], blocks, count).mean(axis=2), info, fill=8)
+	inside = np.flatnonzero(window(ppm, 'naa')) 										# NAA Window
+	if len(inside) < 3: 																# Window outside Spectral Width
+		return 0.0
+	mag    = np.abs(spec[inside]) 														# (window points, blocks)
+	top    = np.clip(np.argmax(mag, axis=0), 1, len(inside) - 2) 						# Peak per Block
+	cols   = np.arange(blocks)
+	a, b, c = mag[top - 1, cols], mag[top, cols], mag[top + 1, cols] 					# Neighbours for Interpolation
+	offset = np.where(a - 2 * b + c != 0, 0.5 * (a - c) / np.where(a - 2 * b + c != 0, a - 2 * b + c, 1), 0)
+	hz     = (inside[0] + top + offset) / (len(ppm) * info['dwell']) 					# Peak Frequencies (Hz from Spectrum Start)
+	return float(hz.max() - hz.min())
+
+def check_pair(scan, ref, limits=None): 												# Pre-Flight QC of a Scan and its Reference
+	'''
+	- 1. Description:
+		- Estimates, from the memory-mapped NIfTI-MRS data and vectorised
+		    over all transients: the usable transients, the SNR of NAA in the
+		    averaged spectrum, the water linewidth of the reference (and of NAA
+		    in the scan), the frequency drift over the transients, and the
+		    water peak of the scan relative to the reference (a water-only or
+		    swapped scan). Scan and reference must have the same spectrometer
+		    frequency, dwell time and voxel size (same acquisition).
+
+	- 2. Inputs:
+		- scan     : (String) Metabolite NIfTI-MRS file
+		- ref      : (String) Water reference NIfTI-MRS file (None = no reference)
+		- limits   : (Dict  ) Thresholds (see thresholds; missing keys use the defaults)
+
+	- 3. Outputs:
+		- metrics  : (Dict  ) transients, usable, snr, fwhm_hz, naa_fwhm_hz, drift_hz, water
+		- failures : (List  ) Failed checks (i.e. snr 3.1 < 5); empty = passed
+	'''
+
+	limits   = dict(thresholds, **(limits or {})) 										# Thresholds
+	fids, info = load_fids(scan)
+	combined, usable = combine(fids)
+	metrics  = {'transients': int(usable.size), 'usable': int(usable.sum())}
+	failures = []
+	if metrics['usable'] < max(1, limits['min_transients']): 							# Too many Missing Transients
+		failures.append('transients {} usable of {} (min {})'.format(metrics['usable'], metrics['transients'], limits['min_transients']))
+	if metrics['usable'] == 0: 															# Nothing to Measure
+		return metrics, failures
+
+	good     = combined[:, usable] 														# Usable Transients
+	spec, ppm = spectrum(good.mean(axis=1), info, fill=1) 								# Averaged Spectrum (Noise Statistics)
+	noise    = np.real(spec[window(ppm, 'noise')]) 										# Noise Window
+	noise    = np.std(noise - np.polyval(np.polyfit(np.arange(noise.size), noise, 1), np.arange(noise.size))) if noise.size > 2 else 0.0 # Detrended Noise
+	spec, ppm = spectrum(good.mean(axis=1), info) 										# Zero-Filled (Peak Heights, Linewidths)
+	hz_point = 1 / (len(ppm) * info['dwell']) 											# Spectral Resolution
+	index, naa = peak(spec, ppm, 'naa') 												# NAA Peak
+	metrics['snr']         = round(float(naa / noise), 1) if noise > 0 else float('inf')
+	metrics['naa_fwhm_hz'] = round(fwhm(spec, index, hz_point), 2) if index is not None else None
+	metrics['drift_hz']    = round(drift(good, info), 2)
+	if metrics['snr'] < limits['min_snr']:
+		failures.append('snr {} < {}'.format(metrics['snr'], limits['min_snr']))
+	if metrics['drift_hz'] > limits['max_drift']:
+		failures.append('drift {} Hz > {}'.format(metrics['drift_hz'], limits['max_drift']))
+
+	if ref is not None: 																# Reference Checks
+		rfids, rinfo = load_fids(ref)
+		if (abs(rinfo['freq'] - info['freq']) > 1e-3 * info['freq'] or 					# Different Acquisition
+			abs(rinfo['dwell'] - info['dwell']) > 1e-3 * info['dwell'] or rinfo['voxel'] != info['voxel']):
+			failures.append('reference does not match scan (freq {} / {} MHz, dwell {} / {} s, voxel {} / {})'.format(
+							info['freq'], rinfo['freq'], info['dwell'], rinfo['dwell'], info['voxel'], rinfo['voxel']))
+			return metrics, failures
+		rcombined, rusable = combine(rfids)
+		rspec, rppm = spectrum(rcombined[:, rusable].mean(axis=1) if rusable.any() else rcombined[:, 0], rinfo)
+		rindex     = int(np.argmax(np.abs(rspec))) 										# Tallest Peak (Water)
+		metrics['fwhm_hz'] = round(fwhm(rspec, rindex, 1 / (len(rppm) * rinfo['dwell'])), 2)
+		water      = peak(spec, ppm, 'water')[1] / max(peak(rspec, rppm, 'water')[1], 1e-30) # Water of Scan over Reference
+		metrics['water']   = round(water, 3)
+		if metrics['fwhm_hz'] > limits['max_fwhm']:
+			failures.append('water linewidth {} Hz > {}'.format(metrics['fwhm_hz'], limits['max_fwhm']))
+		if metrics['water'] > limits['max_water']:
+			failures.append('water {} of reference > {} (water-only scan or swapped pair)'.format(metrics['water'], limits['max_water']))
+	return metrics, failures
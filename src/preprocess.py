@@ -0,0 +1,168 @@
+from datetime import datetime 															# Date and Time
+import os 																				# Operating System
+
+import numpy as np 																		# Vectorised Spectra
+
+from nifti import read_nifti, write_nifti 												# NIfTI-MRS Files
+from preflight import transients, usable_transients, coil_weights, combine 				# Coil Combination
+
+reducible = ['DIM_COIL', 'DIM_DYN'] 													# Dimensions Combined or Averaged
+
+def load(path): 																		# Data of a NIfTI-MRS File
+	'''
+	- 1. Description:
+		- Reads a single voxel NIfTI-MRS file as FIDs of shape (points, coils,
+		    transients), if its higher dimensions are only coils (DIM_COIL) and
+		    transients (DIM_DYN). Other dimensions (i.e. DIM_EDIT of MEGA data)
+		    are left to Osprey.
+
+	- 2. Inputs:
+		- path     : (String) NIfTI-MRS file
+
+	- 3. Outputs:
+		- fids     : (Array ) complex FIDs (points, coils, transients) (None = not reducible)
+		- header   : (Dict  ) NIfTI header (see nifti.read_header)
+		- mrs      : (Dict  ) NIfTI-MRS header extension
+	'''
+
+	header, mrs, data = read_nifti(path)
+	tags   = [mrs.get('dim_{}'.format(d), 'DIM_DYN') for d in range(5, data.ndim + 1)] 	# Higher Dimension Tags
+	if data.shape[:3] != (1, 1, 1) or any(tag not in reducible for tag in tags): 		# Not Single Voxel Coils/Transients
+		return None, header, mrs
+	return transients(data, mrs), header, mrs
+
+def register(fids, ref, dwell, iterations=3): 											# Spectral Registration of all Transients
+	'''
+	- 1. Description:
+		- Estimates the frequency and phase of every transient relative to a
+		    reference FID (spectral registration, Near et al. 2015), for all
+		    transients at once. The start values come from the peak of the
+		    spectrum of fid * conj(ref) (zero-filled), which Gauss-Newton steps
+		    on the complex residual then refine.
+
+	- 2. Inputs:
+		- fids     : (Array ) complex FIDs (points, transients)
+		- ref      : (Array ) complex reference FID (points)
+		- dwell    : (Float ) Dwell time (s)
+		- iterations: (Int  ) Gauss-Newton steps
+
+	- 3. Outputs:
+		- freq     : (Array ) Frequency of each transient (Hz)
+		- phase    : (Array ) Phase of each transient (radians)
+	'''
+
+	t      = np.arange(fids.shape[0]) * dwell 											# Time Axis
+	cols   = np.arange(fids.shape[1])
+	cross  = np.fft.fft(fids * np.conj(ref)[:, None], n=8 * fids.shape[0], axis=0) 		# Peaks at the Frequency Offset
+	top    = np.argmax(np.abs(cross), axis=0) 											# Coarse Frequency per Transient
+	freq   = np.fft.fftfreq(cross.shape[0], dwell)[top]
+	phase  = np.angle(cross[top, cols])
+
+	for _ in range(iterations): 														# Gauss-Newton Steps
+		model = ref[:, None] * np.exp(1j * (2 * np.pi * freq[None, :] * t[:, None] + phase[None, :])) # Shifted Reference
+		resid = fids - model 															# Complex Residual
+		jf    = 2j * np.pi * t[:, None] * model 										# d model / d freq
+		jp    = 1j * model 																# d model / d phase
+		a     = np.sum(np.abs(jf) ** 2, axis=0) 										# Normal Equations (2x2 per Transient)
+		b     = np.sum(np.real(np.conj(jf) * jp), axis=0)
+		c     = np.sum(np.abs(jp) ** 2, axis=0)
+		gf    = np.sum(np.real(np.conj(jf) * resid), axis=0)
+		gp    = np.sum(np.real(np.conj(jp) * resid), axis=0)
+		det   = np.where(a * c - b * b > 0, a * c - b * b, np.inf) 						# Singular - No Step
+		freq  = freq + (c * gf - b * gp) / det
+		phase = phase + (a * gp - b * gf) / det
+	return freq, phase
+
+def reduce(fids, dwell, weights=None, align=True, limit=0.2): 							# Coil Combine, Align and Average
+	'''
+	- 1. Description:
+		- Combines the coils of every transient (see preflight.combine), drops
+		    missing transients, aligns the rest in frequency and phase (two
+		    passes of register against their mean, fitted on the first limit
+		    seconds) and averages them.
+
+	- 2. Inputs:
+		- fids     : (Array ) complex FIDs (points, coils, transients)
+		- dwell    : (Float ) Dwell time (s)
+		- weights  : (Array ) Coil weights (i.e. of the water reference; None = from fids)
+		- align    : (Bool  ) Spectral registration before averaging
+		- limit    : (Float ) Seconds of the FIDs used for registration
+
+	- 3. Outputs:
+		- fid      : (Array ) complex64 averaged FID (points)
+		- info     : (Dict  ) averages, transients and the frequency shifts (Hz)
+	'''
+
+	combined, usable = combine(fids, weights) 											# Coil Combined Transients
+	combined = combined[:, usable] 														# Usable Transients
+	info     = {'transients': int(usable.size), 'averages': int(usable.sum()), 'shift_hz': 0.0}
+	if combined.shape[1] == 0: 															# Nothing to Average
+		return None, info
+
+	if align and combined.shape[1] > 1: 												# Spectral Registration
+		t      = np.arange(combined.shape[0]) * dwell 									# Time Axis
+		n      = max(16, min(combined.shape[0], int(limit / dwell))) 					# Points Fitted
+		ref    = combined[:n].mean(axis=1) 												# First Pass Against the Mean
+		for _ in range(2): 																# Second Pass Against the Aligned Mean
+			freq, phase = register(combined[:n], ref, dwell)
+			aligned = combined * np.exp(-1j * (2 * np.pi * freq[None, :] * t[:, None] + phase[None, :]))
+			ref     = aligned[:n].mean(axis=1)
+		combined = aligned
+		info['shift_hz'] = float(np.max(np.abs(freq - np.median(freq)))) 				# Largest Correction
+	return combined.mean(axis=1).astype(np.complex64), info
+
+def reduce_pair(scan, ref, outdir, align=True): 										# Reduced NIfTI-MRS of a Scan and its Reference
+	'''
+	- 1. Description:
+		- Writes coil-combined, aligned and averaged copies of a scan and its
+		    water reference to outdir (same file names), so Osprey loads one
+		    FID per file. The reference is combined first and its coil weights
+		    are used for the scan. The NIfTI-MRS header keeps every field but
+		    the reduced dimensions, and notes the steps in ProcessingApplied.
+		    Files that cannot be reduced (i.e. edited data) keep their path.
+
+	- 2. Inputs:
+		- scan     : (String) Metabolite NIfTI-MRS file
+		- ref      : (String) Water reference NIfTI-MRS file (None = no reference)
+		- outdir   : (String) Directory of the reduced files
+		- align    : (Bool  ) Spectral registration before averaging
+
+	- 3. Outputs:
+		- paths    : (List  ) Reduced (or original) scan and reference paths
+		- info     : (List  ) Averages, transients and shifts of each file
+	'''
+
+	os.makedirs(outdir, exist_ok=True) 													# Reduced Data Directory
+	paths, infos, weights = [], [], None
+	for path in [ref, scan]: 															# Reference First (Coil Weights)
+		if path is None: 																# No Reference
+			continue
+		fids, header, mrs = load(path)
+		if fids is None: 																# Not Reducible - Osprey Reads the Original
+			paths.append(path)
+			infos.append({'reduced': False})
+			continue
+		if path == ref: 																# Coil Weights of the Water Reference
+			weights = coil_weights(fids, usable_transients(fids))
+		if weights is not None and len(weights) != fids.shape[1]: 						# Reference with other Coils
+			weights = None
+		fid, info = reduce(fids, header['pixdim'][4], weights, align)
+		if fid is None: 																# No Usable Transients
+			raise ValueError('no usable transients in {}'.format(path))
+
+		mrs  = {key: value for key, value in mrs.items() 								# Header without Reduced Dimensions
+				if key.startswith(('dim_5', 'dim_6', 'dim_7')) == False}
+		now  = datetime.now().isoformat(timespec='seconds') 							# Processing Time
+		mrs['ProcessingApplied'] = mrs.get('ProcessingApplied', []) + [ 				# Provenance
+			{'Time': now, 'Program': 'preprocess.py', 'Method': 'RF coil combination',
+			 'Details': 'weighted by the conjugate first points of the {}'.format('reference' if weights is not None else 'data')},
+			{'Time': now, 'Program': 'preprocess.py', 'Method': 'Frequency and phase correction',
+			 'Details': 'spectral registration, largest shift {:.2f} Hz'.format(info['shift_hz'])} if align else None,
+			{'Time': now, 'Program': 'preprocess.py', 'Method': 'Signal averaging',
+			 'Details': '{} of {} transients'.format(info['averages'], info['transients'])}]
+		mrs['ProcessingApplied'] = [step for step in mrs['ProcessingApplied'] if step is not None]
+		outfile = '{}/{}'.format(outdir, os.path.basename(path)) 						# Same File Name
+		write_nifti(outfile, header, fid.reshape(1, 1, 1, -1), mrs)
+		paths.append(outfile)
+		infos.append(dict(info, reduced=True))
+	return paths[::-1], infos[::-1] 													# Scan First
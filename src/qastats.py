@@ -0,0 +1,247 @@
+from datetime import datetime 															# Date and Time
+import math 																			# Square Root
+import json 																			# JSON Files
+import os 																				# Operating System
+
+import pandas as pd 																	# Result Tables
+
+from metrics import percentile 															# Percentile (Linear Interpolation)
+
+quantiles = [0.05, 0.5, 0.95] 															# Quantiles Sketched per Metric
+
+class Welford(): 																		# Running Mean and Variance
+	'''
+	- 1. Description:
+		- Keeps the count, mean and sum of squared deviations of a metric, and
+		    updates them one value at a time (Welford's algorithm), so the mean
+		    and standard deviation never need the earlier values.
+	'''
+
+	def __init__(self, state=None):
+		self.n, self.mean, self.m2 = state if state is not None else (0, 0.0, 0.0) 		# Count, Mean, Squared Deviations
+
+	def add(self, value): 																# Add a Value
+		self.n    += 1
+		delta      = value - self.mean
+		self.mean += delta / self.n
+		self.m2   += delta * (value - self.mean)
+
+	def sd(self): 																		# Sample Standard Deviation
+		return math.sqrt(self.m2 / (self.n - 1)) if self.n > 1 else 0.0
+
+	def state(self): 																	# JSON State
+		return [self.n, self.mean, self.m2]
+
+class P2Quantile(): 																	# Streaming Quantile Sketch
+	'''
+	- 1. Description:
+		- Estimates one quantile of a metric without keeping its values (the P²
+		    algorithm of Jain and Chlamtac, 1985). Five markers follow the
+		    minimum, the quantile, the maximum and two points between, and are
+		    moved by a parabolic step after every value.
+
+	- 2. Inputs:
+		- p        : (Float ) Quantile (0 - 1)
+		- state    : (Dict  ) JSON State (see state; None = no values yet)
+	'''
+
+	def __init__(self, p, state=None):
+
+		self.p    = p 																	# Quantile
+		self.q    = [] 																	# Marker Heights (First Values while Fewer than 5)
+		self.pos  = [1, 2, 3, 4, 5] 													# Marker Positions
+		self.want = [1, 1 + 2 * p, 1 + 4 * p, 3 + 2 * p, 5] 							# Desired Marker Positions
+		if state is not None: 															# Restore Markers
+			self.q, self.pos, self.want = state['q'], state['pos'], state['want']
+
+	def add(self, value): 																# Add a Value
+		if len(self.q) < 5: 															# Collect the First Values
+			self.q = sorted(self.q + [value])
+			return
+
+		if value < self.q[0]: 															# New Minimum
+			self.q[0] = value
+			k = 0
+		elif value >= self.q[4]: 														# New Maximum
+			self.q[4] = value
+			k = 3
+		else: 																			# Cell of the Value
+			k = next(i for i in range(4) if self.q[i] <= value < self.q[i + 1])
+
+		for i in range(k + 1, 5): 														# Markers above the Value Move Up
+			self.pos[i] += 1
+		step = [0, self.p / 2, self.p, (1 + self.p) / 2, 1] 							# Desired Position Increments
+		for i in range(5):
+			self.want[i] += step[i]
+
+		for i in range(1, 4): 															# Adjust Middle Markers
+			d = self.want[i] - self.pos[i] 												# Distance to Desired Position
+			if (d >= 1 and self.pos[i + 1] - self.pos[i] > 1) or (d <= -1 and self.pos[i - 1] - self.pos[i] < -1):
+				d = 1 if d > 0 else -1
+				q = self.parabolic(i, d) 												# Parabolic Prediction
+				if (self.q[i - 1] < q < self.q[i + 1]) == False: 						# Outside Neighbours - Linear Step
+					q = self.q[i] + d * (self.q[i + d] - self.q[i]) / (self.pos[i + d] - self.pos[i])
+				self.q[i]    = q
+				self.pos[i] += d
+
+	def parabolic(self, i, d): 															# Piecewise-Parabolic Marker Height
+		q, n = self.q, self.pos
+		return q[i] + d / (n[i + 1] - n[i - 1]) * ((n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i]) +
+												   (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1]))
+
+	def value(self): 																	# Current Estimate
+		if len(self.q) == 0: 															# No Values
+			return None
+		if self.pos[4] <= 5: 															# Exact Quantile of the First Values (Markers not Moved)
+			return percentile(self.q, 100 * self.p)
+		return self.q[2]
+
+	def state(self): 																	# JSON State
+		return {'q': self.q, 'pos': self.pos, 'want': self.want}
+
+def session_group(sidecar): 															# Scanner and Sequence of a Session
+	'''
+	- 1. Description:
+		- Names the group a session is compared with: its scanner (vendor,
+		    model and field strength) and sequence, from the JSON sidecar of its
+		    MRS data. Missing fields are left out (unknown if none are known).
+
+	- 2. Inputs:
+		- sidecar  : (Dict  ) JSON sidecar of the MRS data (None = unknown)
+
+	- 3. Outputs:
+		- group    : (String) i.e. Philips Ingenia 3T PRESS
+	'''
+
+	sidecar = sidecar or {} 															# No Sidecar
+	field   = sidecar.get('MagneticFieldStrength') 										# Field Strength (Tesla)
+	parts   = [sidecar.get('Manufacturer'), sidecar.get('ManufacturersModelName'),
+			   None if field is None else '{:g}T'.format(float(field)),
+			   sidecar.get('SequenceName') or sidecar.get('PulseSequenceType')]
+	parts   = [str(part).strip() for part in parts if part not in (None, '')] 			# Known Fields
+	return ' '.join(parts) if len(parts) > 0 else 'unknown'
+
+def session_metrics(tables): 															# Numeric Metrics of a Session
+	'''
+	- 1. Description:
+		- Lists the numeric values of the result tables of a session (i.e. SNR
+		    and FWHM of the QM tables, metabolite ratios of QuantifyResults),
+		    one per table column and row. The metric is named table:column.
+
+	- 2. Inputs:
+		- tables   : (Dict  ) Table name -> DataFrame (see results.session_tables)
+
+	- 3. Outputs:
+		- values   : (List  ) (Metric, Row, Value)
+	'''
+
+	values = [] 																		# Metric Values
+	for table, frame in sorted(tables.items()): 										# Iterate over Tables
+		for column in frame.columns: 													# Iterate over Columns
+			if pd.api.types.is_numeric_dtype(frame[column]) == False: 					# Not a Metric (i.e. Subject Names)
+				continue
+			for row, value in enumerate(frame[column]): 								# Iterate over Rows
+				if pd.notna(value) and math.isfinite(value): 							# Skip Missing Values
+					values.append(('{}:{}'.format(table, column), row, float(value)))
+	return values
+
+class OnlineStats(): 																	# Streaming Study QA Statistics
+	'''
+	- 1. Description:
+		- Keeps running statistics of every metric per scanner/sequence group:
+		    mean and standard deviation (Welford) and the 5th, 50th and 95th
+		    percentile (P² sketches). Adding a session compares each of its
+		    values with the statistics of its group before the value is added,
+		    and returns an alert for every value more than z standard
+		    deviations from the mean, once the group has min_n values of the
+		    metric. Updating the statistics takes the same time for every
+		    session, however many sessions the study already has.
+
+		  Note: A session is only added once (sessions in the state file), so
+		    rerunning it compares it again without counting it twice. The state
+		    file expects one writer at a time (main.py runs the osprey_results
+		    stage with a limit of 1).
+
+	- 2. Inputs:
+		- statefile: (String) JSON state file (i.e. {basedir}/qa_stats.json)
+		- alertfile: (String) JSON lines alert file (i.e. {basedir}/qa_alerts.jsonl)
+		- z        : (Float ) Standard deviations from the mean that raise an alert
+		- min_n    : (Int   ) Values of a metric in a group before alerts are raised
+	'''
+
+	def __init__(self, statefile, alertfile, z=4.0, min_n=20):
+
+		self.statefile = statefile 														# State File
+		self.alertfile = alertfile 														# Alert File
+		self.z         = z 																# Alert Threshold
+		self.min_n     = min_n 															# Values before Alerts
+		self.state     = {'groups': {}, 'sessions': {}} 								# Group -> Metric -> Statistics
+
+		try: 																			# Load State
+			with open(self.statefile, 'r') as f:
+				self.state = json.loads(f.read())
+		except (OSError, ValueError): 													# New Study
+			pass
+
+	def add_session(self, sub, ses, group, values): 									# Compare and Add a Session
+		'''
+		- 1. Description:
+			- Compares the values of a session with its group, adds them to the
+			    group (unless the session was added before), saves the state and
+			    appends any alerts to the alert file.
+
+		- 2. Inputs:
+			- sub      : (String) Current Subject as string
+			- ses      : (String) Current Subject's Session as string
+			- group    : (String) Scanner/sequence group (see session_group)
+			- values   : (List  ) (Metric, Row, Value) (see session_metrics)
+
+		- 3. Outputs:
+			- alerts   : (List  ) Alert records (Dicts)
+		'''
+
+		session = '{}_{}'.format(sub, ses) 												# Session Key
+		counted = session in self.state['sessions'] 									# Added Before
+		metrics = self.state['groups'].setdefault(group, {}) 							# Metrics of Group
+		alerts  = [] 																	# Alert Records
+
+		for metric, row, value in values: 												# Iterate over Values
+			stats  = metrics.get(metric, {'welford': None, 'quantiles': {}}) 			# Statistics of Metric
+			mean   = Welford(stats['welford']) 											# Mean and Variance
+			sketch = {p: P2Quantile(p, stats['quantiles'].get(str(p))) for p in quantiles} # Quantile Sketches
+
+			sd     = mean.sd() 															# Spread before this Value
+			if mean.n >= self.min_n and sd > 0 and abs(value - mean.mean) / sd >= self.z: # Outlier
+				alerts.append({'time'   : datetime.now().isoformat(timespec='seconds'),
+							   'sub'    : sub, 'ses': ses, 'group': group, 'metric': metric, 'row': row,
+							   'value'  : value, 'z': round((value - mean.mean) / sd, 2),
+							   'n'      : mean.n, 'mean': mean.mean, 'sd': sd,
+							   'p05'    : sketch[0.05].value(), 'p50': sketch[0.5].value(), 'p95': sketch[0.95].value()})
+
+			if counted == False: 														# Add Value to Group
+				mean.add(value)
+				for p in quantiles:
+					sketch[p].add(value)
+				metrics[metric] = {'welford': mean.state(), 'quantiles': {str(p): sketch[p].state() for p in quantiles}}
+
+		if counted == False: 															# Save State
+			self.state['sessions'][session] = group
+			tmpfile = '{}.tmp'.format(self.statefile) 									# Write to Temporary File First
+			with open(tmpfile, 'w') as f:
+				f.write(json.dumps(self.state))
+			os.replace(tmpfile, self.statefile) 										# Replace State in one Step
+
+		if len(alerts) > 0: 															# Study Alert File
+			with open(self.alertfile, 'a') as f:
+				for alert in alerts:
+					f.write(json.dumps(alert) + '\n')
+		return alerts
+
+	def summary(self, group, metric): 													# Current Statistics of a Metric
+		stats  = self.state['groups'].get(group, {}).get(metric) 						# Statistics of Metric
+		if stats is None: 																# Never Seen
+			return None
+		mean   = Welford(stats['welford'])
+		sketch = {p: P2Quantile(p, stats['quantiles'].get(str(p))) for p in quantiles}
+		return {'n': mean.n, 'mean': mean.mean, 'sd': mean.sd(),
+				'p05': sketch[0.05].value(), 'p50': sketch[0.5].value(), 'p95': sketch[0.95].value()}
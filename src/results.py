@@ -0,0 +1,206 @@
+import glob 																			# File Matching
+import json 																			# JSON Files
+import os 																				# Operating System
+
+import numpy as np 																		# Column Arrays
+import pandas as pd 																	# Result Tables
+
+try: 																					# Optional - Parquet Partitions
+	import pyarrow as pa
+	import pyarrow.parquet as pq
+except ImportError: 																	# NumPy Partitions Only
+	pa = None
+
+keys = ['sub', 'ses', 'date', 'row'] 													# Columns Added to every Result Row
+
+def session_tables(outdir): 															# Osprey Result Tables of a Session
+	'''
+	- 1. Description:
+		- Reads every result table (.tsv/.csv, i.e. QuantifyResults and QM
+		    tables) in the Osprey derivatives of a session. The table name is
+		    the path relative to the derivatives folder, without extension and
+		    with dots between folders (i.e. QuantifyResults.A_tCr_Voxel_1).
+
+	- 2. Inputs:
+		- outdir   : (String) Osprey derivatives of a session
+
+	- 3. Outputs:
+		- tables   : (Dict  ) Table name -> DataFrame
+	'''
+
+	tables = {} 																		# Table Name -> Rows
+	for root, dirs, files in os.walk(outdir): 											# Walk Derivatives
+		dirs[:] = sorted(d for d in dirs if d.startswith('.') == False) 				# Skip Hidden Directories
+		for filename in sorted(files): 													# Iterate over Files
+			if filename.endswith(('.tsv', '.csv')) == False: 							# Not a Table
+				continue
+			filepath = os.path.join(root, filename) 									# Full Path
+			name     = os.path.splitext(os.path.relpath(filepath, outdir))[0].replace(os.sep, '.') # Table Name
+			tables[name] = pd.read_csv(filepath, sep='\t' if filename.endswith('.tsv') else ',')
+	return tables
+
+def session_date(ses_dir, sub, ses): 													# Acquisition Date of a Session
+	'''
+	- 1. Description:
+		- Finds the acquisition date of a session from the earliest acq_time in
+		    its BIDS scans table (sub-*_ses-*_scans.tsv, written by bidscoiner).
+		    Without one, the date the session folder was last modified is used.
+
+	- 2. Inputs:
+		- ses_dir  : (String) BIDS Session Directory
+		- sub      : (String) Current Subject as string
+		- ses      : (String) Current Subject's Session as string
+
+	- 3. Outputs:
+		- date     : (String) Session date (YYYY-MM-DD)
+	'''
+
+	for scans in glob.glob('{}/{}*_scans.tsv'.format(ses_dir, sub)): 					# BIDS Scans Table
+		try:
+			times = pd.read_csv(scans, sep='\t')['acq_time'].dropna() 					# Acquisition Times
+			if len(times) > 0:
+				return str(times.astype(str).min())[:10]
+		except (OSError, KeyError, ValueError): 										# No Acquisition Times
+			continue
+	return pd.Timestamp.fromtimestamp(os.path.getmtime(ses_dir)).strftime('%Y-%m-%d')
+
+class ResultsStore(): 																	# Study-Wide Columnar Results Store
+	'''
+	- 1. Description:
+		- Keeps the Osprey result tables of every session of a study in one
+		    columnar store, so study-wide QA reads a few columns of a few files
+		    instead of parsing every session's tables. Each table is kept in
+		    partitions by session month (root/<table>/month=YYYY-MM/part.*),
+		    with the columns sub, ses, date and row added to every row.
+		    Partitions are Parquet files when pyarrow is installed, and .npz
+		    files (one array per column) otherwise; both read only the columns
+		    asked for.
+
+		  Note: Writing a session replaces its earlier rows (in every table and
+		    partition, see index.json), so rerunning a session never duplicates
+		    it. The store expects one writer at a time (main.py runs the
+		    osprey_results stage with a limit of 1).
+
+	- 2. Inputs:
+		- root     : (String) Store Directory (i.e. bids/derivatives/results)
+	'''
+
+	def __init__(self, root):
+
+		self.root      = root 															# Store Directory
+		self.indexfile = '{}/index.json'.format(root) 									# Session -> Month and Tables
+		self.ext       = 'parquet' if pa is not None else 'npz' 						# Partition Format
+		self.index     = {} 															# Sessions in the Store
+
+		try: 																			# Load Session Index
+			with open(self.indexfile, 'r') as f:
+				self.index = json.loads(f.read())
+		except (OSError, ValueError): 													# New Store
+			pass
+
+	def partition(self, table, month): 													# Partition File of a Table and Month
+		return '{}/{}/month={}/part.{}'.format(self.root, table, month, self.ext)
+
+	def read_part(self, path, columns=None): 											# Read a Partition File
+		if path.endswith('.parquet'): 													# Parquet Partition
+			names   = pq.read_schema(path).names 										# Columns in Partition
+			columns = names if columns is None else [c for c in columns if c in names]
+			return pq.read_table(path, columns=columns).to_pandas()
+		with np.load(path) as part: 													# NumPy Partition (Columns Load on Access)
+			names   = list(part.keys()) 												# Columns in Partition
+			columns = names if columns is None else [c for c in columns if c in names]
+			return pd.DataFrame({column: part[column] for column in columns})
+
+	def write_part(self, path, frame): 													# Write a Partition File
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		tmpfile = '{}.tmp.{}'.format(os.path.splitext(path)[0], self.ext) 				# Write to Temporary File First
+		if len(frame) == 0: 															# Partition Empty
+			if os.path.exists(path):
+				os.remove(path)
+			return
+		if self.ext == 'parquet': 														# Parquet Partition
+			pq.write_table(pa.Table.from_pandas(frame, preserve_index=False), tmpfile)
+		else: 																			# NumPy Partition
+			arrays = {} 																# Column -> Array
+			for column in frame.columns: 												# Iterate over Columns
+				values = frame[column] 													# Column Values
+				if pd.api.types.is_numeric_dtype(values) == False: 						# Text Column
+					values = values.fillna('').astype(str) 								# Fixed-Width Text (No Pickles)
+				arrays[str(column)] = values.to_numpy()
+				if arrays[str(column)].dtype == object: 								# Text as Unicode Array
+					arrays[str(column)] = arrays[str(column)].astype(str)
+			np.savez(tmpfile, **arrays)
+		os.replace(tmpfile, path) 														# Replace Partition in one Step
+
+	def write_session(self, sub, ses, date, tables): 									# Add or Replace a Session
+		'''
+		- 1. Description:
+			- Writes the result tables of a session into their partitions,
+			    replacing any rows the session had in the store before.
+
+		- 2. Inputs:
+			- sub      : (String) Current Subject as string
+			- ses      : (String) Current Subject's Session as string
+			- date     : (String) Session date (YYYY-MM-DD)
+			- tables   : (Dict  ) Table name -> DataFrame (see session_tables)
+
+		- 3. Outputs:
+			- rows     : (Int   ) Rows written
+		'''
+
+		session = '{}_{}'.format(sub, ses) 												# Session Key
+		month   = date[:7] 																# Partition Month
+		before  = self.index.get(session, {'month': None, 'tables': []}) 				# Earlier Partitions of Session
+		targets = set((table, month) for table in tables) 								# Partitions to Write
+		targets.update((table, before['month']) for table in before['tables']) 		# Partitions to Clean
+
+		rows    = 0 																	# Rows Written
+		for table, part_month in sorted(targets): 										# Iterate over Partitions
+			path  = self.partition(table, part_month) 									# Partition File
+			frame = self.read_part(path) if os.path.exists(path) else pd.DataFrame() 	# Current Rows
+			if len(frame) > 0: 															# Drop Earlier Rows of Session
+				frame = frame[(frame['sub'] != sub) | (frame['ses'] != ses)]
+			if table in tables and part_month == month: 								# Add Session Rows
+				new   = tables[table].copy()
+				new.insert(0, 'row', np.arange(len(new)))
+				new.insert(0, 'date', date)
+				new.insert(0, 'ses', ses)
+				new.insert(0, 'sub', sub)
+				frame = pd.concat([frame, new], ignore_index=True) if len(frame) > 0 else new
+				rows += len(new)
+			self.write_part(path, frame.reset_index(drop=True))
+
+		self.index[session] = {'month': month, 'tables': sorted(tables)} 				# Session Partitions
+		tmpfile = '{}.tmp'.format(self.indexfile) 										# Write to Temporary File First
+		with open(tmpfile, 'w') as f:
+			f.write(json.dumps(self.index))
+		os.replace(tmpfile, self.indexfile)
+		return rows
+
+	def tables(self): 																	# Tables in the Store
+		return sorted(name for name in os.listdir(self.root) if os.path.isdir(os.path.join(self.root, name))) if os.path.isdir(self.root) else []
+
+	def read(self, table, columns=None, months=None): 									# Read a Table
+		'''
+		- 1. Description:
+			- Reads a table of the store, only the given columns and months.
+			    Columns missing from older partitions are filled with NaN.
+
+		- 2. Inputs:
+			- table    : (String) Table name (i.e. QuantifyResults.A_tCr_Voxel_1)
+			- columns  : (List  ) Columns to read (None = all; i.e. ['sub', 'ses', 'tNAA'])
+			- months   : (List  ) Months to read (YYYY-MM; None = all)
+
+		- 3. Outputs:
+			- frame    : (Frame ) Rows of the table
+		'''
+
+		frames = [] 																	# Partition Rows
+		for path in sorted(glob.glob('{}/{}/month=*/part.{}'.format(self.root, table, self.ext))): # Iterate over Partitions
+			month = os.path.basename(os.path.dirname(path)).split('=', 1)[1] 			# Partition Month
+			if months is None or month in months: 										# Month Wanted
+				frames.append(self.read_part(path, columns))
+		if len(frames) == 0: 															# Nothing Stored
+			return pd.DataFrame(columns=columns)
+		frame  = pd.concat(frames, ignore_index=True)
+		return frame if columns is None else frame.reindex(columns=columns)
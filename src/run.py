@@ -1,20 +1,34 @@
 #!/usr/bin/env python3
-import glob, argparse, os, json
-import numpy as np
+import argparse, os, json, sys
+from bidsindex import BidsIndex
+from dispatch import dispatch, estimate_cost, is_done, run_jobs, write_manifest
 
 
 #Configure the commands that can be fed to the command line
 parser = argparse.ArgumentParser()
-parser.add_argument("bids_dir", help="The path to the BIDS directory for your study (this is the same for all subjects)", type=str)
-parser.add_argument("output_dir", help="The path to the folder where outputs will be stored (this is the same for all subjects)", type=str)
-parser.add_argument("analysis_level", help="Should always be participant", type=str)
-parser.add_argument("json_settings", help="The path to the subject-agnostic JSON file that will be used to configure processing settings", type=str)
+parser.add_argument("bids_dir", help="The path to the BIDS directory for your study (this is the same for all subjects)", type=str, nargs='?')
+parser.add_argument("output_dir", help="The path to the folder where outputs will be stored (this is the same for all subjects)", type=str, nargs='?')
+parser.add_argument("analysis_level", help="Should always be participant", type=str, nargs='?')
+parser.add_argument("json_settings", help="The path to the subject-agnostic JSON file that will be used to configure processing settings", type=str, nargs='?')
 
 parser.add_argument('--participant_label', '--participant-label', help="The name/label of the subject to be processed (i.e. sub-01 or 01)", type=str)
 parser.add_argument('--segmentation_dir', '--segmentation-dir', help="The path to the folder where segmentations are stored (this is the same for all subjects)", type=str)
 parser.add_argument('--session_id', '--session-id', help="OPTIONAL: the name of a specific session to be processed (i.e. ses-01)", type=str)
+parser.add_argument('--n_jobs', '--n-jobs', help="OPTIONAL: the number of processing jobs to run at the same time (default 1)", type=int, default=1)
+parser.add_argument('--plan', help="OPTIONAL: only write the wrapper_settings.json files and a manifest of the pending jobs (default output_dir/osprey_jobs.jsonl)", type=str, nargs='?', const='')
+parser.add_argument('--dispatch', help="OPTIONAL: run the jobs of a manifest written by --plan (no other arguments are needed)", type=str)
+parser.add_argument('--task', help="OPTIONAL: with --dispatch, only run job N of the manifest (i.e. an array task id)", type=int)
+parser.add_argument('--array', help="OPTIONAL: with --dispatch, write an array job script for slurm or pbs instead of running the jobs", type=str, choices=['slurm', 'pbs'])
+parser.add_argument('--array_limit', '--array-limit', help="OPTIONAL: with --array, the number of array tasks to run at the same time", type=int)
 args = parser.parse_args()
 
+#Dispatch mode runs (or hands to a batch system) the jobs of
+#a manifest written by --plan, so no inputs are resolved
+if args.dispatch:
+    sys.exit(dispatch(args.dispatch, n_jobs=args.n_jobs, task=args.task, array=args.array, limit=args.array_limit))
+if args.json_settings is None:
+    parser.error('bids_dir, output_dir, analysis_level and json_settings are required unless --dispatch is given')
+
 compiled_executable_path = os.getenv("EXECUTABLE_PATH")
 mcr_path = os.getenv("MCR_PATH")
 
@@ -56,6 +70,13 @@ if args.segmentation_dir:
 else:
     segmentation_dir = None
 
+#Index the BIDS directory (and segmentation directory) on disk,
+#so inputs and sidecars are looked up instead of globbed. The
+#index is updated incrementally, only listing changed directories
+bids_index = BidsIndex(bids_dir)
+if segmentation_dir:
+    seg_index = BidsIndex(segmentation_dir)
+
 #Find participants to try running
 if args.participant_label:
     participant_split = args.participant_label.split(' ')
@@ -65,9 +86,14 @@ if args.participant_label:
             participants.append('sub-' + temp_participant)
         else:
             participants.append(temp_participant)
+    bids_index.update(participants)
 else:
     os.chdir(bids_dir)
-    participants = glob.glob('sub-*')
+    bids_index.update()
+    participants = bids_index.subjects()
+
+if segmentation_dir:
+    seg_index.update(participants)
 
 
 
@@ -75,9 +101,8 @@ else:
 #############################################################################################################
 #############################################################################################################
 
-def run_processing(settings_dict, mrs_files_dict, anat_files_dict, derivs_folder_path,
-                   participant_label, session_partial_path, sequence, index,
-                   compiled_executable_path, mcr_path):
+def prepare_processing(settings_dict, mrs_files_dict, anat_files_dict, derivs_folder_path,
+                       participant_label, session_partial_path, sequence, index):
 
     #If this is the first instance of this session/config combo being used for processing
     #dont number it with *_index, otherwise add the index
@@ -103,11 +128,32 @@ def run_processing(settings_dict, mrs_files_dict, anat_files_dict, derivs_folder
         joint_json = json.dumps(joint_dict, indent = 4)
         f.write(joint_json)
 
-    #Run osprey
-    print('Running: ' + compiled_executable_path + ' ' + mcr_path + ' ' + json_output_path)
-    os.system(compiled_executable_path + ' ' + mcr_path + ' ' + json_output_path)
-
-    return
+    return json_output_path
+
+def plan_work_item(work_item, job_id):
+
+    #Write the wrapper_settings.json file of a work item and
+    #describe it as a job (see dispatch.py for how jobs are run)
+    json_output_path = prepare_processing(*work_item[:8])
+    return {'id': job_id,
+            'label': work_item_label(work_item),
+            'participant': work_item[4],
+            'session': work_item[5],
+            'sequence': work_item[6],
+            'index': work_item[7],
+            'settings': json_output_path,
+            'executable': work_item[8],
+            'mcr': work_item[9],
+            'cost': estimate_cost(json_output_path)}
+
+def work_item_label(work_item):
+
+    #Name of a work item: participant, session, sequence
+    #and file combo index
+    label = ' '.join(x for x in [work_item[4], work_item[5], work_item[6]] if x)
+    if work_item[7] > 0:
+        label += ' filecombo ' + str(work_item[7])
+    return label
 
 def nifti_path_to_json_dict(nifti_path):
 
@@ -115,6 +161,11 @@ def nifti_path_to_json_dict(nifti_path):
     #and returns the contents of its json
     #sidecar as a dictionary
 
+    #Use the sidecar parsed by the BIDS index if it is indexed
+    json_dict = bids_index.sidecar(os.path.abspath(nifti_path))
+    if json_dict is not None:
+        return json_dict
+
     pre_name = nifti_path.split('.nii')[0]
     json_name = pre_name + '.json'
     if os.path.exists(json_name) == False:
@@ -152,6 +203,10 @@ def find_acceptable_file_combos(prereq_dict, subj_dir):
 
     IntendedFor fields should start at the session level (i.e. ses/func/run.nii.gz)
 
+    Each json sidecar is read once. Only combinations whose files all
+    point to each other (cliques of the mutual IntendedFor graph) are
+    enumerated, in the same order as iterating over every combination.
+
     Params
     ------
 
@@ -191,58 +246,61 @@ def find_acceptable_file_combos(prereq_dict, subj_dir):
 
         return [prereq_dict]
 
-    trash = np.zeros(key_lens)
-    #This is a list of tuples. For each list index,
-    #the first index of the underlying tuple will
-    #have the values necessary to iterate through
-    #all combinations of files in prereq_dict,
-    #choosing 1 file per requirement.
-    array_enumerator = list(np.ndenumerate(trash))
-
+    #Load the IntendedFor field of every file once. Files
+    #are identified by (requirement index, file index), since
+    #the same file may fill more than one requirement. Files
+    #are read in the order the combinations first reach them
+    #(the first file of every requirement, then the others
+    #from the last requirement back), so a missing sidecar or
+    #IntendedFor field raises the same error as before
+    intendedfors = [[None] * key_len for key_len in key_lens]
+    read_order = [(j, 0) for j in range(len(keys))]
+    read_order += [(j, k) for j in reversed(range(len(keys))) for k in range(1, key_lens[j])]
+    for j, k in read_order:
+        temp_nifti = prereq_dict[keys[j]][k]
+        temp_json = nifti_path_to_json_dict(temp_nifti)
+        if 'IntendedFor' in temp_json.keys():
+            intendedfors[j][k] = temp_json['IntendedFor']
+        else:
+            raise ValueError('Error: if any requirement has more than one file, IntendedFor fields from the json sidecar must be present to proceed. IntendedFor field was not found for json associated with: ' + temp_nifti)
+
+    #Build the mutual IntendedFor graph. Two files of different
+    #requirements are connected if each one is named in the
+    #IntendedFor of the other. compatible[j][i] holds, for file k
+    #of requirement j, the set of files of requirement i < j that
+    #it is connected to
+    compatible = []
+    for j, temp_key in enumerate(keys):
+        key_compatible = []
+        for k, temp_nifti in enumerate(prereq_dict[temp_key]):
+            file_compatible = []
+            for i in range(j):
+                file_compatible.append(set(l for l, other_nifti in enumerate(prereq_dict[keys[i]])
+                                           if temp_nifti in intendedfors[i][l] and other_nifti in intendedfors[j][k]))
+            key_compatible.append(file_compatible)
+        compatible.append(key_compatible)
+
+    #Enumerate the cliques with one file per requirement, choosing
+    #requirements in order and files in index order. This visits
+    #combinations in the same order as iterating over every
+    #combination, but stops extending a partial combination as
+    #soon as two of its files are not connected
     acceptable_combinations = []
-    for i in array_enumerator:
-
-        #This is a tuple that will tell
-        #you which files from prereq_dict
-        #to grab for the current iteration.
-        #With these files, we will then check
-        #whether the intendedfors of the various
-        #requirements work with one another
-        x = i[0]
-
-        intendedfors = []
-        nifti_names = []
-        temp_dict = {}
-        for j, k in enumerate(x):
-            temp_nifti = prereq_dict[keys[j]][k]
-            temp_json = nifti_path_to_json_dict(temp_nifti)
-
-            if 'IntendedFor' in temp_json.keys():
-                intendedfors.append(temp_json['IntendedFor'])
-                temp_dict[keys[j]] = [os.path.join(subj_dir,temp_nifti)] #THIS IS IMPLEMENTED HERE BUT DOESN"T TAKE EFFECT FOR SINGLE FILE USE CASE (this is okay)
-                nifti_names.append(temp_nifti)
-            else:
-                raise ValueError('Error: if any requirement has more than one file, IntendedFor fields from the json sidecar must be present to proceed. IntendedFor field was not found for json associated with: ' + temp_nifti)
-
-        process = True
-        for j, temp_nifti in enumerate(nifti_names):
-
-            intendedfors_without_current_key = intendedfors.copy()
-            intendedfors_without_current_key.pop(j)
-
-            #This is for the case where there is only one requirement file
-            if len(intendedfors_without_current_key) == 0:
-                continue
-            #This is for the case where there are multiple requirement files
-            else:
-                for temp_intendedfor in intendedfors_without_current_key:
-                    if temp_nifti in temp_intendedfor:
-                        pass
-                    else:
-                        process = False
-
-        if process:
+    def extend_combination(chosen):
+
+        j = len(chosen)
+        if j == len(keys):
+            temp_dict = {}
+            for i, l in enumerate(chosen):
+                temp_dict[keys[i]] = [os.path.join(subj_dir, prereq_dict[keys[i]][l])]
             acceptable_combinations.append(temp_dict)
+            return
+
+        for k in range(key_lens[j]):
+            if all(chosen[i] in compatible[j][k][i] for i in range(j)):
+                extend_combination(chosen + [k])
+
+    extend_combination([])
 
     return acceptable_combinations
 
@@ -255,6 +313,10 @@ with open(json_settings, 'r') as f:
     master_settings = json.loads(f.read())
 
 
+#Work items (arguments of prepare_processing plus the osprey
+#executable), one per participant, session, sequence and file combo
+work_items = []
+
 #Iterate through all participants
 for temp_participant in participants:
 
@@ -267,7 +329,7 @@ for temp_participant in participants:
 
     #Find session/sessions
     if session_label == None:
-        sessions = glob.glob('ses*')
+        sessions = bids_index.sessions(temp_participant)
         if len(sessions) < 1:
             sessions = ['']
     elif os.path.exists(session_label):
@@ -283,7 +345,7 @@ for temp_participant in participants:
 
         #Grab T1w file
         anats_dict = {}
-        anats = glob.glob(os.path.join(session_path,'anat/*T1w.ni*'))
+        anats = bids_index.files(temp_participant, temp_session, 'anat', pattern='*T1w.ni*')
         if len(anats) == 0:
             print('No T1w image found for ' + session_path + ', skipping processing for current session.')
             continue
@@ -295,7 +357,7 @@ for temp_participant in participants:
         #Grab segmentation
         if isinstance(segmentation_dir, type(None)) == False:
             seg_path_template = os.path.join(segmentation_dir, temp_participant, temp_session, 'anat', '*_space-orig_desc-aseg_dseg.nii.gz')
-            seg_files = glob.glob(seg_path_template)
+            seg_files = seg_index.files(temp_participant, temp_session, 'anat', pattern='*_space-orig_desc-aseg_dseg.nii.gz')
             if len(seg_files) != 1:
                 raise ValueError('Error: expected to find 1 segmentation matching ' + seg_path_template + ', but found ' + str(len(seg_files)))
             anats_dict['files_seg'] = seg_files
@@ -311,7 +373,8 @@ for temp_participant in participants:
             all_files = []
             print("\nFor session " + session_path + " and configuration " + temp_sequence + ":")
             for temp_prereq in prereq_keys:
-                prereq_dict[temp_prereq] = glob.glob(os.path.join(temp_session, 'mrs', temp_sequence_dict['prerequisites'][temp_prereq]))
+                prereq_files = bids_index.files(temp_participant, temp_session, 'mrs', pattern=temp_sequence_dict['prerequisites'][temp_prereq])
+                prereq_dict[temp_prereq] = [os.path.relpath(temp_file, subject_path) for temp_file in prereq_files]
                 print("Found " + str(len(prereq_dict[temp_prereq])) + " " + temp_prereq)
                 num_files.append(len(prereq_dict[temp_prereq]))
                 all_files += prereq_dict[temp_prereq]
@@ -322,8 +385,40 @@ for temp_participant in participants:
             index = 0
             for temp_combo in file_combos:
 
-                run_processing(temp_sequence_dict, temp_combo, anats_dict, output_dir,
-                       temp_participant, temp_session, temp_sequence, index,
-                       compiled_executable_path, mcr_path)
+                work_items.append((temp_sequence_dict, temp_combo, anats_dict, output_dir,
+                                   temp_participant, temp_session, temp_sequence, index,
+                                   compiled_executable_path, mcr_path))
 
                 index += 1
+
+#Write the wrapper_settings.json file of every work item. An
+#item that can not be prepared (i.e. its output folder can not
+#be created) is reported as failed instead of stopping the others
+jobs = []
+unplanned = []
+for work_item in work_items:
+    try:
+        jobs.append(plan_work_item(work_item, len(jobs) + 1))
+    except Exception as e:
+        unplanned.append((work_item_label(work_item), str(e)))
+        print('\n[' + work_item_label(work_item) + '] could not be prepared: ' + str(e))
+
+#Plan mode stops here: the jobs that have not finished with their
+#current settings go to a manifest, one JSON object per line, to be
+#run later with --dispatch (locally or as an array job)
+if args.plan is not None:
+    manifest_path = os.path.join(cwd, args.plan) if args.plan else os.path.join(output_dir, 'osprey_jobs.jsonl')
+    pending_jobs = [job for job in jobs if is_done(job) == False]
+    for job_id, job in enumerate(pending_jobs):
+        job['id'] = job_id + 1
+    write_manifest(manifest_path, pending_jobs)
+    print('\nPlanned ' + str(len(pending_jobs)) + ' pending job(s) of ' + str(len(jobs)) + ', estimated ' +
+          str(round(sum(job['cost']['seconds'] for job in pending_jobs) / 3600, 2)) + ' osprey hour(s): ' + manifest_path)
+    for label, error in unplanned:
+        print('Failed: ' + label + ' (not prepared: ' + error + ')')
+    sys.exit(1 if len(unplanned) > 0 else 0)
+
+#Run the jobs, n_jobs at a time, and summarize which failed
+failed_jobs = run_jobs(jobs, args.n_jobs, unplanned)
+if len(failed_jobs) > 0 or len(unplanned) > 0:
+    sys.exit(1)
@@ -2,11 +2,12 @@
 
 import numpy as np                                                                          # Numerical Operations
 import argparse                                                                             # Parse Input Arguments
-import glob                                                                                 # File Matching
 import json                                                                                 # Handle JSON files
 import copy                                                                                 # Copy Objects
 import os                                                                                   # Interact with Operating System
 
+from bidsindex import BidsIndex                                                             # BIDS Metadata Index
+
 if __name__ == '__main__':
 
     ## Input Arguments
@@ -48,12 +49,17 @@ if __name__ == '__main__':
     if os.path.exists(sub_dir) == False:                                                    # Check Participant Exists
         raise AttributeError('\nError: Subject Directory Not Found ({})'.format(sub_dir))   #
 
-    if os.path.exists(ses_dir) == False:                                                    # Check Session Exists (Otherwise use Subject Directory)
+    index     = BidsIndex(bids_dir)                                                         # BIDS Metadata Index
+    index.update([subject])                                                                 # Index Subject (Only Changed Directories)
+
+    ses_      = session                                                                     # Session in the Index
+    if session not in index.sessions(subject):                                              # Check Session Exists (Otherwise use Subject Directory)
         ses_dir = sub_dir                                                                   # 
+        ses_    = ''                                                                        # Sessionless Subject
 
     ## Grab T1w file
     anat_dict = {}                                                                         # Anatomical Scans Dictionary
-    anat      = glob.glob(os.path.join(ses_dir, 'anat/*T1w.ni*'))                          # Find Anatomical Scans
+    anat      = index.files(subject, ses_, 'anat', pattern='*T1w.ni*')                      # Find Anatomical Scans
     
     if len(anat) == 0:                                                                      # No Anatomical Scans Found
         raise ValueError('No T1w image found in {}'.format(ses_dir))                        # 
@@ -80,11 +86,11 @@ if __name__ == '__main__':
         seq_dict[seqs[ii]]['files_ref'] = []   
 
         scans = master_settings[seqs[ii]]['prerequisites']['files']
-        scans = glob.glob('{}/mrs/{}'.format(ses_dir, scans))
+        scans = index.files(subject, ses_, 'mrs', pattern=scans)                            # Find Scans
         scans = list(sorted(set(scans)))
 
         refs  = master_settings[seqs[ii]]['prerequisites']['files_ref']
-        refs  = glob.glob('{}/mrs/{}'.format(ses_dir, refs))
+        refs  = index.files(subject, ses_, 'mrs', pattern=refs)                             # Find References
         refs  = list(sorted(set(refs)))
 
         jsons = []
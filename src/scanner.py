@@ -0,0 +1,123 @@
+import time as t0 																		# Timer
+import json 																			# JSON Files
+import os 																				# Operating System
+
+class RawScanner(): 																	# Incremental Raw Directory Scanner
+	'''
+	- 1. Description:
+		- Finds the subjects and sessions held in the raw directory with a single
+		    os.scandir pass. The modification time of every subject directory is
+		    kept in a cache file, and a subject directory is only listed again
+		    when its modification time changed since the last scan (a new or
+		    removed session changes the modification time of the subject
+		    directory). Unchanged subjects reuse their cached sessions, so on a
+		    network share only one metadata round-trip per subject is needed to
+		    find the one new session.
+
+		  Note: File systems store modification times with limited precision.
+		    Subject directories modified within a few seconds of the previous
+		    scan are therefore always listed again.
+
+	- 2. Inputs:
+		- rawdir   : (String) Raw Directory holding the sub-* directories.
+		- cachefile: (String) Cache File Path (default to raw/.scan_cache.json)
+		- slack    : (Float ) Seconds of modification time precision.
+	'''
+
+	def __init__(self, rawdir, cachefile=None, slack=2):
+
+		self.rawdir    = rawdir 														# Raw Directory
+		self.cachefile = cachefile if cachefile else '{}/.scan_cache.json'.format(rawdir) # Cache File
+		self.slack     = slack 															# Modification Time Precision
+		self.stats     = {} 															# Last Scan Statistics
+		self.cache     = {'scanned': 0, 'subjects': {}} 								# Subject -> mtime and Sessions
+
+		try: 																			# Load Previous Scan
+			with open(self.cachefile, 'r') as f: 										# Read Cache
+				self.cache = json.loads(f.read()) 										# Cached Directory State
+		except (OSError, ValueError): 													# No or Corrupt Cache - Full Scan
+			pass
+
+	def save(self): 																	# Store Cache
+		tmpfile = '{}.tmp'.format(self.cachefile) 										# Write to Temporary File First
+		with open(tmpfile, 'w') as f: 													# Write Cache
+			f.write(json.dumps(self.cache)) 											# Cached Directory State
+		os.replace(tmpfile, self.cachefile) 											# Replace Cache in one Step
+
+	def scan(self): 																	# Find Subjects and Sessions
+		'''
+		- 1. Description:
+			- Populate dictionary with subjects (keys) and list of sessions
+			    (values) held in the raw directory. Subjects without sessions
+			    default to ses-01. Statistics of the scan (seconds, directories
+			    visited, subjects) are kept in self.stats.
+
+		- 2. Outputs:
+			- subdict  : (Dict  ) Subjects and Sessions found in the raw directory.
+			- combined : (List  ) List of strings ["sub_ses"] to determine new subjects
+		'''
+
+		start    = t0.time() 															# Scan Start
+		previous = self.cache.get('scanned', 0) 										# Previous Scan Time
+		cached   = self.cache.get('subjects', {}) 										# Previous Subjects
+		subjects = {} 																	# Current Subjects
+		visited  = 1 																	# Directories Listed (raw)
+
+		with os.scandir(self.rawdir) as entries: 										# List Raw Directory
+			for entry in entries: 														# Iterate over Entries
+				if entry.name.startswith('sub') == False or entry.is_dir() == False: 	# Not a Subject Directory
+					continue
+
+				mtime = entry.stat().st_mtime 											# Subject Directory Modification Time
+				prior = cached.get(entry.name) 											# Cached Subject
+				if (prior is not None and prior['mtime'] == mtime and 					# Unchanged Since Last Scan
+					mtime < previous - self.slack): 									# Not Modified During Last Scan
+					subjects[entry.name] = prior 										# Reuse Cached Sessions
+					continue
+
+				with os.scandir(entry.path) as sesentries: 								# List Subject Directory
+					sessions = sorted([sesentry.name for sesentry in sesentries 		# Session Directories
+									   if sesentry.name.startswith('ses') and sesentry.is_dir()])
+				visited += 1 															# Directories Listed
+				subjects[entry.name] = {'mtime': mtime, 'sessions': sessions} 			# Update Subject
+
+		self.cache = {'scanned': start, 'subjects': subjects} 							# Current Directory State
+		self.save() 																	# Store Cache
+
+		subdict  = {} 																	# Subject Dictionary with Sessions
+		combined = [] 																	# Combined Subject and Session
+		for subject in sorted(subjects.keys()): 										# Iterate over Subjects
+			sessions = subjects[subject]['sessions'] 									# Sessions of Subject
+			subdict[subject] = list(sessions) if len(sessions) > 0 else ['ses-01'] 		# Default to ses-01
+			combined.extend(['{}_{}'.format(subject, session) for session in subdict[subject]])
+
+		self.stats = {'seconds' : t0.time() - start, 									# Scan Time
+					  'visited' : visited, 												# Directories Listed
+					  'subjects': len(subjects)} 										# Subjects Found
+		return subdict, combined
+
+	def scan_subject(self, subject): 													# Sessions of a Single Subject
+		'''
+		- 1. Description:
+			- List the sessions of a single subject directory (i.e. after a
+			    watchman event named that subject) and update the cache.
+
+		- 2. Inputs:
+			- subject  : (String) Subject directory name
+
+		- 3. Outputs:
+			- sessions : (List  ) Sessions of the subject (ses-01 if none, empty
+								    if the subject directory does not exist)
+		'''
+
+		subdir   = '{}/{}'.format(self.rawdir, subject) 								# Subject Directory
+		try: 																			# Subject might have been Removed
+			mtime = os.stat(subdir).st_mtime 											# Subject Directory Modification Time
+			with os.scandir(subdir) as sesentries: 										# List Subject Directory
+				sessions = sorted([sesentry.name for sesentry in sesentries 			# Session Directories
+								   if sesentry.name.startswith('ses') and sesentry.is_dir()])
+		except (FileNotFoundError, NotADirectoryError): 								# No Subject Directory
+			return []
+
+		self.cache.setdefault('subjects', {})[subject] = {'mtime': mtime, 'sessions': sessions} # Update Subject
+		return list(sessions) if len(sessions) > 0 else ['ses-01'] 						# Default to ses-01
@@ -0,0 +1,389 @@
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait 				# Process Pool
+from concurrent.futures.process import BrokenProcessPool 								# Worker Process Died
+from collections import OrderedDict, deque 												# Ordered Stages and Ready Queues
+import time as t0 																		# Timer
+import os 																				# Operating System
+
+lanes = OrderedDict([('urgent', 0), ('high', 1), ('normal', 2), ('low', 3)]) 			# Priority Lanes (Lower Runs First)
+
+class StageScheduler(): 																# Concurrent Subject/Session Pipeline
+	'''
+	- 1. Description:
+		- Runs every submitted subject/session through an ordered chain of
+		    stages (dicomsort -> bidscoin -> osprey_job -> osprey_run) using a
+		    pool of worker processes. Sessions are independent of one another,
+		    so different sessions can be in different stages at the same time.
+		    Each stage has its own concurrency cap (i.e. 8 dicomsort/bidscoin
+		    at once, but only 3 OspreyCMD at once since the Matlab Runtime is
+		    memory-heavy). The total number of worker processes is set by jobs.
+
+		  Note: A session only advances to its next stage when the previous
+		    stage succeeded. A failed stage stops that session only; all other
+		    sessions keep executing. If a worker process dies (i.e. killed for
+		    memory), the calls running in the pool fail, they are listed in
+		    crashed, and a fresh pool runs the sessions still queued.
+
+		  Batched stages (i.e. osprey_run, to pay the Matlab Runtime start-up
+		    once for several sessions) gather ready sessions with the same batch
+		    key and run them with a single call of the batch runner, once size
+		    sessions are waiting, the oldest waited wait seconds, or no further
+		    sessions can arrive (see drain). The batch runner has the signature
+		    runner(func, sessions, misc) and returns a list with the success
+		    (or success and details) of every session.
+
+		  Every session has a priority (see lanes): a waiting session of a
+		    more urgent lane starts before any less urgent one, whatever its
+		    stage, and an urgent session never waits for its batch to fill.
+		    Within a lane, later stages are served first so that sessions
+		    already in flight finish before new sessions are started. Sessions
+		    of several studies (base directories) can share one scheduler, so
+		    the limits hold across all of them.
+
+		  Stages with a memory estimate (memory) only start while the
+		    estimates of the running calls stay within budget. A call waiting
+		    for memory keeps other memory-using calls from starting before it;
+		    a call larger than the budget runs once nothing else holds memory.
+
+	- 2. Inputs:
+		- commands : (Dict  ) Ordered stage names (keys) and stage functions (values).
+		- runner   : (Func  ) Function executed in the worker processes with the
+							    signature runner(func, basedir, sub, ses, misc).
+							    Must be importable (top-level) and return success
+							    (or a tuple of success and a dictionary of details).
+		- jobs     : (Int   ) Number of worker processes (default to cpu count).
+		- limits   : (Dict  ) Maximum concurrent calls per stage (default to jobs).
+		- callback : (Func  ) Called in the main process when a session finishes
+							    with the signature callback(session, stage, success).
+		- progress : (Func  ) Called in the main process when a stage starts and
+							    ends with the signature progress(session, stage,
+							    status, details) where status is running, success
+							    or failed (i.e. to checkpoint stages). The details
+							    include the seconds the session was queued
+							    (queue_wait) and whatever the runner reported.
+		- batches  : (Dict  ) Batched stage names (keys) and batch settings (values)
+							    {'size': N, 'wait': seconds, 'runner': func,
+							     'key': func(session, misc) -> batch key}
+		- initializer: (Func) Called in every worker process when it starts
+							    with initargs (i.e. to send logs to a LogQueue).
+		- initargs : (Tuple ) Arguments of the initializer
+		- memory   : (Dict  ) Memory estimate of one call per stage in MB (i.e.
+							    {'osprey_run': 4000}; other stages use none)
+		- budget   : (Float ) Memory of all running calls in MB (None = no budget)
+	'''
+
+	def __init__(self, commands, runner, jobs=None, limits=None, callback=None, progress=None, batches=None,
+				 initializer=None, initargs=(), memory=None, budget=None):
+
+		self.commands = OrderedDict(commands) 											# Stage Names and Functions
+		self.stages   = list(self.commands.keys()) 										# Stage Order
+		self.runner   = runner 															# Worker Function
+		self.jobs     = jobs if jobs else (os.cpu_count() or 1) 						# Number of Worker Processes
+		self.callback = callback 														# Session Finished Callback
+		self.progress = progress 														# Stage Started/Ended Callback
+		self.initializer = initializer 													# Worker Process Setup
+		self.initargs = initargs 														# Worker Process Setup Arguments
+
+		self.limits   = {stage: self.jobs for stage in self.stages} 					# Default Stage Limit - Number of Workers
+		for stage in (limits or {}): 													# Iterate over User Limits
+			if stage not in self.commands: 												# Unknown Stage
+				raise ValueError('Unknown stage for limit: {}'.format(stage))
+			self.limits[stage] = max(1, int(limits[stage])) 							# At least 1 Concurrent Call
+
+		self.batches  = {} 																# Batched Stages -> Batch Settings
+		for stage in (batches or {}): 													# Iterate over Batched Stages
+			if stage not in self.commands: 												# Unknown Stage
+				raise ValueError('Unknown stage for batch: {}'.format(stage))
+			self.batches[stage] = dict({'size': 1, 'wait': 0, 'key': None, 'runner': runner}, **batches[stage])
+
+		self.memory   = {} 																# Stage -> Memory Estimate per Call (MB)
+		for stage in (memory or {}): 													# Iterate over Memory Estimates
+			if stage not in self.commands: 												# Unknown Stage
+				raise ValueError('Unknown stage for memory: {}'.format(stage))
+			self.memory[stage] = max(0.0, float(memory[stage]))
+		self.budget   = budget 															# Memory Budget (MB)
+		self.used     = 0.0 															# Memory Estimate of Running Calls
+
+		self.ready    = {stage: deque() for stage in self.stages} 						# Sessions Waiting per Stage (Priority Order)
+		self.priority = {} 																# Session -> Priority (see lanes)
+		self.waiting  = {} 																# Session -> (Batch Key, Time Queued)
+		self.queued   = {} 																# Session -> Time Queued at Current Stage
+		self.waits    = {} 																# Session -> Seconds Queued before Current Stage Started
+		self.draining = False 															# No more Sessions will be Submitted
+		self.running  = {stage: 0       for stage in self.stages} 						# Sessions Running per Stage
+		self.futures  = {} 																# Running Futures -> (Session, Stage)
+		self.sessions = {} 																# Session -> Misc Objects
+		self.results  = OrderedDict() 													# Finished Session -> (Last Stage, Success)
+		self.pool     = None 															# Worker Pool (Created on First Use)
+		self.crashed  = [] 																# (Session(s), Stage) of Calls Lost with a Worker (Cleared by Caller)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.shutdown()
+
+	def submit(self, basedir, sub, ses, misc, start=None, priority=lanes['normal']): 	# Queue a Session
+		'''
+		- 1. Description:
+			- Queue a subject/session at its first stage (or at start). Sessions
+			    that are already queued or running are ignored.
+
+		- 2. Inputs:
+			- basedir  : (String) Base Directory where raw and bids can be found.
+			- sub      : (String) Current Subject as string
+			- ses      : (String) Current Subject's Session as string
+			- misc     : (Dict  ) Miscellaneous Objects that specific functions may need.
+			- start    : (String) First stage to run (default to the first stage).
+			- priority : (Int   ) Priority of the session (see lanes; lower runs first)
+
+		- 3. Outputs:
+			- queued   : (Bool  ) True if the session was queued.
+		'''
+
+		session = (basedir, sub, ses) 													# Session Key
+		if session in self.sessions: 													# Already Queued or Running
+			return False
+
+		stage   = start if start else self.stages[0] 									# First Stage to Run
+		self.sessions[session] = misc 													# Keep Misc Objects for Later Stages
+		self.priority[session] = priority 												# Priority Lane
+		self.results.pop(session, None) 												# Remove Previous Result (Resubmitted)
+		self.queue(session, stage) 														# Queue Session
+		return True
+
+	def queue(self, session, stage): 													# Queue a Session at a Stage
+		if stage in self.batches: 														# Batched Stage - Note Batch Key and Time
+			key = session[0] 															# Default - Batch Sessions of the same Study
+			if self.batches[stage]['key'] is not None: 									# Batch Key Function
+				try:
+					key = self.batches[stage]['key'](session, self.sessions[session])
+				except Exception as e: 													# No Key - Run Alone
+					key = None
+			self.waiting[session] = (key, t0.time())
+		self.queued[session] = t0.time() 												# Time Queued
+		ready = self.ready[stage] 														# Sessions Waiting at Stage
+		index = len(ready) 																# Behind Sessions of the same or a more Urgent Lane
+		while index > 0 and self.priority[ready[index - 1]] > self.priority[session]:
+			index -= 1
+		ready.insert(index, session)
+
+	def started(self, session, stage, now): 											# Stage Call Started
+		self.waits[session] = now - self.queued.pop(session, now) 						# Queue Wait
+		if self.progress is not None: 													# Notify Caller
+			self.progress(session, stage, 'running', {'queue_wait': self.waits[session]})
+
+	def drain(self): 																	# No more Sessions will be Submitted
+		self.draining = True
+
+	def next_batch(self, stage, now): 													# Next Batch of a Batched Stage
+		'''
+		- 1. Description:
+			- Group the sessions waiting at a batched stage by batch key (in
+			    queue order) and return the first group that is due: full, waited
+			    long enough, holds an urgent session, or nothing can join anymore
+			    (draining and no session in an earlier stage). Sessions without a
+			    batch key run alone.
+
+		- 2. Inputs:
+			- stage    : (String) Batched stage name
+			- now      : (Float ) Current time
+
+		- 3. Outputs:
+			- batch    : (List  ) Sessions to run together (None if no batch is due)
+		'''
+
+		spec     = self.batches[stage] 													# Batch Settings
+		earlier  = self.stages[:self.stages.index(stage)] 								# Stages Feeding this Stage
+		final    = self.draining and all(len(self.ready[prev]) == 0 and self.running[prev] == 0 for prev in earlier)
+
+		groups   = OrderedDict() 														# Batch Key -> Sessions
+		for session in self.ready[stage]: 												# Iterate over Waiting Sessions
+			key, since = self.waiting[session] 											# Batch Key and Time Queued
+			if key is None: 															# No Batch Key - Run Alone
+				return [session]
+			groups.setdefault(key, []).append(session)
+
+		for key, group in groups.items(): 												# Iterate over Groups (Oldest First)
+			since  = min(self.waiting[session][1] for session in group) 				# Oldest Session
+			urgent = self.priority[group[0]] == lanes['urgent'] 						# Urgent Sessions do not Wait
+			if len(group) >= spec['size'] or now - since >= spec['wait'] or urgent or final: # Batch Due
+				return group[:spec['size']]
+		return None
+
+	def due(self, timeout): 															# Wait at most until the next Batch is Due
+		now = t0.time() 																# Current Time
+		for stage in self.batches: 														# Iterate over Batched Stages
+			if self.running[stage] >= self.limits[stage] or len(self.futures) >= self.jobs: # No Free Slot - Wait for Completion
+				continue
+			for session in self.ready[stage]: 											# Iterate over Waiting Sessions
+				wait    = max(0, self.waiting[session][1] + self.batches[stage]['wait'] - now)
+				timeout = wait if timeout is None else min(timeout, wait)
+		return timeout
+
+	@property
+	def idle(self): 																	# Nothing Queued or Running
+		return len(self.sessions) == 0
+
+	def fits(self, stage): 																# Memory Budget Allows a Call
+		need = self.memory.get(stage, 0) 												# Memory Estimate of Call
+		return self.budget is None or need == 0 or self.used == 0 or self.used + need <= self.budget
+
+	def candidate(self, now, held): 													# Most Urgent Call that could Start
+		best = None 																	# (Rank, Stage, Sessions)
+		for index, stage in enumerate(self.stages): 									# Iterate over Stages
+			if (len(self.ready[stage]) == 0 or self.running[stage] >= self.limits[stage] or # Nothing Waiting or No Free Slot
+				stage in held or (len(held) > 0 and self.memory.get(stage, 0) > 0)): 	# Memory Kept for a Waiting Call
+				continue
+			batch = self.next_batch(stage, now) if stage in self.batches else [self.ready[stage][0]] # Next Call of Stage
+			if batch is None: 															# No Batch Due
+				continue
+			rank  = (min(self.priority[session] for session in batch), -index) 			# Lane, then Later Stages First
+			if best is None or rank < best[0]:
+				best = (rank, stage, batch)
+		return best
+
+	def dispatch(self): 																# Start as many Stage Calls as Limits Allow
+		'''
+		- 1. Description:
+			- Start queued stage calls while the pool, the stage limits and the
+			    memory budget have room, most urgent lane first and, within a
+			    lane, later stages first so that sessions already in flight
+			    finish before new sessions are started.
+		'''
+
+		now  = t0.time() 																# Current Time
+		held = set() 																	# Stages Waiting for Memory
+		while len(self.futures) < self.jobs: 											# Pool Has Free Worker
+			best = self.candidate(now, held) 											# Most Urgent Call
+			if best is None: 															# Nothing can Start
+				break
+			rank, stage, batch = best
+			if self.fits(stage) == False: 												# Not Enough Memory - Wait for Running Calls
+				held.add(stage)
+				continue
+
+			for session in batch: 														# Iterate over Sessions of Call
+				self.ready[stage].remove(session) 										# Remove from Queue
+				self.waiting.pop(session, None) 										# No Longer Waiting for a Batch
+			try: 																		# A Worker Died since the Last Step
+				future = self.submit_call(stage, batch) 								# Run Call in Worker
+			except BrokenProcessPool: 													# Retry in a Fresh Pool
+				self.discard()
+				future = self.submit_call(stage, batch)
+			self.futures[future] = (batch if stage in self.batches else batch[0], stage) # Track Future
+			self.running[stage] += 1 													# Stage Running Count
+			self.used           += self.memory.get(stage, 0) 							# Memory Estimate in Use
+			for session in batch: 														# Iterate over Sessions of Call
+				self.started(session, stage, now) 										# Note Queue Wait
+
+	def submit_call(self, stage, batch): 												# Submit a Stage Call to the Pool
+		if self.pool is None: 															# Create Pool on First Use (or after a Crash)
+			self.pool = ProcessPoolExecutor(max_workers=self.jobs, initializer=self.initializer, initargs=self.initargs) # Worker Processes
+		if stage in self.batches: 														# Run Batch in Worker
+			return self.pool.submit(self.batches[stage]['runner'], self.commands[stage], batch, self.sessions[batch[0]])
+		basedir, sub, ses = batch[0] 													# Unpack Session
+		return self.pool.submit(self.runner, self.commands[stage], basedir, sub, ses, self.sessions[batch[0]])
+
+	def discard(self): 																	# Drop a Broken Pool
+		self.pool.shutdown(wait=False) 													# Calls still Tracked Fail with BrokenProcessPool
+		self.pool = None 																# Next Submit Creates a Fresh Pool
+
+	def step(self, timeout=None): 														# Wait for Stage Completions
+		'''
+		- 1. Description:
+			- Dispatch queued work and wait (up to timeout seconds) for at least
+			    one stage call to complete. Completed sessions advance to their
+			    next stage or finish.
+
+		- 2. Inputs:
+			- timeout  : (Float ) Seconds to wait (None waits for a completion).
+
+		- 3. Outputs:
+			- finished : (List  ) Sessions that finished during this step.
+		'''
+
+		self.dispatch() 																# Start Queued Work
+		timeout  = self.due(timeout) 													# Wake up for Waiting Batches
+		if len(self.futures) == 0: 														# Nothing Running
+			if timeout: 																# Caller Asked to Wait
+				t0.sleep(timeout) 														# Idle Wait
+			return []
+
+		done,_   = wait(list(self.futures.keys()), timeout=timeout, return_when=FIRST_COMPLETED)
+		finished = []
+		for future in done: 															# Iterate over Completed Stage Calls
+			session, stage = self.futures.pop(future) 									# Session and Stage of Call
+			self.running[stage] -= 1 													# Free Stage Slot
+			self.used           -= self.memory.get(stage, 0) 							# Free Memory Estimate
+
+			try: 																		# Worker Errors Count as Failure
+				result  = future.result() 												# Stage Success
+			except BrokenProcessPool as e: 												# Worker Died - Call Lost
+				result  = False 														# Set Success
+				self.crashed.append((session, stage)) 									# Noted for the Caller
+			except Exception as e: 														# Error Handling
+				result  = False 														# Set Success
+
+			if stage in self.batches: 													# Batch - Success of every Session
+				if isinstance(result, list) == False: 									# Batch Failed as a Whole
+					result = [result] * len(session)
+				self.complete(list(zip(session, result)), stage, finished)
+			else: 																		# Single Session
+				self.complete([(session, result)], stage, finished)
+
+		self.dispatch() 																# Refill Free Slots
+		return finished
+
+	def complete(self, results, stage, finished): 										# Advance or Finish Sessions after a Stage
+		'''
+		- 1. Description:
+			- Advance every session that completed a stage to its next stage, or
+			    finish the session (last stage or failed).
+
+		- 2. Inputs:
+			- results  : (List  ) (Session, Result) where Result is success or a
+								    tuple of success and details
+			- stage    : (String) Completed stage
+			- finished : (List  ) Finished sessions (appended to)
+		'''
+
+		for session, success in results: 												# Iterate over Sessions
+			details  = {} 																# Details Reported by Runner
+			if isinstance(success, tuple): 												# Success and Details
+				success, details = success
+			success  = bool(success) 													# Stage Success
+			details  = dict(details, queue_wait=self.waits.pop(session, None)) 			# Add Queue Wait
+
+			if self.progress is not None: 												# Notify Caller
+				self.progress(session, stage, 'success' if success else 'failed', details)
+
+			index    = self.stages.index(stage) 										# Current Stage Position
+			if success == True and index + 1 < len(self.stages): 						# Advance to Next Stage
+				self.queue(session, self.stages[index + 1]) 							# Queue Next Stage
+				continue
+
+			del self.sessions[session] 													# Session Complete
+			del self.priority[session] 													# Priority Lane
+			self.results[session] = (stage, success) 									# Record Result
+			finished.append(session) 													# Finished This Step
+			if self.callback is not None: 												# Notify Caller
+				self.callback(session, stage, success)
+
+	def run(self): 																		# Run until all Sessions Finish
+		'''
+		- 1. Description:
+			- Block until every submitted session has finished.
+
+		- 2. Outputs:
+			- results  : (Dict  ) Session -> (Last Stage, Success)
+		'''
+
+		self.drain() 																	# No Submissions while Running
+		while self.idle == False: 														# Sessions Remaining
+			self.step() 																# Wait for Completions
+		return self.results
+
+	def shutdown(self): 																# Stop Worker Processes
+		if self.pool is not None: 														# Pool Created
+			self.pool.shutdown(wait=True) 												# Wait for Workers to Exit
+			self.pool = None
@@ -0,0 +1,243 @@
+import hashlib 																			# Fingerprint Hashing
+import shutil 																			# Find Executables
+import json 																			# JSON Files
+import os 																				# Operating System
+
+inplace = ['dicomsort', 'osprey_prep'] 													# Stages that Modify their Inputs (Fingerprint Recorded after Running)
+
+def raw_dir(basedir, sub, ses): 														# Raw Session Directory
+	subdir = '{}/raw/{}/{}'.format(basedir, sub, ses) 									# Subject Directory (With Session)
+	if os.path.exists(subdir) == False: 												# Determine if Session Information was Given
+		subdir = '{}/raw/{}'.format(basedir, sub) 										# No Session Information Provided
+	return subdir
+
+def bids_dir(basedir, sub, ses): 														# BIDS Session Directory
+	ses_dir = '{}/bids/{}/{}'.format(basedir, sub, ses) 								# Session Directory
+	if os.path.exists(ses_dir) == False: 												# Check Session Exists (Otherwise use Subject Directory)
+		ses_dir = '{}/bids/{}'.format(basedir, sub) 									# No Session - Use Subject Directory
+	return ses_dir
+
+def src_dir(basedir): 																	# Source Directory (Next to the Study Directory)
+	return '{}/src'.format('/'.join(basedir.split('/')[:-1]))
+
+def tree_entries(path): 																# Files of a Directory Tree
+	'''
+	- 1. Description:
+		- Lists every file of a directory tree with its size and modification
+		    time. Hidden files (i.e. stage fingerprints, upload sentinels) and log
+		    files are left out, since they change without the data changing.
+
+	- 2. Inputs:
+		- path     : (String) Directory (or file) to list
+
+	- 3. Outputs:
+		- entries  : (List  ) Sorted [relative path, size, mtime in ns]
+	'''
+
+	if os.path.isfile(path): 															# Single File
+		stat = os.stat(path) 															# File Information
+		return [[os.path.basename(path), stat.st_size, stat.st_mtime_ns]]
+
+	entries = [] 																		# Files in Tree
+	for root, dirs, files in os.walk(path): 											# Walk Directory Tree
+		dirs[:] = [d for d in dirs if d.startswith('.') == False] 						# Skip Hidden Directories
+		for filename in files: 															# Iterate over Files
+			if filename.startswith('.') or filename.endswith('.log'): 					# Hidden or Log File
+				continue
+			filepath = os.path.join(root, filename) 									# Full Path
+			try: 																		# File might be Moved While Walking
+				stat = os.stat(filepath) 												# File Information
+			except FileNotFoundError:
+				continue
+			relpath  = os.path.relpath(filepath, path).replace('\\', '/') 				# Relative Path
+			entries.append([relpath, stat.st_size, stat.st_mtime_ns]) 					# Add File
+	return sorted(entries)
+
+def file_digest(path): 																	# Content Hash of a (Small) File
+	if os.path.isfile(path) == False: 													# Missing File
+		return None
+	with open(path, 'rb') as f: 														# Read File
+		return hashlib.sha256(f.read()).hexdigest()
+
+def tool_version(tool, path=None): 														# Version of an External Tool
+	'''
+	- 1. Description:
+		- Identifies the installed version of an external tool by the path, size
+		    and modification time of its executable. This changes whenever the
+		    tool is updated, without having to run it.
+
+	- 2. Inputs:
+		- tool     : (String) Executable name (i.e. bidscoiner)
+		- path     : (String) Additional search path (i.e. the Osprey directory)
+
+	- 3. Outputs:
+		- version  : (List  ) [executable path, size, mtime in ns] (None if not found)
+	'''
+
+	search = os.environ.get('PATH', '') 												# Executable Search Path
+	if path: 																			# Additional Directory
+		search = path + os.pathsep + search
+	exe    = shutil.which(tool, path=search) 											# Find Executable
+	if exe is None: 																	# Not Installed
+		return None
+	stat   = os.stat(exe) 																# Executable Information
+	return [exe.replace('\\', '/'), stat.st_size, stat.st_mtime_ns]
+
+def job_data(basedir, sub, ses, keys, original=False): 									# Data Files of an Osprey Job
+	jobfile = '{}/{}_{}_osprey_job.json'.format(bids_dir(basedir, sub, ses), sub, ses) 	# Osprey Job File
+	data    = [] 																		# Data Files Listed in Job File
+	try: 																				# Job File might be Missing
+		with open(jobfile, 'r') as f: 													# Read Job File
+			job = json.loads(f.read()) 													# Osprey Job
+	except (OSError, ValueError): 														# No Job File
+		return None
+	for key in keys: 																	# Data File Keys
+		files = job.get(key + '_raw', job.get(key, [])) if original else job.get(key, []) # Original Data of Preprocessed Jobs
+		for filepath in files: 															# Iterate over Data Files
+			data.append([key, filepath.replace('\\', '/')] + tree_entries(filepath)) 	# Data File Information
+	return data
+
+def stage_inputs(stage, basedir, sub, ses, misc): 										# Inputs of a Stage
+	'''
+	- 1. Description:
+		- Describes everything a stage reads: data files (size and modification
+		    time), settings files (content hash), and the tool version.
+
+		  - dicomsort : raw session tree, folder scheme, dicomsort (or built-in)
+		  - bidscoin  : raw session tree, bidsmap.yaml, bidscoiner
+		  - osprey_job: bids mrs and anat trees, OSPREY_master_settings.json,
+		                basis set tree (with --basis-dir)
+		  - osprey_qc : scan and reference files of the Osprey job, QC
+		                thresholds and action
+		  - osprey_prep: Osprey job file, original scan and reference files,
+		                --preprocess
+		  - osprey_run: Osprey job file and all data files it lists, OspreyCMD
+		  - osprey_results: Osprey result tables, BIDS scans table
+
+	- 2. Inputs:
+		- stage    : (String) Stage name
+		- basedir  : (String) Base Directory where raw and bids can be found.
+		- sub      : (String) Current Subject as string
+		- ses      : (String) Current Subject's Session as string
+		- misc     : (Dict  ) Miscellaneous Objects that specific functions may need.
+
+	- 3. Outputs:
+		- inputs   : (Dict  ) Stage inputs (None if the stage is not cached)
+	'''
+
+	if stage == 'dicomsort': 															# Sort Dicoms
+		return {'raw'     : tree_entries(raw_dir(basedir, sub, ses)), 					# Raw Session Files
+				'scheme'  : misc.get('sort_scheme', '{ScanningSequence}'), 				# Folder Scheme
+				'tool'    : tool_version('dicomsort') if misc.get('sorter') == 'dicomsort' else 'builtin'} # dicomsort Version (or Built-in Sorter)
+
+	if stage == 'bidscoin': 															# Bids-ify
+		bmap = '{}/bids/code/bidscoin/bidsmap.yaml'.format(basedir) 					# Bidsmap
+		return {'raw'     : tree_entries(raw_dir(basedir, sub, ses)), 					# Raw Session Files
+				'bidsmap' : file_digest(bmap), 											# Bidsmap Content
+				'tool'    : tool_version('bidscoiner')} 								# bidscoiner Version
+
+	if stage == 'osprey_job': 															# Create Osprey Job File
+		ses_dir = bids_dir(basedir, sub, ses) 											# BIDS Session Directory
+		return {'mrs'     : tree_entries('{}/mrs'.format(ses_dir)), 					# MRS Files
+				'extra'   : tree_entries('{}/extra_data'.format(ses_dir)), 				# MRS Files (Other Name)
+				'anat'    : tree_entries('{}/anat'.format(ses_dir)), 					# Anatomical Files
+				'settings': file_digest('{}/OSPREY_master_settings.json'.format(src_dir(basedir))), # Osprey Settings
+				'email'   : file_digest('{}/EmailConfig.json'.format(src_dir(basedir))), # Email Settings
+				'basis'   : tree_entries(misc['basis_dir']) if misc.get('basis_dir') else None} # Basis Set Tree (Automatic Selection)
+
+	if stage == 'osprey_qc': 															# Pre-Flight QC
+		data    = job_data(basedir, sub, ses, ['files', 'files_ref'], original=True) 	# Scans and References
+		if data is None: 																# No Job File - Never Cached
+			return None
+		return {'data'    : data, 														# Data Files
+				'qc'      : misc.get('qc', {}), 										# Changed Thresholds
+				'action'  : misc.get('qc_action', 'skip')} 								# Skip or Flag
+
+	if stage == 'osprey_prep': 															# Preprocess for Osprey
+		jobfile = '{}/{}_{}_osprey_job.json'.format(bids_dir(basedir, sub, ses), sub, ses) # Osprey Job File
+		data    = job_data(basedir, sub, ses, ['files', 'files_ref'], original=True) 	# Original Scans and References
+		if data is None: 																# No Job File - Never Cached
+			return None
+		return {'job'     : file_digest(jobfile), 										# Job File Content (Points at Reduced Data)
+				'data'    : data, 														# Original Data Files
+				'prep'    : misc.get('preprocess', False)} 								# Preprocess or Original Data
+
+	if stage == 'osprey_run': 															# Run Osprey
+		jobfile = '{}/{}_{}_osprey_job.json'.format(bids_dir(basedir, sub, ses), sub, ses) # Osprey Job File
+		data    = job_data(basedir, sub, ses, ['files', 'files_ref', 'files_w', 'files_nii', 'files_seg']) # Data Files Listed in Job File
+		if data is None: 																# No Job File - Never Cached
+			return None
+		return {'job'     : file_digest(jobfile), 										# Job File Content
+				'data'    : data, 														# Data Files
+				'tool'    : tool_version('OspreyCMD', misc.get('osp_path'))} 			# OspreyCMD Version
+
+	if stage == 'osprey_results': 														# Add Results to Study Store
+		tables = tree_entries(output_dir(stage, basedir, sub, ses)) 					# Osprey Derivatives
+		scans  = tree_entries(bids_dir(basedir, sub, ses)) 								# BIDS Session Files
+		return {'tables'  : [entry for entry in tables if entry[0].endswith(('.tsv', '.csv'))], # Osprey Result Tables
+				'scans'   : [entry for entry in scans if entry[0].endswith('_scans.tsv')]} # BIDS Scans Table (Session Date)
+
+	return None
+
+def output_dir(stage, basedir, sub, ses): 												# Where a Stage Writes its Outputs
+	if stage == 'dicomsort': 															# Sorted in Place
+		return raw_dir(basedir, sub, ses)
+	if stage in ['bidscoin', 'osprey_job']: 											# BIDS Session Directory
+		return bids_dir(basedir, sub, ses)
+	return '{}/bids/derivatives/{}/{}'.format(basedir, sub, ses) 						# Osprey Derivatives
+
+def fingerprint(stage, basedir, sub, ses, misc): 										# Fingerprint of Stage Inputs
+	'''
+	- 1. Description:
+		- Hash of all inputs of a stage (see stage_inputs).
+
+	- 2. Outputs:
+		- digest   : (String) SHA-256 of the stage inputs (None if not cached)
+	'''
+
+	inputs = stage_inputs(stage, basedir, sub, ses, misc) 								# Stage Inputs
+	if inputs is None: 																	# Stage is not Cached
+		return None
+	return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+def fingerprint_file(stage, basedir, sub, ses): 										# Fingerprint File Next to Outputs
+	return '{}/.{}.fingerprint.json'.format(output_dir(stage, basedir, sub, ses), stage)
+
+def is_current(stage, basedir, sub, ses, digest): 										# Stage Outputs Match Inputs
+	'''
+	- 1. Description:
+		- Determine whether a stage already ran successfully on exactly these
+		    inputs, by comparing with the fingerprint recorded next to its outputs.
+
+	- 2. Inputs:
+		- stage    : (String) Stage name
+		- basedir  : (String) Base Directory where raw and bids can be found.
+		- sub      : (String) Current Subject as string
+		- ses      : (String) Current Subject's Session as string
+		- digest   : (String) Current fingerprint of the stage inputs
+
+	- 3. Outputs:
+		- current  : (Bool  ) True if the stage can be skipped.
+	'''
+
+	if digest is None: 																	# Stage is not Cached
+		return False
+	try: 																				# Fingerprint might be Missing
+		with open(fingerprint_file(stage, basedir, sub, ses), 'r') as f: 				# Read Fingerprint
+			return json.loads(f.read()).get('digest') == digest
+	except (OSError, ValueError): 														# No Fingerprint
+		return False
+
+def record(stage, basedir, sub, ses, digest): 											# Store Fingerprint Next to Outputs
+	if digest is None: 																	# Stage is not Cached
+		return
+	outfile = fingerprint_file(stage, basedir, sub, ses) 								# Fingerprint File
+	os.makedirs(os.path.dirname(outfile), exist_ok=True) 								# Output Directory
+	with open(outfile, 'w') as f: 														# Write Fingerprint
+		f.write(json.dumps({'stage': stage, 'digest': digest})) 						# Stage and Fingerprint
+
+def clear(stage, basedir, sub, ses): 													# Remove Fingerprint (i.e. Stage Failed)
+	try:
+		os.remove(fingerprint_file(stage, basedir, sub, ses))
+	except OSError:
+		pass
@@ -0,0 +1,336 @@
+from collections import OrderedDict 													# Ordered Pending Sessions
+import fnmatch 																			# Required Series Patterns
+import time as t0 																		# Timer
+import json 																			# JSON Files
+import os 																				# Operating System
+
+import dicomsorter 																		# Built-in Dicom Sorter
+
+def tree_snapshot(path): 																# Summarize a Directory Tree
+	'''
+	- 1. Description:
+		- Walks a directory tree once and summarizes it by the number of files,
+		    their total size, and the most recent modification time (files and
+		    directories). Two equal snapshots mean nothing arrived in between.
+
+	- 2. Inputs:
+		- path     : (String) Directory to summarize
+
+	- 3. Outputs:
+		- snapshot : (Tuple ) (Number of Files, Total Size, Latest mtime)
+	'''
+
+	nfiles = 0 																			# Number of Files
+	nbytes = 0 																			# Total Size
+	mtime  = 0 																			# Latest Modification
+	stack  = [path] 																	# Directories to Visit
+
+	while len(stack) > 0: 																# Iterate over Directories
+		current = stack.pop() 															# Current Directory
+		try: 																			# Directory might be Moved During Upload
+			with os.scandir(current) as entries: 										# List Directory
+				for entry in entries: 													# Iterate over Entries
+					stat  = entry.stat(follow_symlinks=False) 							# File Information
+					mtime = max(mtime, stat.st_mtime) 									# Latest Modification
+					if entry.is_dir(follow_symlinks=False): 							# Directory
+						stack.append(entry.path) 										# Visit Later
+					else: 																# File
+						nfiles += 1 													# Count File
+						nbytes += stat.st_size 											# Add Size
+		except FileNotFoundError: 														# Removed While Walking
+			continue
+
+	return nfiles, nbytes, mtime
+
+class UploadWatcher(): 																	# Upload Completion Detector
+	'''
+	- 1. Description:
+		- Watches the raw/sub-*/ses-* tree of every pending session and marks a
+		    session ready for processing once its upload has completed. An upload
+		    is considered complete when:
+		      - a sentinel file (i.e. .upload_complete) appears in the session, or
+		      - a manifest file (i.e. upload_manifest.json) appears and all files
+		          listed within have arrived (with matching sizes if given), or
+		      - the number of files, their sizes and modification times have not
+		          changed for the quiet window.
+		    Sessions that are still not complete after the timeout (i.e. empty
+		    session folders) are released anyway, so they do not block others.
+
+		  Note: The manifest can either be a list of file paths or a dictionary
+		    of file paths (keys) and sizes in bytes (values). Paths are relative
+		    to the session directory.
+
+	- 2. Inputs:
+		- basedir  : (String) Base Directory where raw and bids can be found.
+		- quiet    : (Float ) Seconds without changes before a session is ready.
+		- sentinels: (List  ) Filenames that mark an upload as complete.
+		- manifests: (List  ) Filenames of manifests listing the expected files.
+		- timeout  : (Float ) Seconds after which a session is released anyway.
+	'''
+
+	def __init__(self, basedir, quiet=60, sentinels=('.upload_complete',), manifests=('upload_manifest.json',), timeout=3600):
+
+		self.basedir   = basedir 														# Base Directory
+		self.quiet     = quiet 															# Quiet Window (Seconds)
+		self.sentinels = list(sentinels) 												# Sentinel Filenames
+		self.manifests = list(manifests) 												# Manifest Filenames
+		self.timeout   = timeout 														# Maximum Wait (Seconds)
+		self.pending   = OrderedDict() 													# (Subject, Session) -> (Snapshot, Last Change)
+
+	def session_dir(self, sub, ses): 													# Raw Session Directory
+		subdir = '{}/raw/{}/{}'.format(self.basedir, sub, ses) 							# Subject Directory (With Session)
+		if os.path.exists(subdir) == False: 											# Determine if Session Information was Given
+			subdir = '{}/raw/{}'.format(self.basedir, sub) 								# No Session Information Provided
+		return subdir
+
+	def add(self, sub, ses): 															# Watch a Session
+		if (sub, ses) not in self.pending: 												# Not Yet Watched
+			self.pending[(sub, ses)] = (None, t0.time()) 								# No Snapshot Yet
+
+	def discard(self, sub, ses): 														# Stop Watching a Session
+		self.pending.pop((sub, ses), None)
+
+	def manifest_complete(self, subdir, manifest): 										# Check Manifest Files
+		'''
+		- 1. Description:
+			- Determine whether every file listed in a manifest has arrived.
+
+		- 2. Inputs:
+			- subdir   : (String) Session Directory
+			- manifest : (String) Manifest File Path
+
+		- 3. Outputs:
+			- complete : (Bool  ) True if all files are present (and sizes match)
+		'''
+
+		try: 																			# Manifest might still be Written
+			with open(manifest, 'r') as f: 												# Read Manifest
+				expected = json.loads(f.read()) 										# Expected Files
+		except (OSError, ValueError): 													# Incomplete or Unreadable
+			return False
+
+		if isinstance(expected, list): 													# List of Files without Sizes
+			expected = {filename: None for filename in expected}
+
+		for filename, size in expected.items(): 										# Iterate over Expected Files
+			filepath = os.path.join(subdir, filename) 									# Full Path
+			if os.path.isfile(filepath) == False: 										# File Missing
+				return False
+			if size is not None and os.path.getsize(filepath) != int(size): 			# File Incomplete
+				return False
+		return True
+
+	def check(self, sub, ses, now): 													# Check a Single Session
+		'''
+		- 1. Description:
+			- Check whether a single session finished uploading.
+
+		- 2. Inputs:
+			- sub      : (String) Current Subject as string
+			- ses      : (String) Current Subject's Session as string
+			- now      : (Float ) Current time
+
+		- 3. Outputs:
+			- reason   : (String) Why the session is ready (None if not ready)
+		'''
+
+		subdir = self.session_dir(sub, ses) 											# Raw Session Directory
+
+		for sentinel in self.sentinels: 												# Iterate over Sentinel Files
+			if os.path.exists(os.path.join(subdir, sentinel)): 							# Sentinel Found
+				return 'sentinel {}'.format(sentinel)
+
+		for manifest in self.manifests: 												# Iterate over Manifest Files
+			manifest = os.path.join(subdir, manifest) 									# Manifest Path
+			if os.path.exists(manifest): 												# Manifest Found - Only Trust Manifest
+				if self.manifest_complete(subdir, manifest): 							# All Files Arrived
+					return 'manifest {}'.format(os.path.basename(manifest))
+				return None
+
+		previous, changed = self.pending[(sub, ses)] 									# Previous Snapshot
+		snapshot          = tree_snapshot(subdir) 										# Current Snapshot
+		if snapshot != previous: 														# Something Changed (or First Look)
+			changed = now if previous is not None else changed 							# Time of Change (First Look - Time Added)
+			self.pending[(sub, ses)] = (snapshot, changed) 								# Keep New Snapshot
+			return None
+
+		if snapshot[0] > 0 and now - changed >= self.quiet: 							# Files Present and Quiet
+			return 'quiet {:.0f}s'.format(now - changed)
+		return None
+
+	def expired(self, sub, ses, now): 													# Waited Longer than Timeout
+		previous, changed = self.pending[(sub, ses)] 									# Time Added or Last Change
+		return self.timeout is not None and now - changed >= self.timeout
+
+	def poll(self): 																	# Check all Pending Sessions
+		'''
+		- 1. Description:
+			- Check every pending session once. Sessions that are ready are
+			    removed from the pending sessions and returned.
+
+		- 2. Outputs:
+			- ready    : (List  ) (Subject, Session, Reason) of ready sessions
+		'''
+
+		now   = t0.time() 																# Current Time
+		ready = [] 																		# Ready Sessions
+		for sub, ses in list(self.pending.keys()): 										# Iterate over Pending Sessions
+			reason = self.check(sub, ses, now) 											# Check Session
+			if reason is None and self.expired(sub, ses, now): 							# Upload Never Completed
+				reason = 'timeout {:.0f}s'.format(self.timeout)
+			if reason is not None: 														# Session Ready
+				del self.pending[(sub, ses)] 											# Stop Watching
+				ready.append((sub, ses, reason)) 										# Ready for Processing
+		return ready
+
+class StreamingWatcher(UploadWatcher): 													# Upload Watcher that Sorts while Uploading
+	'''
+	- 1. Description:
+		- Sorts the dicoms of every pending session into their series folders
+		    while the upload is still arriving (see dicomsorter), and marks a
+		    session ready as soon as the series it needs are complete, instead
+		    of waiting for the whole upload. A series (a folder of the sort
+		    scheme) is complete once it holds its expected number of images
+		    (ImagesInAcquisition) or no new image arrived for series_quiet
+		    seconds. A session is ready once every pattern in require (i.e. the
+		    MRS and T1w series, matched against the series folder names) is
+		    matched by a complete series. Sessions are also ready on the usual
+		    upload checks (sentinel, manifest, quiet, timeout; see UploadWatcher).
+
+		    A session released by its required series is watched until the
+		    usual upload checks complete. Files that arrive after the release
+		    are not sorted here, since the dicomsort stage of the session may
+		    be sorting at the same time. They are counted instead, and the
+		    session is returned once more (reason 'late ...') to be processed
+		    again, so its dicomsort stage sorts them.
+
+		  Note: Only files untouched for settle seconds are sorted, so files are
+		    not moved while they are being written. Files that can not be read
+		    yet (i.e. still being copied) are tried again at the next poll.
+
+	- 2. Inputs:
+		- basedir  : (String) Base Directory where raw and bids can be found.
+		- require  : (List  ) Series folder patterns that must be complete (i.e. SE GR)
+		- scheme   : (String) Folder scheme of the sorter (i.e. {ScanningSequence})
+		- series_quiet: (Float) Seconds without new images before a series is complete.
+		- settle   : (Float ) Seconds a file must be untouched before it is sorted.
+		- link     : (Bool  ) Hardlink dicoms into their folders instead of moving them
+		- threads  : (Int   ) Header reads at the same time
+		- kwargs   : (Dict  ) UploadWatcher settings (quiet, sentinels, manifests, timeout)
+	'''
+
+	def __init__(self, basedir, require=(), scheme='{ScanningSequence}', series_quiet=30, settle=2, link=False, threads=8, **kwargs):
+
+		UploadWatcher.__init__(self, basedir, **kwargs)
+		self.require   = list(require) 													# Required Series Patterns
+		self.scheme    = scheme 														# Sort Folder Scheme
+		self.series_quiet = series_quiet 												# Series Quiet Window (Seconds)
+		self.settle    = settle 														# File Settle Time (Seconds)
+		self.link      = link 															# Hardlink instead of Move
+		self.threads   = threads 														# Header Reads at the Same Time
+		self.seen      = {} 															# (Subject, Session) -> Sorted Paths
+		self.series    = {} 															# (Subject, Session) -> Folder -> Series State
+		self.released  = {} 															# (Subject, Session) -> Files Arrived after Release by Required Series
+
+	def discard(self, sub, ses): 														# Stop Watching a Session
+		UploadWatcher.discard(self, sub, ses)
+		self.seen.pop((sub, ses), None)
+		self.series.pop((sub, ses), None)
+		self.released.pop((sub, ses), None)
+
+	def ingest(self, sub, ses, now): 													# Sort Newly Arrived Files
+		'''
+		- 1. Description:
+			- Sorts the files of a session that arrived since the last poll and
+			    updates the image count and last arrival of their series.
+
+		- 2. Inputs:
+			- sub      : (String) Current Subject as string
+			- ses      : (String) Current Subject's Session as string
+			- now      : (Float ) Current time
+
+		- 3. Outputs:
+			- series   : (Dict  ) Folder -> files, expected and last (arrival time)
+		'''
+
+		subdir = self.session_dir(sub, ses) 											# Raw Session Directory
+		seen   = self.seen.setdefault((sub, ses), set()) 								# Files Sorted Earlier
+		series = self.series.setdefault((sub, ses), {}) 								# Series of the Session
+
+		paths  = [] 																	# New Files that Settled
+		for path in dicomsorter.list_files(subdir): 									# Iterate over Session Files
+			if path in seen: 															# Sorted Earlier
+				continue
+			try:
+				if now - os.path.getmtime(path) >= self.settle: 						# Not Being Written
+					paths.append(path)
+			except OSError: 															# Removed Meanwhile
+				continue
+		if len(paths) == 0: 															# Nothing New
+			return series
+
+		stats  = dicomsorter.sort_dicoms(subdir, self.scheme, self.link, self.threads, paths=paths, extra=['ImagesInAcquisition'])
+		placed = set() 																	# Files Read this Poll
+		for path, folder, values in stats['placed']: 									# Iterate over Sorted Dicoms
+			state = series.setdefault(folder, {'files': 0, 'expected': None, 'last': now}) # Series State
+			state['files']   += 1 														# Image Count
+			state['last']     = now 													# Last Arrival
+			if isinstance(values.get('ImagesInAcquisition'), int): 						# Expected Images
+				state['expected'] = values['ImagesInAcquisition']
+			placed.add(path)
+		seen.update(placed) 															# Sorted Dicoms
+		seen.update(set(paths) - set(stats['errors'])) 									# Sources and Other Files (Unreadable Files are Tried Again)
+		return series
+
+	def complete(self, state, now): 													# Series Complete
+		if state['expected'] is not None and state['files'] >= state['expected']: 		# All Images Arrived
+			return True
+		return now - state['last'] >= self.series_quiet 								# No New Images for a While
+
+	def late_files(self, sub, ses): 													# Files that Arrived after the Release
+		seen = self.seen.get((sub, ses), set()) 										# Files Sorted before the Release
+		late = self.released[(sub, ses)]
+		late.update(path for path in dicomsorter.list_files(self.session_dir(sub, ses)) if path not in seen)
+		return late
+
+	def check(self, sub, ses, now): 													# Check a Single Session
+		if (sub, ses) in self.released: 												# Released by Required Series - Wait for the Upload
+			self.late_files(sub, ses) 													# Note Late Files (Sorted by the dicomsort Stage)
+			return UploadWatcher.check(self, sub, ses, now) 							# Usual Upload Checks
+
+		series = self.ingest(sub, ses, now) 											# Sort New Files
+		if len(self.require) > 0: 														# Required Series Given
+			done   = [folder for folder, state in series.items() if self.complete(state, now)] # Complete Series
+			needed = [pattern for pattern in self.require if len(fnmatch.filter(done, pattern)) == 0] # Required Series Missing
+			if len(needed) == 0: 														# Every Required Series Complete
+				return 'series {}'.format(' '.join(sorted(fnmatch.filter(done, pattern)[0] for pattern in self.require)))
+		return UploadWatcher.check(self, sub, ses, now) 								# Usual Upload Checks
+
+	def poll(self): 																	# Check all Pending Sessions
+		'''
+		- 1. Description:
+			- Check every pending session once. A session released by its
+			    required series is returned and watched again until its upload
+			    completes. It is then returned a second time only if files
+			    arrived after its release (reason 'late N file(s) ...').
+
+		- 2. Outputs:
+			- ready    : (List  ) (Subject, Session, Reason) of ready sessions
+		'''
+
+		ready = [] 																		# Ready Sessions
+		for sub, ses, reason in UploadWatcher.poll(self): 								# Iterate over Sessions Ready
+			if (sub, ses) in self.released: 											# Upload of a Released Session Complete
+				late = self.released.pop((sub, ses)) 									# Files Arrived after the Release
+				if len(late) > 0: 														# Process Session Again
+					ready.append((sub, ses, 'late {} file(s), {}'.format(len(late), reason)))
+			elif reason.startswith('series '): 											# Released before the Upload Checks
+				self.released[(sub, ses)] = set() 										# Watch Remaining Upload
+				self.pending[(sub, ses)]  = (None, t0.time()) 							# Fresh Snapshot
+				ready.append((sub, ses, reason))
+				continue
+			else:
+				ready.append((sub, ses, reason))
+			self.seen.pop((sub, ses), None) 											# Forget Session
+			self.series.pop((sub, ses), None)
+		return ready
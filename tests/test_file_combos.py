@@ -0,0 +1,220 @@
+import random, json, ast, os
+
+import numpy as np
+import pytest
+
+run_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'run.py')
+
+
+class NoIndex:
+
+    #Stands in for the BIDS index of run.py, so every
+    #sidecar is read from its json file
+
+    def sidecar(self, nifti_path):
+        return None
+
+
+def load_run_functions():
+
+    #run.py parses its arguments and processes the study when
+    #it is imported, so only the functions under test are taken
+    #from its source
+
+    with open(run_py, 'r') as f:
+        tree = ast.parse(f.read())
+    names = ['nifti_path_to_json_dict', 'find_acceptable_file_combos']
+    nodes = [node for node in tree.body if isinstance(node, ast.FunctionDef) and node.name in names]
+    namespace = {'os': os, 'json': json, 'bids_index': NoIndex()}
+    exec(compile(ast.Module(body=nodes, type_ignores=[]), run_py, 'exec'), namespace)
+    return namespace
+
+
+run_functions = load_run_functions()
+nifti_path_to_json_dict = run_functions['nifti_path_to_json_dict']
+find_acceptable_file_combos = run_functions['find_acceptable_file_combos']
+
+
+def cartesian_file_combos(prereq_dict, subj_dir):
+
+    #Reference: find_acceptable_file_combos before the IntendedFor
+    #graph, which checked every combination of one file per
+    #requirement
+
+    key_lens = []
+    keys = list(prereq_dict.keys())
+    for temp_key in keys:
+        key_lens.append(len(prereq_dict[temp_key]))
+
+    if any(x == 0 for x in key_lens):
+        return []
+
+    if all(x == 1 for x in key_lens):
+        for temp_key in prereq_dict.keys():
+            requirements_temp_list = prereq_dict[temp_key]
+            for i in range(len(requirements_temp_list)):
+                prereq_dict[temp_key][i] = os.path.join(subj_dir, prereq_dict[temp_key][i])
+        return [prereq_dict]
+
+    trash = np.zeros(key_lens)
+    array_enumerator = list(np.ndenumerate(trash))
+
+    acceptable_combinations = []
+    for i in array_enumerator:
+
+        x = i[0]
+
+        intendedfors = []
+        nifti_names = []
+        temp_dict = {}
+        for j, k in enumerate(x):
+            temp_nifti = prereq_dict[keys[j]][k]
+            temp_json = nifti_path_to_json_dict(temp_nifti)
+
+            if 'IntendedFor' in temp_json.keys():
+                intendedfors.append(temp_json['IntendedFor'])
+                temp_dict[keys[j]] = [os.path.join(subj_dir,temp_nifti)]
+                nifti_names.append(temp_nifti)
+            else:
+                raise ValueError('Error: if any requirement has more than one file, IntendedFor fields from the json sidecar must be present to proceed. IntendedFor field was not found for json associated with: ' + temp_nifti)
+
+        process = True
+        for j, temp_nifti in enumerate(nifti_names):
+
+            intendedfors_without_current_key = intendedfors.copy()
+            intendedfors_without_current_key.pop(j)
+
+            if len(intendedfors_without_current_key) == 0:
+                continue
+            else:
+                for temp_intendedfor in intendedfors_without_current_key:
+                    if temp_nifti in temp_intendedfor:
+                        pass
+                    else:
+                        process = False
+
+        if process:
+            acceptable_combinations.append(temp_dict)
+
+    return acceptable_combinations
+
+
+def random_layout(rng, subj_dir, max_requirements=4, max_files=4, missing=0.0, no_sidecar=0.0):
+
+    #Writes the sidecars of a random session and returns the
+    #requirements. Files may fill several requirements, run-1
+    #is a substring of run-10 (IntendedFor strings are searched
+    #with 'in'), IntendedFor may be a single string, and with
+    #missing/no_sidecar a file has no IntendedFor or no sidecar.
+    #Returns the requirements and the sidecar of every file
+
+    runs = ['1', '2', '3', '10', '11']
+    pool = ['ses-01/mrs/sub-01_ses-01_acq-{}_run-{}_svs.nii.gz'.format(acq, run)
+            for acq in ['press', 'ref', 'hercules'] for run in runs]
+    pool += ['ses-01/anat/sub-01_ses-01_run-{}_T1w.nii.gz'.format(run) for run in runs[:2]]
+
+    prereq_dict = {}
+    for j in range(rng.randint(1, max_requirements)):
+        count = rng.choice([0] + [1] * 2 + list(range(1, max_files + 1)) * 3) if j > 0 else rng.randint(1, max_files)
+        prereq_dict['requirement_{}'.format(j)] = rng.sample(pool, count)
+
+    files = sorted(set(f for value in prereq_dict.values() for f in value))
+    sidecars = {}
+    for temp_nifti in files:
+        if rng.random() < no_sidecar:
+            continue
+        sidecar = {'EchoTime': 0.03}
+        if rng.random() >= missing:
+            targets = rng.sample(files, rng.randint(0, len(files)))
+            if len(targets) == 1 and rng.random() < 0.5:
+                sidecar['IntendedFor'] = targets[0]
+            elif rng.random() < 0.2:
+                sidecar['IntendedFor'] = ' '.join(targets)
+            else:
+                sidecar['IntendedFor'] = targets
+        json_path = os.path.join(subj_dir, temp_nifti.split('.nii')[0] + '.json')
+        os.makedirs(os.path.dirname(json_path), exist_ok=True)
+        with open(json_path, 'w') as f:
+            f.write(json.dumps(sidecar))
+        sidecars[temp_nifti] = sidecar
+    return prereq_dict, sidecars
+
+
+def outcome(function, prereq_dict, subj_dir):
+
+    #Combinations, or the type and message of the exception
+
+    try:
+        return function(json.loads(json.dumps(prereq_dict)), subj_dir)
+    except (ValueError, AttributeError) as e:
+        return type(e), str(e)
+
+
+@pytest.mark.parametrize('seed', range(300))
+def test_matches_cartesian_combinations(seed, tmp_path, monkeypatch):
+
+    rng = random.Random(seed)
+    subj_dir = str(tmp_path)
+    monkeypatch.chdir(subj_dir)
+    prereq_dict, sidecars = random_layout(rng, subj_dir)
+
+    expected = outcome(cartesian_file_combos, prereq_dict, subj_dir)
+    assert outcome(find_acceptable_file_combos, prereq_dict, subj_dir) == expected
+
+
+@pytest.mark.parametrize('seed', range(200))
+def test_matches_cartesian_errors(seed, tmp_path, monkeypatch):
+
+    rng = random.Random(seed)
+    subj_dir = str(tmp_path)
+    monkeypatch.chdir(subj_dir)
+    prereq_dict, sidecars = random_layout(rng, subj_dir, missing=0.15, no_sidecar=0.1)
+
+    expected = outcome(cartesian_file_combos, prereq_dict, subj_dir)
+    assert outcome(find_acceptable_file_combos, prereq_dict, subj_dir) == expected
+
+
+def test_single_files_are_not_checked(tmp_path, monkeypatch):
+
+    #One file per requirement is used without reading sidecars
+
+    monkeypatch.chdir(str(tmp_path))
+    prereq_dict = {'metab': ['ses-01/mrs/sub-01_ses-01_svs.nii.gz'], 'ref': ['ses-01/mrs/sub-01_ses-01_ref.nii.gz']}
+    combos = find_acceptable_file_combos(json.loads(json.dumps(prereq_dict)), str(tmp_path))
+    assert combos == cartesian_file_combos(json.loads(json.dumps(prereq_dict)), str(tmp_path))
+    assert combos == [{key: [os.path.join(str(tmp_path), value[0])] for key, value in prereq_dict.items()}]
+
+
+def test_layouts_cover_every_case(tmp_path):
+
+    #The seeded layouts include one and several requirements,
+    #shared files, string IntendedFor fields, missing fields and
+    #sidecars, and sessions with and without acceptable combinations
+
+    cases = set()
+    for seed in range(300):
+        subj_dir = str(tmp_path / str(seed))
+        prereq_dict, sidecars = random_layout(random.Random(seed), subj_dir)
+        files = [f for value in prereq_dict.values() for f in value]
+        cases.add('one requirement' if len(prereq_dict) == 1 else 'several requirements')
+        if len(files) > len(set(files)):
+            cases.add('shared file')
+        if any(isinstance(sidecar.get('IntendedFor'), str) for sidecar in sidecars.values()):
+            cases.add('string IntendedFor')
+        cwd = os.getcwd()
+        os.chdir(subj_dir)
+        try:
+            combos = cartesian_file_combos(json.loads(json.dumps(prereq_dict)), subj_dir)
+        finally:
+            os.chdir(cwd)
+        cases.add('combinations' if len(combos) > 0 else 'no combinations')
+    for seed in range(200):
+        subj_dir = str(tmp_path / 'errors_{}'.format(seed))
+        prereq_dict, sidecars = random_layout(random.Random(seed), subj_dir, missing=0.15, no_sidecar=0.1)
+        files = set(f for value in prereq_dict.values() for f in value)
+        if any(f in sidecars and 'IntendedFor' not in sidecars[f] for f in files):
+            cases.add('missing IntendedFor')
+        if any(f not in sidecars for f in files):
+            cases.add('missing sidecar')
+    assert cases == {'one requirement', 'several requirements', 'shared file', 'string IntendedFor',
+                     'combinations', 'no combinations', 'missing IntendedFor', 'missing sidecar'}